@@ -1,5 +1,6 @@
 from flask import Flask
 from flask_cors import CORS
+from app.json_provider import FastJSONProvider
 import os
 
 def create_app():
@@ -11,6 +12,8 @@ def create_app():
     
     # Use environment variable for secret key in production
     app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-in-production')
+    # orjson-backed jsonify(): faster, and dates/datetimes/Decimals serialize natively
+    app.json = FastJSONProvider(app)
     CORS(app)
     
     # Import and register blueprints
@@ -0,0 +1,145 @@
+"""
+Response formats for routes that return a list of rows under "data"
+?format=json (default) returns the payload as is; html, csv and ndjson stream just the rows,
+so no route builds a DataFrame or HTML table unless the caller asked for one.
+Without ?format= the Accept header picks the format; */* or no match means json.
+?shape=columns sends rows as {"columns": [...], "rows": [[...], ...]} instead of one object each.
+"""
+
+import csv
+from html import escape
+
+from flask import jsonify, request, Response, stream_with_context
+
+from app.json_provider import dumps
+
+
+FORMATS = ('json', 'html', 'csv', 'ndjson')
+MIMETYPES = {
+    'json': 'application/json',
+    'html': 'text/html',
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+# Rows rendered per chunk of a streamed csv/html/ndjson response
+STREAM_BATCH_ROWS = 500
+
+
+def requested_format():
+    """
+    The ?format= of this request, else the best match for its Accept header, else 'json'
+    None if ?format= is not one of FORMATS.
+    """
+    fmt = request.args.get('format')
+    if fmt:
+        fmt = fmt.lower()
+        return fmt if fmt in FORMATS else None
+    best = request.accept_mimetypes.best_match(list(MIMETYPES.values()), default=MIMETYPES['json'])
+    return next(name for name, mimetype in MIMETYPES.items() if mimetype == best)
+
+
+def columns_requested():
+    return request.args.get('shape') == 'columns'
+
+
+def shaped_rows(columns, rows):
+    """
+    Database rows (tuples in column order) for a JSON "data" field
+    Columnar when ?shape=columns, saving the per-row dict and the repeated keys; else a list of dicts.
+    """
+    if columns_requested():
+        return {"columns": list(columns), "rows": rows}
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def row_columns(rows):
+    """Column names across all rows, in first-seen order"""
+    columns = {}
+    for row in rows:
+        for column in row:
+            columns.setdefault(column, None)
+    return list(columns)
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return dumps(value)
+    return value
+
+
+def _batches(rows):
+    for start in range(0, len(rows), STREAM_BATCH_ROWS):
+        yield rows[start:start + STREAM_BATCH_ROWS]
+
+
+class _Lines:
+    """File-like object for csv.writer that collects written lines until taken"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, value):
+        self.lines.append(value)
+
+    def take(self):
+        chunk = ''.join(self.lines)
+        self.lines = []
+        return chunk
+
+
+def iter_csv(rows, columns):
+    out = _Lines()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for batch in _batches(rows):
+        writer.writerows([_cell(row.get(column)) for column in columns] for row in batch)
+        yield out.take()
+    yield out.take()
+
+
+def iter_ndjson(rows):
+    for batch in _batches(rows):
+        yield ''.join(dumps(row) + '\n' for row in batch)
+
+
+def iter_html(rows, columns, table_class, empty_message):
+    """A plain <table>, streamed a batch of rows at a time; every value is HTML-escaped"""
+    if not rows:
+        yield f"<p>{escape(empty_message)}</p>\n"
+        return
+    yield (f'<table class="{escape(table_class)}">\n<thead><tr>'
+           + ''.join(f"<th>{escape(column)}</th>" for column in columns)
+           + '</tr></thead>\n<tbody>\n')
+    for batch in _batches(rows):
+        yield ''.join(
+            '<tr>' + ''.join(f"<td>{escape(str(_cell(row.get(column))))}</td>" for column in columns) + '</tr>\n'
+            for row in batch
+        )
+    yield '</tbody>\n</table>\n'
+
+
+def respond(payload, status=200, table_class='table table-striped', empty_message='No rows found'):
+    """
+    Return payload (a dict with the rows under "data") in the requested format
+    Everything but json drops the rest of the payload and streams only the rows.
+    """
+    fmt = requested_format()
+    if fmt is None:
+        return jsonify({"error": f"Unknown format; use one of {', '.join(FORMATS)}"}), 400
+    if fmt == 'json':
+        response = jsonify(payload)
+        response.status_code = status
+    else:
+        rows = payload.get('data') or []
+        if fmt == 'ndjson':
+            body = iter_ndjson(rows)
+        elif fmt == 'csv':
+            body = iter_csv(rows, row_columns(rows))
+        else:
+            body = iter_html(rows, row_columns(rows), table_class, empty_message)
+        response = Response(stream_with_context(body), status=status, mimetype=MIMETYPES[fmt])
+    # The same URL answers differently per Accept header; caches must key on it
+    response.vary.add('Accept')
+    return response
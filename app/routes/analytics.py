@@ -1,8 +1,13 @@
-from flask import jsonify
+from flask import jsonify, request, Response, stream_with_context
+import os
+import time
+import uuid
 from datetime import datetime
 import pandas as pd
 from . import analytics_bp
-from app.utils import get_db_connection
+from app.utils import get_db_connection, get_pool_stats
+from app.formats import shaped_rows
+from app.json_provider import dumps
 
 # ===== PATIENT ROUTES =====
 @analytics_bp.route('/health', methods=['GET'])
@@ -12,13 +17,11 @@ def health():
 @analytics_bp.route('/patients/count', methods=['GET'])
 def patient_count():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         query = "SELECT COUNT(*) FROM patients;"
-        cursor.execute(query)
-        count = cursor.fetchone()[0]
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            count = cursor.fetchone()[0]
         
         return jsonify({
             "data": count,
@@ -29,34 +32,73 @@ def patient_count():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+PATIENTS_DEFAULT_LIMIT = 1000
+PATIENTS_MAX_LIMIT = 10000
+PATIENTS_STREAM_BATCH_SIZE = 2000
+
+
+# Response keys of the patient_id, first_name, last_name, date_of_birth, email query columns
+PATIENT_FIELDS = ("id", "first_name", "last_name", "date_of_birth", "email")
+
+
+def _stream_patients(after_id, batch_size):
+    """Yield NDJSON lines from a server-side cursor, batch_size rows at a time"""
+    query = """
+    SELECT patient_id, first_name, last_name, date_of_birth, email
+    FROM patients
+    WHERE patient_id > %s
+    ORDER BY patient_id;
+    """
+    with get_db_connection() as conn:
+        # Named cursor = server-side cursor, so rows stay in Postgres until fetched
+        cursor = conn.cursor(name=f"patients_export_{uuid.uuid4().hex}")
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(query, (after_id,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield ''.join(dumps(dict(zip(PATIENT_FIELDS, p))) + '\n' for p in rows)
+        finally:
+            cursor.close()
+
+
 @analytics_bp.route('/patients', methods=['GET'])
 def get_patients():
+    """
+    Patients ordered by patient_id, paginated with ?limit=&after_id=
+    ?format=ndjson streams every patient after after_id as newline-delimited JSON
+    ?shape=columns returns {"columns", "rows"} instead of one object per patient
+    """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        query = "SELECT patient_id, first_name, last_name, date_of_birth, email FROM patients;"
-        cursor.execute(query)
-        patients = cursor.fetchall()
-        
-        patient_list = [
-            {
-                "id": p[0],
-                "first_name": p[1],
-                "last_name": p[2],
-                "date_of_birth": str(p[3]),
-                "email": p[4]
-            }
-            for p in patients
-        ]
-        
-        conn.close()
+        after_id = request.args.get('after_id', 0, type=int)
+
+        if request.args.get('format') == 'ndjson':
+            batch_size = request.args.get('batch_size', PATIENTS_STREAM_BATCH_SIZE, type=int)
+            batch_size = max(1, min(batch_size, PATIENTS_MAX_LIMIT))
+            return Response(
+                stream_with_context(_stream_patients(after_id, batch_size)),
+                mimetype='application/x-ndjson'
+            )
+
+        limit = request.args.get('limit', PATIENTS_DEFAULT_LIMIT, type=int)
+        limit = max(1, min(limit, PATIENTS_MAX_LIMIT))
+
+        query = "SELECT patient_id, first_name, last_name, date_of_birth, email FROM patients WHERE patient_id > %s ORDER BY patient_id LIMIT %s;"
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (after_id, limit))
+            patients = cursor.fetchall()
         
         return jsonify({
-            "data": patient_list,
+            "data": shaped_rows(PATIENT_FIELDS, patients),
             "query": query,
-            "description": "Returns all patients with their basic information",
-            "count": len(patient_list),
+            "description": "Returns patients with their basic information, one page at a time",
+            "count": len(patients),
+            "limit": limit,
+            "after_id": after_id,
+            "next_after_id": patients[-1][0] if len(patients) == limit else None,
             "timestamp": datetime.now().isoformat()
         }), 200
     except Exception as e:
@@ -66,65 +108,80 @@ def get_patients():
 @analytics_bp.route('/conditions', methods=['GET'])
 def get_conditions():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         query = "SELECT condition_id, condition_name, description, severity_level FROM conditions;"
-        cursor.execute(query)
-        conditions = cursor.fetchall()
-        
-        condition_list = [
-            {
-                "id": c[0],
-                "name": c[1],
-                "description": c[2],
-                "severity": c[3]
-            }
-            for c in conditions
-        ]
-        
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            conditions = cursor.fetchall()
         
         return jsonify({
-            "data": condition_list,
+            "data": shaped_rows(("id", "name", "description", "severity"), conditions),
             "query": query,
             "description": "Returns all medical conditions in the database",
-            "count": len(condition_list),
+            "count": len(conditions),
             "timestamp": datetime.now().isoformat()
         }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def refresh_condition_prevalence(conn):
+    """Recompute the condition_prevalence materialized view without blocking readers"""
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY condition_prevalence;")
+    duration_ms = round((time.perf_counter() - started) * 1000, 3)
+    cursor.execute("""
+        INSERT INTO materialized_view_refreshes (view_name, refreshed_at, duration_ms)
+        VALUES ('condition_prevalence', CURRENT_TIMESTAMP, %s)
+        ON CONFLICT (view_name) DO UPDATE
+        SET refreshed_at = EXCLUDED.refreshed_at, duration_ms = EXCLUDED.duration_ms
+        RETURNING refreshed_at;
+    """, (duration_ms,))
+    refreshed_at = cursor.fetchone()[0]
+    conn.commit()
+    return refreshed_at, duration_ms
+
+
 @analytics_bp.route('/analytics/patient-conditions', methods=['GET'])
 def patient_conditions_analytics():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         query = """
-        SELECT c.condition_name, COUNT(pc.patient_id) as patient_count
-        FROM conditions c
-        LEFT JOIN patient_conditions pc ON c.condition_id = pc.condition_id
-        GROUP BY c.condition_id, c.condition_name
+        SELECT condition_name, patient_count
+        FROM condition_prevalence
         ORDER BY patient_count DESC;
         """
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        analytics = [
-            {
-                "condition": r[0],
-                "patient_count": r[1]
-            }
-            for r in results
-        ]
-        
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            results = cursor.fetchall()
+            cursor.execute(
+                "SELECT refreshed_at, CURRENT_TIMESTAMP::TIMESTAMP - refreshed_at "
+                "FROM materialized_view_refreshes WHERE view_name = 'condition_prevalence';"
+            )
+            refresh = cursor.fetchone()
         
         return jsonify({
-            "data": analytics,
+            "data": shaped_rows(("condition", "patient_count"), results),
             "query": query.strip(),
             "description": "Shows how many patients have each condition",
+            "refreshed_at": refresh[0].isoformat() if refresh else None,
+            "stale_seconds": refresh[1].total_seconds() if refresh else None,
+            "timestamp": datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@analytics_bp.route('/analytics/patient-conditions/refresh', methods=['POST'])
+def refresh_patient_conditions_analytics():
+    """Refresh the precomputed condition counts"""
+    try:
+        with get_db_connection() as conn:
+            refreshed_at, duration_ms = refresh_condition_prevalence(conn)
+        
+        return jsonify({
+            "message": "Condition prevalence refreshed",
+            "refreshed_at": refreshed_at.isoformat(),
+            "duration_ms": duration_ms,
             "timestamp": datetime.now().isoformat()
         }), 200
     except Exception as e:
@@ -133,9 +190,6 @@ def patient_conditions_analytics():
 @analytics_bp.route('/saved-epic-observations', methods=['GET'])
 def get_saved_epic_observations():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         query = """
         SELECT 
             po.observation_id,
@@ -143,36 +197,37 @@ def get_saved_epic_observations():
             po.value,
             po.unit,
             po.observation_date,
-            p.first_name,
-            p.last_name,
+            CASE WHEN p.first_name IS NOT NULL
+                 THEN concat_ws(' ', p.first_name, p.last_name)
+                 ELSE 'Unknown' END,
             po.fhir_patient_id
         FROM patient_observations po
         LEFT JOIN patients p ON po.patient_id = p.patient_id
         ORDER BY po.observation_date DESC
         LIMIT 50
         """
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        observations = [
-            {
-                "id": r[0],
-                "test_name": r[1],
-                "value": r[2],
-                "unit": r[3],
-                "date": str(r[4]) if r[4] else None,
-                "patient_name": f"{r[5]} {r[6]}" if r[5] else "Unknown",
-                "fhir_id": r[7]
-            }
-            for r in results
-        ]
-        
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            results = cursor.fetchall()
         
         return jsonify({
-            "data": observations,
-            "count": len(observations),
+            "data": shaped_rows(("id", "test_name", "value", "unit", "date", "patient_name", "fhir_id"), results),
+            "count": len(results),
             "timestamp": datetime.now().isoformat()
         }), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+
+# ===== DATABASE ROUTES =====
+@analytics_bp.route('/db/pool-stats', methods=['GET'])
+def db_pool_stats():
+    """Connection pool usage for this worker process"""
+    stats = get_pool_stats()
+    return jsonify({
+        "data": stats,
+        "pid": os.getpid(),
+        "description": "Connection pool in-use/idle counts and checkout wait times" if stats else "No database connection pool created yet in this process",
+        "timestamp": datetime.now().isoformat()
+    }), 200
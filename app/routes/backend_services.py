@@ -4,24 +4,99 @@ Backend Services routes - No user login required
 Perfect for automated bulk data operations
 """
 
-from flask import jsonify, request
+from flask import jsonify, request, Response, stream_with_context
 from datetime import datetime
-import pandas as pd
+import os
+import threading
+import time
 from . import backend_bp
 from epic_backend_auth import EpicBackendAuth, EpicBulkExport
+from app.utils import get_db_connection
+from app.formats import respond
+from app.json_provider import dumps
+from epic_fhir import (
+    EpicFHIRClient, PATIENT_SUMMARY_ELEMENTS, OBSERVATION_SUMMARY_ELEMENTS,
+    projection_params, patient_summary, observation_summary
+)
+import fhir_http
+import token_store
+from bulk_export_jobs import BulkExportJobManager
+import bulk_ingest
+from demographics import PatientColumns
+import ndjson_index
+import parquet_landing
 
 
 # Initialize backend auth client (singleton)
 backend_auth = None
+_backend_auth_lock = threading.Lock()
 
 def get_backend_auth():
-    """Get or create backend auth client"""
+    """Get or create backend auth client; BACKEND_TOKEN_STORE shares its token across workers"""
     global backend_auth
     if backend_auth is None:
-        backend_auth = EpicBackendAuth()
+        with _backend_auth_lock:
+            if backend_auth is None:
+                backend_auth = EpicBackendAuth(token_store=token_store.token_store_from_env(get_db_connection))
     return backend_auth
 
 
+job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Get or create the bulk export job manager (each worker process starts its own poller)"""
+    global job_manager
+    if job_manager is None:
+        with _job_manager_lock:
+            if job_manager is None:
+                on_complete = start_ingest if os.getenv('BULK_EXPORT_AUTO_INGEST', '0') == '1' else None
+                job_manager = BulkExportJobManager(EpicBulkExport(get_backend_auth()), get_db_connection,
+                                                   on_complete=on_complete)
+    return job_manager
+
+
+def start_ingest(job_id):
+    """Load a completed job's files into Postgres on a background thread (worker processes do the work)"""
+    def run():
+        try:
+            bulk_ingest.ingest_job(job_id)
+        except Exception as e:
+            print(f"Ingest of bulk export job {job_id} failed: {e}")
+    threading.Thread(target=run, name=f'bulk-ingest-{job_id}', daemon=True).start()
+
+
+# After a failed start, wait this long before a later request tries again
+POLLER_RETRY_SECONDS = float(os.getenv('BULK_EXPORT_POLLER_RETRY', 60))
+_poller_started = False
+_poller_retry_at = 0.0
+_poller_lock = threading.Lock()
+
+
+@backend_bp.before_app_request
+def start_bulk_export_poller():
+    """
+    Resume polling persisted export jobs in this process
+    Started on a process's first request, not at app creation, so every preforked worker runs one.
+    """
+    global _poller_started, _poller_retry_at
+    if _poller_started or os.getenv('BULK_EXPORT_POLLER', '1') != '1':
+        return
+    if time.monotonic() < _poller_retry_at or not _poller_lock.acquire(blocking=False):
+        # Backing off after a failure, or another request is starting it right now
+        return
+    try:
+        if not _poller_started:
+            get_job_manager().start()
+            _poller_started = True
+    except Exception as e:
+        # Never fail the request itself; a request after the back-off tries again
+        _poller_retry_at = time.monotonic() + POLLER_RETRY_SECONDS
+        print(f"Could not start bulk export poller (retrying in {POLLER_RETRY_SECONDS:.0f}s): {e}")
+    finally:
+        _poller_lock.release()
+
+
 @backend_bp.route('/backend/test-connection', methods=['GET'])
 def test_backend_connection():
     """Test backend services authentication"""
@@ -73,60 +148,25 @@ def bulk_export_patients():
         print(f"Fetching {count} patients via Backend Services...")
         
         # Fetch patients (no user login needed!)
-        patients_data = bulk.simple_patient_export(count=count)
+        patients_data = bulk.simple_patient_export(count=count, elements=PATIENT_SUMMARY_ELEMENTS)
         
-        # Process patient data
-        processed_patients = []
-        gender_counts = {'male': 0, 'female': 0, 'other': 0}
+        # Process patient data: one pass into arrays, then vectorized stats
+        columns = PatientColumns.from_resources(patients_data)
         
-        for resource in patients_data:
-            name = resource.get('name', [{}])[0]
-            gender = resource.get('gender', 'unknown').lower()
-            dob = resource.get('birthDate')
-            
-            # Calculate age
-            age = None
-            if dob:
-                from datetime import datetime as dt
-                birth_date = dt.strptime(dob, '%Y-%m-%d')
-                age = (dt.now() - birth_date).days // 365
-            
-            processed_patients.append({
-                'id': resource.get('id'),
-                'first_name': name.get('given', [''])[0],
-                'last_name': name.get('family', ''),
-                'dob': dob,
-                'age': age,
-                'gender': gender if gender in ['male', 'female'] else 'other',
-                'avatar': f'https://ui-avatars.com/api/?name={name.get("given", [""])[0]}+{name.get("family", "")}'
-            })
-            
-            if gender in ['male', 'female']:
-                gender_counts[gender] += 1
-            else:
-                gender_counts['other'] += 1
-        
-        # Create DataFrame for analytics
-        df = pd.DataFrame(processed_patients)
-        
-        stats = {
-            'total_patients': len(processed_patients),
-            'gender_counts': gender_counts,
-            'average_age': float(df['age'].mean()) if 'age' in df.columns and not df['age'].isna().all() else None,
-            'age_range': {
-                'min': int(df['age'].min()) if 'age' in df.columns and not df['age'].isna().all() else None,
-                'max': int(df['age'].max()) if 'age' in df.columns and not df['age'].isna().all() else None
-            }
-        }
+        processed_patients = [patient_summary(resource) for resource in patients_data]
+        for patient, age, gender in zip(processed_patients, columns.age_list(), columns.genders()):
+            patient['age'] = age
+            patient['gender'] = gender
         
-        return jsonify({
+        stats = columns.stats()
+        
+        return respond({
             "status": "success",
             "data": processed_patients,
             "stats": stats,
-            "table_html": df.to_html(classes='table table-striped table-hover'),
             "auth_method": "Backend Services (No User Login)",
             "timestamp": datetime.now().isoformat()
-        }), 200
+        }, table_class='table table-striped table-hover')
         
     except Exception as e:
         import traceback
@@ -146,38 +186,93 @@ def get_patient_observations_backend(patient_id):
         auth = get_backend_auth()
         token = auth.get_access_token()
         
-        import requests
         headers = {
             'Authorization': f'Bearer {token}',
             'Accept': 'application/fhir+json'
         }
         
         url = f"{auth.fhir_url}/Observation"
-        params = {'patient': patient_id, 'category': 'laboratory'}
+        params = {
+            'patient': patient_id,
+            'category': 'laboratory',
+            **projection_params(OBSERVATION_SUMMARY_ELEMENTS)
+        }
         
-        response = requests.get(url, headers=headers, params=params)
+        response = fhir_http.get(url, headers=headers, params=params)
         response.raise_for_status()
         
         obs_data = response.json()
         
-        observations = []
-        for entry in obs_data.get('entry', []):
-            resource = entry.get('resource', {})
-            observations.append({
-                'code': resource.get('code', {}).get('coding', [{}])[0].get('display', 'Unknown'),
-                'value': resource.get('valueQuantity', {}).get('value', 'N/A'),
-                'unit': resource.get('valueQuantity', {}).get('unit', ''),
-                'date': resource.get('effectiveDateTime', 'N/A')
-            })
-        
-        df = pd.DataFrame(observations) if observations else pd.DataFrame()
+        observations = [
+            observation_summary(entry.get('resource', {}))
+            for entry in obs_data.get('entry', [])
+        ]
         
-        return jsonify({
+        return respond({
             "status": "success",
             "data": observations,
-            "table_html": df.to_html(classes='table table-striped') if not df.empty else "<p>No observations found</p>",
             "patient_id": patient_id,
             "timestamp": datetime.now().isoformat()
+        }, empty_message="No observations found")
+        
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
+MAX_BATCH_PATIENTS = 500
+
+
+@backend_bp.route('/backend/observations/batch', methods=['POST'])
+def get_observations_batch():
+    """
+    Fetch observations for many patients concurrently
+    Body: {"patient_ids": [...], "category": "laboratory"}
+    Results come back in completion order; ?format=ndjson streams one line per patient as it finishes
+    """
+    try:
+        body = request.get_json(silent=True) or {}
+        patient_ids = body.get('patient_ids') or []
+        category = body.get('category', 'laboratory')
+        
+        if not patient_ids:
+            return jsonify({"status": "error", "message": "patient_ids required"}), 400
+        if not isinstance(patient_ids, list) or not all(isinstance(pid, str) and pid for pid in patient_ids):
+            return jsonify({"status": "error", "message": "patient_ids must be a list of non-empty strings"}), 400
+        if len(patient_ids) > MAX_BATCH_PATIENTS:
+            return jsonify({"status": "error", "message": f"At most {MAX_BATCH_PATIENTS} patient_ids per batch"}), 400
+        
+        auth = get_backend_auth()
+        client = EpicFHIRClient(auth.get_access_token(), cache_scope=f"backend:{auth.client_id}")
+        results = client.iter_observations_for_patients(
+            patient_ids, category=category, elements=OBSERVATION_SUMMARY_ELEMENTS
+        )
+        
+        def result_row(patient_id, resources, error):
+            return {
+                "patient_id": patient_id,
+                "status": "error" if error else "success",
+                "message": error,
+                "count": len(resources),
+                "data": [observation_summary(resource) for resource in resources]
+            }
+        
+        if request.args.get('format') == 'ndjson':
+            def stream():
+                for patient_id, resources, error in results:
+                    yield dumps(result_row(patient_id, resources, error)) + '\n'
+            return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+        
+        rows = [result_row(*result) for result in results]
+        
+        return jsonify({
+            "status": "success",
+            "data": rows,
+            "patients": len(rows),
+            "errors": sum(1 for row in rows if row["status"] == "error"),
+            "timestamp": datetime.now().isoformat()
         }), 200
         
     except Exception as e:
@@ -191,23 +286,26 @@ def get_patient_observations_backend(patient_id):
 def start_bulk_export():
     """
     Initiate a full FHIR bulk data export
-    This uses the official $export operation
+    This uses the official $export operation; the server polls it and downloads the output
     """
     try:
-        auth = get_backend_auth()
-        bulk = EpicBulkExport(auth)
+        manager = get_job_manager()
         
         # Get parameters
         resource_type = request.json.get('resource_type', 'Patient')
         params = request.json.get('params', {})
+        # Only ask for changes since the last ingested export unless told otherwise
+        incremental = request.json.get('incremental', True)
         
-        # Initiate export
-        status_url = bulk.initiate_export(resource_type, params)
+        # Initiate export and hand it to the background poller
+        job = manager.submit(resource_type, params, incremental=incremental)
         
         return jsonify({
             "status": "initiated",
-            "status_url": status_url,
-            "message": "Bulk export started. Poll the status URL to check progress.",
+            "job_id": job['job_id'],
+            "status_url": job['status_url'],
+            "job": job,
+            "message": f"Bulk export started. Check /api/backend/bulk-export-jobs/{job['job_id']} for progress.",
             "timestamp": datetime.now().isoformat()
         }), 202
         
@@ -218,6 +316,146 @@ def start_bulk_export():
         }), 500
 
 
+@backend_bp.route('/backend/bulk-export-jobs', methods=['GET'])
+def list_bulk_export_jobs():
+    """Recent bulk export jobs, newest first"""
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        return jsonify({
+            "data": get_job_manager().list_jobs(limit),
+            "timestamp": datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@backend_bp.route('/backend/bulk-export-jobs/<int:job_id>', methods=['GET'])
+def get_bulk_export_job(job_id):
+    """State of one bulk export job, as last recorded by the poller (no call to Epic)"""
+    try:
+        job = get_job_manager().get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@backend_bp.route('/backend/bulk-export-jobs/<int:job_id>/ingest', methods=['POST'])
+def ingest_bulk_export_job(job_id):
+    """Load a completed job's Patient/Observation files into the database"""
+    try:
+        job = get_job_manager().get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        if job['status'] != 'complete':
+            return jsonify({"error": f"Job is {job['status']}, not complete"}), 409
+        if bulk_ingest.ingest_running(job_id):
+            return jsonify({"error": "Job is already being ingested"}), 409
+        
+        start_ingest(job_id)
+        return jsonify({
+            "status": "started",
+            "job_id": job_id,
+            "message": f"Ingest started. Check /api/backend/bulk-export-jobs/{job_id}/ingest for progress.",
+            "timestamp": datetime.now().isoformat()
+        }), 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@backend_bp.route('/backend/bulk-export-jobs/<int:job_id>/ingest', methods=['GET'])
+def get_bulk_ingest_progress(job_id):
+    """Files of a job loaded so far, with rows per second"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT file_key, resource_type, resources, rows_written, unchanged, skipped, unknown_patients,
+                       seconds, rows_per_second, completed_at
+                FROM bulk_ingest_checkpoints
+                WHERE job_id = %s
+                ORDER BY completed_at
+            """, (job_id,))
+            columns = [desc[0] for desc in cursor.description]
+            files = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
+        
+        for f in files:
+            f['completed_at'] = f['completed_at'].isoformat() if f['completed_at'] else None
+        
+        return jsonify({
+            "job_id": job_id,
+            "files": files,
+            "resources": sum(f['resources'] for f in files),
+            "timestamp": datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@backend_bp.route('/backend/bulk-export-jobs/<int:job_id>/lookup', methods=['GET'])
+def lookup_bulk_export_resources(job_id):
+    """
+    Pull resources out of a job's downloaded files without loading them
+    ?id=<resource id> or ?patient=<patient id>, optionally &type=Observation
+    """
+    resource_id = request.args.get('id')
+    patient_id = request.args.get('patient')
+    resource_type = request.args.get('type')
+    if not resource_id and not patient_id:
+        return jsonify({"error": "id or patient is required"}), 400
+
+    try:
+        job = get_job_manager().get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        if job['status'] != 'complete':
+            return jsonify({"error": f"Job is {job['status']}, not complete"}), 409
+
+        resources = []
+        for output in job['output_files'] or []:
+            if resource_type and output.get('type') != resource_type:
+                continue
+            if not os.path.exists(output['path']):
+                continue
+            with ndjson_index.IndexedNdjson(output['path']) as index:
+                if resource_id:
+                    resource = index.get(resource_id)
+                    if resource:
+                        resources.append(resource)
+                else:
+                    resources.extend(index.for_patient(patient_id))
+
+        return jsonify({
+            "job_id": job_id,
+            "data": resources,
+            "count": len(resources),
+            "timestamp": datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@backend_bp.route('/backend/landing/patient-stats', methods=['GET'])
+def landing_patient_stats():
+    """Demographic stats straight from the Parquet landing zone (only gender and birth_date are read)"""
+    try:
+        df = parquet_landing.read_landing('Patient', columns=['id', 'gender', 'birth_date'])
+        # The same patient may have landed from several exports
+        df = df.drop_duplicates('id', keep='last')
+        stats = PatientColumns.from_frame(df).stats()
+        
+        return jsonify({
+            "status": "success",
+            "stats": stats,
+            "source": "parquet",
+            "timestamp": datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 @backend_bp.route('/backend/bulk-export-status', methods=['POST'])
 def check_bulk_export_status():
     """Check status of a bulk export operation"""
@@ -227,6 +465,18 @@ def check_bulk_export_status():
         if not status_url:
             return jsonify({"error": "status_url required"}), 400
         
+        # Jobs started through this server are answered from the job table, not by polling Epic
+        job = get_job_manager().find_job(status_url)
+        if job:
+            if job['status'] == 'complete':
+                result = {'status': 'complete', 'data': job['manifest']}
+            elif job['status'] == 'error':
+                result = {'status': 'error', 'message': job['error']}
+            else:
+                result = {'status': 'in-progress', 'retry_after': job['next_poll_at']}
+            result['job'] = job
+            return jsonify(result), 200
+        
         auth = get_backend_auth()
         bulk = EpicBulkExport(auth)
         
@@ -250,6 +500,7 @@ def get_token_info():
         return jsonify({
             "has_token": auth.access_token is not None,
             "token_expiry": auth.token_expiry.isoformat() if auth.token_expiry else None,
+            "shared_store": type(auth.token_store).__name__ if auth.token_store else None,
             "client_id": auth.client_id,
             "fhir_url": auth.fhir_url
         }), 200
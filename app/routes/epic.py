@@ -1,10 +1,17 @@
 # app/routes/epic.py
 from flask import jsonify, session, redirect, request
 from datetime import datetime
-import pandas as pd
 from . import epic_bp
-from epic_fhir import EpicFHIRClient, get_epic_auth_url, exchange_code_for_token, save_observations_to_db
+from epic_fhir import (
+    EpicFHIRClient, get_epic_auth_url, exchange_code_for_token, save_observations_to_db,
+    resolve_patient_ids, upsert_patients_to_db,
+    PATIENT_SUMMARY_ELEMENTS, OBSERVATION_SUMMARY_ELEMENTS, OBSERVATION_INGEST_ELEMENTS,
+    patient_summary, observation_summary, observation_for_ingest
+)
 from app.utils import get_db_connection
+from app.formats import respond
+import fhir_cache
+from demographics import PatientColumns
 
 # ===== AUTHENTICATION ROUTES =====
 @epic_bp.route('/epic/login', methods=['GET'])
@@ -63,34 +70,22 @@ def get_epic_patients():
             return jsonify({"error": "Not authenticated with Epic"}), 401
         
         client = EpicFHIRClient(access_token)
-        patients_response = client.search_patients(count=5)
+        patients_response = client.search_patients(count=5, elements=PATIENT_SUMMARY_ELEMENTS)
         
         if not patients_response:
             return jsonify({"error": "Failed to fetch patients"}), 500
         
-        patients_data = []
-        for entry in patients_response.get('entry', []):
-            resource = entry.get('resource', {})
-            name = resource.get('name', [{}])[0]
-            
-            patients_data.append({
-                'id': resource.get('id'),
-                'first_name': name.get('given', [''])[0],
-                'last_name': name.get('family', ''),
-                'dob': resource.get('birthDate'),
-                'gender': resource.get('gender'),
-                'avatar': f'https://ui-avatars.com/api/?name={name.get("given", [""])[0]}+{name.get("family", "")}'
-            })
-        
-        df = pd.DataFrame(patients_data)
+        patients_data = [
+            patient_summary(entry.get('resource', {}))
+            for entry in patients_response.get('entry', [])
+        ]
         
-        return jsonify({
+        return respond({
             "data": patients_data,
-            "table_html": df.to_html(classes='table table-striped'),
             "query": "Patient.search() from Epic FHIR",
             "description": "Fetching 5 patients from Epic test system with SMART authentication",
             "timestamp": datetime.now().isoformat()
-        }), 200
+        })
         
     except Exception as e:
         import traceback
@@ -106,31 +101,55 @@ def get_patient_obs(patient_id):
             return jsonify({"error": "Not authenticated"}), 401
         
         client = EpicFHIRClient(access_token)
-        obs_response = client.get_patient_observations(patient_id)
+        obs_response = client.get_patient_observations(patient_id, elements=OBSERVATION_SUMMARY_ELEMENTS)
         
         if not obs_response:
             return jsonify({"error": "No observations found"}), 404
         
-        observations = []
-        for entry in obs_response.get('entry', []):
-            resource = entry.get('resource', {})
-            observations.append({
-                'code': resource.get('code', {}).get('coding', [{}])[0].get('display', 'Unknown'),
-                'value': resource.get('valueQuantity', {}).get('value', 'N/A'),
-                'unit': resource.get('valueQuantity', {}).get('unit', ''),
-                'date': resource.get('effectiveDateTime', 'N/A')
-            })
+        observations = [
+            observation_summary(entry.get('resource', {}))
+            for entry in obs_response.get('entry', [])
+        ]
         
-        df = pd.DataFrame(observations)
-        
-        return jsonify({
+        return respond({
             "data": observations,
-            "table_html": df.to_html(classes='table table-striped'),
             "description": "Patient observations and lab results from Epic",
             "timestamp": datetime.now().isoformat()
+        }, empty_message="No observations found")
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@epic_bp.route('/epic/patients-with-labs', methods=['GET'])
+def get_epic_patients_with_labs():
+    """Fetch patients and their lab results together (one _revinclude search, not one call per patient)"""
+    try:
+        access_token = session.get('epic_token')
+        if not access_token:
+            return jsonify({"error": "Not authenticated with Epic"}), 401
+        
+        count = min(max(request.args.get('count', 5, type=int), 1), 100)
+        category = request.args.get('category', 'laboratory') or None
+        
+        client = EpicFHIRClient(access_token)
+        results = client.search_patients_with_observations(count=count, category=category)
+        
+        patients_data = []
+        for patient_resource, observation_resources in results:
+            patient = patient_summary(patient_resource)
+            patient['observations'] = [observation_summary(resource) for resource in observation_resources]
+            patients_data.append(patient)
+        
+        return jsonify({
+            "data": patients_data,
+            "query": "Patient?_revinclude=Observation:patient from Epic FHIR",
+            "description": f"{len(patients_data)} patients with their {category or 'all'} observations",
+            "timestamp": datetime.now().isoformat()
         }), 200
         
     except Exception as e:
+        import traceback
+        print(f"ERROR: {traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
 
 @epic_bp.route('/epic/save-observations/<patient_id>', methods=['POST'])
@@ -141,35 +160,41 @@ def save_observations(patient_id):
         if not access_token:
             return jsonify({"error": "Not authenticated"}), 401
         
-        client = EpicFHIRClient(access_token)
-        obs_response = client.get_patient_observations(patient_id)
+        # Ingest always reads fresh data from Epic, bypassing the response cache
+        client = EpicFHIRClient(access_token, use_cache=False)
+        # Follow every page of the search so no labs are dropped
+        resources = list(client.iter_patient_observations(patient_id, elements=OBSERVATION_INGEST_ELEMENTS))
         
-        if not obs_response or 'entry' not in obs_response:
+        if not resources:
             return jsonify({"error": "No observations found"}), 404
         
-        observations = []
-        for entry in obs_response.get('entry', []):
-            resource = entry.get('resource', {})
-            observations.append({
-                'code': resource.get('code', {}).get('coding', [{}])[0].get('display', 'Unknown'),
-                'value': resource.get('valueQuantity', {}).get('value', 'N/A'),
-                'unit': resource.get('valueQuantity', {}).get('unit', ''),
-                'date': resource.get('effectiveDateTime', None)
-            })
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT patient_id FROM patients LIMIT 1")
-        result = cursor.fetchone()
-        local_patient_id = result[0] if result else 1
-        
-        success = save_observations_to_db(conn, local_patient_id, patient_id, observations)
-        conn.close()
-        
-        if success:
+        observations = [observation_for_ingest(resource) for resource in resources]
+        
+        with get_db_connection() as conn:
+            local_patient_id = resolve_patient_ids(conn, [patient_id]).get(patient_id)
+            if local_patient_id is None:
+                # First sync for this patient: pull demographics from Epic and create the local row
+                patient_resource = client.get_patient_details(patient_id)
+                if not patient_resource:
+                    return jsonify({"error": "Could not fetch patient from Epic"}), 502
+                mapping = upsert_patients_to_db(conn, [patient_resource])
+                if not mapping or patient_id not in mapping:
+                    return jsonify({"error": "Failed to save patient"}), 500
+                local_patient_id = mapping[patient_id]
+
+            saved = save_observations_to_db(conn, local_patient_id, patient_id, observations)
+        
+        if saved:
             return jsonify({
                 "message": "Observations saved successfully",
-                "count": len(observations),
+                "patient_id": local_patient_id,
+                "count": saved['rows'],
+                "inserted": saved['inserted'],
+                "updated": saved['updated'],
+                "unchanged": saved['unchanged'],
+                "skipped": saved['skipped'],
+                "method": saved['method'],
+                "batches": saved['batches'],
                 "timestamp": datetime.now().isoformat()
             }), 200
         else:
@@ -178,6 +203,9 @@ def save_observations(patient_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Most patients one /epic/bulk-export request will pull from Epic
+MAX_BULK_EXPORT_COUNT = 1000
+
 @epic_bp.route('/epic/bulk-export', methods=['GET'])
 def epic_bulk_export():
     """Fetch all patients from Epic FHIR and return demographic data"""
@@ -186,64 +214,40 @@ def epic_bulk_export():
         if not access_token:
             return jsonify({"error": "Not authenticated with Epic"}), 401
         
+        count = min(max(request.args.get('count', 100, type=int), 1), MAX_BULK_EXPORT_COUNT)
+        
         client = EpicFHIRClient(access_token)
-        patients_response = client.search_patients(count=100)
+        patient_resources = client.iter_patients(
+            page_size=min(count, 100), max_resources=count, elements=PATIENT_SUMMARY_ELEMENTS
+        )
         
-        if not patients_response:
-            return jsonify({"error": "Failed to fetch patients"}), 500
+        # One pass into arrays, then vectorized ages and stats
+        patient_resources = list(patient_resources)
+        columns = PatientColumns.from_resources(patient_resources)
         
-        patients_data = []
-        gender_counts = {'male': 0, 'female': 0, 'other': 0}
+        patients_data = [patient_summary(resource) for resource in patient_resources]
+        for patient, age, gender in zip(patients_data, columns.age_list(), columns.genders()):
+            patient['age'] = age
+            patient['gender'] = gender
         
-        for entry in patients_response.get('entry', []):
-            resource = entry.get('resource', {})
-            name = resource.get('name', [{}])[0]
-            gender = resource.get('gender', 'unknown').lower()
-            dob = resource.get('birthDate')
-            
-            if dob:
-                from datetime import datetime as dt
-                birth_date = dt.strptime(dob, '%Y-%m-%d')
-                age = (dt.now() - birth_date).days // 365
-            else:
-                age = None
-            
-            patients_data.append({
-                'id': resource.get('id'),
-                'first_name': name.get('given', [''])[0],
-                'last_name': name.get('family', ''),
-                'dob': dob,
-                'age': age,
-                'gender': gender if gender in ['male', 'female'] else 'other',
-                'avatar': f'https://ui-avatars.com/api/?name={name.get("given", [""])[0]}+{name.get("family", "")}'
-            })
-            
-            if gender in ['male', 'female']:
-                gender_counts[gender] += 1
-            else:
-                gender_counts['other'] += 1
-        
-        df = pd.DataFrame(patients_data)
-        
-        stats = {
-            'total_patients': len(patients_data),
-            'gender_counts': gender_counts,
-            'average_age': float(df['age'].mean()) if 'age' in df.columns else None,
-            'age_range': {
-                'min': int(df['age'].min()) if 'age' in df.columns else None,
-                'max': int(df['age'].max()) if 'age' in df.columns else None
-            }
-        }
+        stats = columns.stats()
         
-        return jsonify({
+        return respond({
             "data": patients_data,
             "stats": stats,
-            "table_html": df.to_html(classes='table table-striped table-hover'),
             "timestamp": datetime.now().isoformat()
-        }), 200
+        }, table_class='table table-striped table-hover')
         
     except Exception as e:
         import traceback
         error_msg = traceback.format_exc()
         print(f"BULK EXPORT ERROR: {error_msg}")  # Prints to Docker logs
         return jsonify({"error": str(e), "traceback": error_msg}), 500
+
+@epic_bp.route('/fhir/cache-stats', methods=['GET'])
+def fhir_cache_stats():
+    """Hit/miss/revalidation counters for the FHIR response cache"""
+    return jsonify({
+        "data": fhir_cache.response_cache.stats(),
+        "timestamp": datetime.now().isoformat()
+    }), 200
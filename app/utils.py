@@ -1,13 +1,258 @@
 import psycopg2
 import os
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2 import extensions
 
-def get_db_connection():
-    """Get database connection"""
-    conn = psycopg2.connect(
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free within the checkout timeout"""
+
+
+def connect():
+    """Open a new (unpooled) database connection"""
+    return psycopg2.connect(
         host=os.getenv('DB_HOST', 'localhost'),
         user=os.getenv('DB_USER', 'admin'),
         password=os.getenv('DB_PASSWORD', 'healthpass123'),
         database=os.getenv('DB_NAME', 'patient_health_analytics'),
-        port=5432
+        port=int(os.getenv('DB_PORT', 5432))
     )
-    return conn
\ No newline at end of file
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections
+    Keeps between minconn and maxconn connections open, checks liveness on
+    checkout and recycles a connection after it has been used recycle_after times
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=10.0, recycle_after=1000, ping_after=30.0):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.recycle_after = recycle_after
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, returned_at)
+        self._uses = {}  # id(conn) -> checkout count
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'failed_pings': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+
+        for _ in range(minconn):
+            self._idle.append((self._create(), time.monotonic()))
+
+    def _create(self):
+        conn = connect()
+        self._uses[id(conn)] = 0
+        self._stats['created'] += 1
+        return conn
+
+    def _destroy(self, conn):
+        self._uses.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_alive(self, conn, idle_for):
+        """
+        Cheap liveness check; only pings the server after the connection sat idle
+        Returns (alive, pinged). Called without the pool lock held, since a ping is a round trip.
+        """
+        if conn.closed:
+            return False, False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False, False
+        if idle_for < self.ping_after:
+            return True, False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True, True
+        except Exception:
+            return False, True
+
+    def getconn(self):
+        """Check out a connection, waiting up to self.timeout seconds for one to free up"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout("Connection pool is closed")
+
+            while True:
+                if self._idle:
+                    # Claim an idle connection (and its slot), then check it with the lock released
+                    conn, returned_at = self._idle.pop()
+                    self._in_use += 1
+                    self._cond.release()
+                    try:
+                        alive, pinged = self._is_alive(conn, time.monotonic() - returned_at)
+                    finally:
+                        self._cond.acquire()
+                    if alive:
+                        break
+                    self._in_use -= 1
+                    self._destroy(conn)
+                    self._stats['discarded'] += 1
+                    if pinged:
+                        self._stats['failed_pings'] += 1
+                    self._cond.notify()
+                    continue
+
+                if self._in_use < self.maxconn:
+                    # Reserve the slot before connecting so other threads respect maxconn
+                    self._in_use += 1
+                    try:
+                        self._cond.release()
+                        try:
+                            conn = connect()
+                        finally:
+                            self._cond.acquire()
+                    except Exception:
+                        self._in_use -= 1
+                        self._cond.notify()
+                        raise
+                    self._uses[id(conn)] = 0
+                    self._stats['created'] += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s "
+                        f"({self._in_use}/{self.maxconn} in use)"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            self._uses[id(conn)] = self._uses.get(id(conn), 0) + 1
+            wait_ms = (time.monotonic() - started) * 1000
+            self._stats['checkouts'] += 1
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, resetting any open transaction"""
+        if not conn.closed and not discard:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if conn.closed or discard or self._closed:
+                self._destroy(conn)
+                self._stats['discarded'] += 1
+            elif self._uses.get(id(conn), 0) >= self.recycle_after:
+                self._destroy(conn)
+                self._stats['recycled'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and always returns it"""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except psycopg2.InterfaceError:
+            discard = True
+            raise
+        except psycopg2.OperationalError:
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self):
+        """Snapshot of pool usage counters"""
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'checkouts': checkouts,
+                'timeouts': self._stats['timeouts'],
+                'created': self._stats['created'],
+                'recycled': self._stats['recycled'],
+                'discarded': self._stats['discarded'],
+                'failed_pings': self._stats['failed_pings'],
+                'avg_wait_ms': round(self._stats['total_wait_ms'] / checkouts, 3) if checkouts else 0.0,
+                'max_wait_ms': round(self._stats['max_wait_ms'], 3),
+                'total_wait_ms': round(self._stats['total_wait_ms'], 3)
+            }
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts"""
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._destroy(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+
+# Process-wide pool, created lazily so forked workers each build their own
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get or create the process-wide connection pool"""
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(
+                    minconn=int(os.getenv('DB_POOL_MIN', 1)),
+                    maxconn=int(os.getenv('DB_POOL_MAX', 10)),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+                    recycle_after=int(os.getenv('DB_POOL_RECYCLE', 1000)),
+                    ping_after=float(os.getenv('DB_POOL_PING_AFTER', 30))
+                )
+    return _pool
+
+
+@contextmanager
+def get_db_connection():
+    """Get a pooled database connection (use as a context manager)"""
+    with get_pool().connection() as conn:
+        yield conn
+
+
+def get_pool_stats():
+    """Pool stats for the running process, or None if no pool was created yet"""
+    if _pool is None or _pool.pid != os.getpid():
+        return None
+    return _pool.stats()
@@ -0,0 +1,387 @@
+"""
+Micro-benchmarks for the FHIR and API hot paths
+Run all offline benchmarks:   python benchmarks.py
+Run specific ones:            python benchmarks.py projection
+Benchmarks marked (live) call Epic and need the Backend Services settings in .env
+"""
+
+import json
+import sys
+import time
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name, live=False):
+    """Register a benchmark function under name"""
+    def register(func):
+        BENCHMARKS[name] = (func, live)
+        return func
+    return register
+
+
+def timed(func, repeat=5):
+    """Best wall time of func() over repeat runs, in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def print_header(title):
+    print("\n" + "=" * 60)
+    print(title)
+    print("=" * 60)
+
+
+# ===== SYNTHETIC FHIR DATA =====
+def synthetic_patient(i):
+    """A Patient shaped like Epic's, with the identifiers/extensions the dashboards never read"""
+    birth = date(1940, 1, 1) + timedelta(days=(i * 7919) % 29000)
+    return {
+        'resourceType': 'Patient',
+        'id': f'e{i:010d}',
+        'meta': {'versionId': '1', 'lastUpdated': '2024-05-01T12:00:00Z'},
+        'extension': [
+            {'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race',
+             'extension': [{'url': 'ombCategory', 'valueCoding': {'system': 'urn:oid:2.16.840.1.113883.6.238',
+                                                                  'code': '2106-3', 'display': 'White'}},
+                           {'url': 'text', 'valueString': 'White'}]},
+            {'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex', 'valueCode': 'F'}
+        ],
+        'identifier': [
+            {'use': 'usual', 'type': {'text': 'EPI'}, 'system': 'urn:oid:1.2.840.114350.1.13.0.1.7.5.737384.14',
+             'value': f'E{i:07d}'},
+            {'use': 'usual', 'type': {'text': 'MRN'}, 'system': 'urn:oid:1.2.840.114350.1.13.0.1.7.5.737384.0',
+             'value': f'{200000 + i}'}
+        ],
+        'active': True,
+        'name': [{'use': 'official', 'text': f'Given{i} Family{i}', 'family': f'Family{i}', 'given': [f'Given{i}']}],
+        'telecom': [{'system': 'phone', 'value': '608-555-0100', 'use': 'home'},
+                    {'system': 'email', 'value': f'patient{i}@example.com', 'rank': 1}],
+        'gender': ('female', 'male', 'other', 'unknown')[i % 4],
+        'birthDate': birth.isoformat(),
+        'deceasedBoolean': False,
+        'address': [{'use': 'home', 'line': [f'{i} Main St'], 'city': 'Madison', 'district': 'DANE',
+                     'state': 'WI', 'postalCode': '53703', 'country': 'US',
+                     'period': {'start': '2010-01-01'}}],
+        'maritalStatus': {'text': 'Married'},
+        'communication': [{'language': {'coding': [{'system': 'urn:ietf:bcp:47', 'code': 'en',
+                                                    'display': 'English'}], 'text': 'English'},
+                           'preferred': True}],
+        'generalPractitioner': [{'reference': 'Practitioner/eM5CWtq15N0WJeuCet5bJlQ3',
+                                 'type': 'Practitioner', 'display': 'Physician Family Medicine, MD'}],
+        'managingOrganization': {'reference': 'Organization/enRyWnSP963FYDpoks4NHOA3',
+                                 'display': 'Epic Hospital System'}
+    }
+
+
+def synthetic_observation(i, patient_id):
+    """A laboratory Observation shaped like Epic's"""
+    return {
+        'resourceType': 'Observation',
+        'id': f'o{i:012d}',
+        'meta': {'lastUpdated': '2024-05-01T12:00:00Z'},
+        'basedOn': [{'reference': 'ServiceRequest/eH4mNLTxG4yAqRnhXNUqXbw3', 'type': 'ServiceRequest'}],
+        'status': 'final',
+        'category': [{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/observation-category',
+                                  'code': 'laboratory', 'display': 'Laboratory'}], 'text': 'Laboratory'}],
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '2345-7',
+                             'display': 'Glucose [Mass/volume] in Serum or Plasma'}],
+                 'text': 'Glucose'},
+        'subject': {'reference': f'Patient/{patient_id}', 'display': 'Patient'},
+        'encounter': {'reference': 'Encounter/eoK8nLRcEypNjtns4cGgcJw3', 'display': 'Office Visit'},
+        'effectiveDateTime': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}T09:30:00Z',
+        'issued': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}T14:00:00Z',
+        'performer': [{'reference': 'Organization/enRyWnSP963FYDpoks4NHOA3', 'display': 'Epic Lab'}],
+        'valueQuantity': {'value': 70 + i % 80, 'unit': 'mg/dL', 'system': 'http://unitsofmeasure.org',
+                          'code': 'mg/dL'},
+        'interpretation': [{'coding': [{'system': 'urn:oid:1.2.840.114350.1.13.0.1.7.4.698084.30',
+                                        'code': 'N', 'display': 'Normal'}], 'text': 'Normal'}],
+        'note': [{'text': 'Fasting specimen.'}],
+        'referenceRange': [{'low': {'value': 70, 'unit': 'mg/dL'}, 'high': {'value': 99, 'unit': 'mg/dL'},
+                            'text': '70 - 99 mg/dL'}]
+    }
+
+
+def project(resource, elements):
+    """What the server returns for _elements: the requested fields plus the mandatory ones"""
+    keep = {'resourceType', 'id', 'meta', *elements}
+    return {key: value for key, value in resource.items() if key in keep}
+
+
+def as_bundle(resources):
+    return {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'total': len(resources),
+        'entry': [{'fullUrl': f"https://fhir.example/{r['resourceType']}/{r['id']}", 'resource': r,
+                   'search': {'mode': 'match'}} for r in resources]
+    }
+
+
+# ===== BENCHMARKS =====
+@benchmark('projection')
+def bench_projection(count=1000):
+    """Bytes and json decode time of full vs _elements-projected search Bundles"""
+    from epic_fhir import (PATIENT_SUMMARY_ELEMENTS, OBSERVATION_SUMMARY_ELEMENTS,
+                           patient_summary, observation_summary)
+
+    print_header(f"FIELD PROJECTION (_elements), {count} resources per Bundle")
+    cases = [
+        ('Patient', [synthetic_patient(i) for i in range(count)], PATIENT_SUMMARY_ELEMENTS, patient_summary),
+        ('Observation', [synthetic_observation(i, 'e1') for i in range(count)],
+         OBSERVATION_SUMMARY_ELEMENTS, observation_summary),
+    ]
+    for resource_type, resources, elements, parser in cases:
+        full = json.dumps(as_bundle(resources)).encode('utf-8')
+        trimmed = json.dumps(as_bundle([project(r, elements) for r in resources])).encode('utf-8')
+
+        full_ms = timed(lambda: [parser(e['resource']) for e in json.loads(full)['entry']])
+        trimmed_ms = timed(lambda: [parser(e['resource']) for e in json.loads(trimmed)['entry']])
+
+        print(f"{resource_type:<12} full:    {len(full):>10,} bytes  decode+parse {full_ms:8.2f} ms")
+        print(f"{resource_type:<12} trimmed: {len(trimmed):>10,} bytes  decode+parse {trimmed_ms:8.2f} ms"
+              f"  ({len(trimmed) / len(full):.0%} of bytes, {full_ms / trimmed_ms:.1f}x faster)")
+
+
+@benchmark('projection-live', live=True)
+def bench_projection_live(count=50):
+    """Same comparison against the configured Epic server (Backend Services token)"""
+    from epic_backend_auth import EpicBackendAuth
+    from epic_fhir import PATIENT_SUMMARY_ELEMENTS
+    import fhir_http
+
+    auth = EpicBackendAuth()
+    print_header(f"FIELD PROJECTION (_elements) against {auth.fhir_url}")
+    headers = {'Authorization': f'Bearer {auth.get_access_token()}', 'Accept': 'application/fhir+json'}
+    url = f"{auth.fhir_url}/Patient"
+
+    for label, params in [('full', {'_count': count}),
+                          ('trimmed', {'_count': count, '_elements': ','.join(PATIENT_SUMMARY_ELEMENTS)})]:
+        started = time.perf_counter()
+        response = fhir_http.get(url, headers=headers, params=params)
+        fetch_ms = (time.perf_counter() - started) * 1000
+        response.raise_for_status()
+        decode_ms = timed(lambda: json.loads(response.content))
+        print(f"{label:<8} {len(response.content):>10,} bytes  fetch {fetch_ms:8.1f} ms  decode {decode_ms:6.2f} ms")
+
+
+@benchmark('jwt-assertion')
+def bench_jwt_assertion(repeat=50):
+    """Client assertion creation: re-parsing the PEM every time vs the cached key"""
+    import os
+    import tempfile
+    import jwt
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from epic_backend_auth import EpicBackendAuth
+
+    print_header(f"JWT CLIENT ASSERTION (RS384, 4096-bit key), best of {repeat}")
+    key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+
+    with tempfile.NamedTemporaryFile(suffix='.pem', delete=False) as f:
+        f.write(pem)
+    saved_pem = os.environ.pop('PRIVATE_KEY_PEM', None)
+    try:
+        auth = EpicBackendAuth(background_refresh=False)
+        auth.private_key_path = f.name
+        auth.client_id = 'benchmark-client'
+        auth.token_url = 'https://fhir.example/oauth2/token'
+        claims = {'iss': auth.client_id, 'sub': auth.client_id, 'aud': auth.token_url,
+                  'jti': 'benchmark', 'exp': int(time.time()) + 300, 'iat': int(time.time())}
+
+        def uncached():
+            # What every token request used to do: parse the PEM, then jwt.encode()
+            private_key = serialization.load_pem_private_key(pem, password=None)
+            jwt.encode(claims, private_key, algorithm='RS384', headers={'kid': 'epic-backend-key'})
+
+        auth.create_jwt_assertion()  # first load parses the key once
+        results = [
+            ('parse + jwt.encode', timed(uncached, repeat)),
+            ('cached key + jwt.encode',
+             timed(lambda: jwt.encode(claims, auth.load_private_key(), algorithm='RS384',
+                                      headers={'kid': 'epic-backend-key'}), repeat)),
+            ('create_jwt_assertion()', timed(auth.create_jwt_assertion, repeat)),
+        ]
+        baseline = results[0][1]
+        for label, ms in results:
+            print(f"{label:<26} {ms:8.3f} ms  ({baseline / ms:5.1f}x)")
+
+        assertion = auth.create_jwt_assertion()
+        jwt.decode(assertion, key.public_key(), algorithms=['RS384'], audience=auth.token_url)
+    finally:
+        os.remove(f.name)
+        if saved_pem is not None:
+            os.environ['PRIVATE_KEY_PEM'] = saved_pem
+
+
+@benchmark('demographics')
+def bench_demographics(counts=(100000, 500000)):
+    """Bulk-export demographics: per-patient strptime/dict loop + DataFrame vs PatientColumns"""
+    from datetime import datetime as dt
+    import pandas as pd
+    from demographics import PatientColumns
+    from epic_fhir import PATIENT_SUMMARY_ELEMENTS
+
+    def row_by_row(resources):
+        # What the bulk-export routes used to do
+        rows = []
+        gender_counts = {'male': 0, 'female': 0, 'other': 0}
+        for resource in resources:
+            gender = (resource.get('gender') or 'unknown').lower()
+            dob = resource.get('birthDate')
+            age = (dt.now() - dt.strptime(dob, '%Y-%m-%d')).days // 365 if dob else None
+            rows.append({'age': age, 'gender': gender if gender in ['male', 'female'] else 'other'})
+            if gender in ['male', 'female']:
+                gender_counts[gender] += 1
+            else:
+                gender_counts['other'] += 1
+        df = pd.DataFrame(rows)
+        return {'gender_counts': gender_counts, 'average_age': float(df['age'].mean()),
+                'age_range': {'min': int(df['age'].min()), 'max': int(df['age'].max())}}
+
+    def vectorized(resources):
+        columns = PatientColumns.from_resources(resources)
+        columns.age_list()
+        columns.genders()
+        return columns.stats()
+
+    print_header("PATIENT DEMOGRAPHICS (ages, gender counts, histogram, quantiles)")
+    for count in counts:
+        resources = [project(synthetic_patient(i), PATIENT_SUMMARY_ELEMENTS) for i in range(count)]
+        loop_ms = timed(lambda: row_by_row(resources), repeat=3)
+        vector_ms = timed(lambda: vectorized(resources), repeat=3)
+        assert row_by_row(resources)['gender_counts'] == vectorized(resources)['gender_counts']
+        print(f"{count:>8,} patients  row by row {loop_ms:9.1f} ms ({count / loop_ms * 1000:>11,.0f}/s)  "
+              f"vectorized {vector_ms:8.1f} ms ({count / vector_ms * 1000:>11,.0f}/s)  "
+              f"{loop_ms / vector_ms:.1f}x")
+
+
+@benchmark('response-formats')
+def bench_response_formats(counts=(1000, 10000)):
+    """Bulk-export response: JSON + DataFrame.to_html (old) vs JSON rows only, and each ?format="""
+    import os
+    import pandas as pd
+    from flask import Flask, jsonify
+    from app.formats import respond
+    from demographics import PatientColumns
+    from epic_fhir import PATIENT_SUMMARY_ELEMENTS, patient_summary
+
+    app = Flask(__name__, template_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+
+    def render(make_response, fmt):
+        with app.test_request_context(f'/?format={fmt}'):
+            response = make_response()
+            if isinstance(response, tuple):
+                response = response[0]
+            return response.get_data()
+
+    print_header("BULK-EXPORT RESPONSE FORMATS")
+    for count in counts:
+        resources = [project(synthetic_patient(i), PATIENT_SUMMARY_ELEMENTS) for i in range(count)]
+        columns = PatientColumns.from_resources(resources)
+        rows = [patient_summary(resource) for resource in resources]
+        for row, age, gender in zip(rows, columns.age_list(), columns.genders()):
+            row['age'], row['gender'] = age, gender
+        payload = {'status': 'success', 'data': rows, 'stats': columns.stats()}
+
+        def with_table_html():
+            # What every request used to build, whether or not the page showed the table
+            df = pd.DataFrame(rows)
+            return jsonify({**payload, 'table_html': df.to_html(classes='table table-striped table-hover')})
+
+        cases = [('json + table_html (old)', with_table_html, 'json')] + [
+            (f'format={fmt}', lambda: respond(payload), fmt) for fmt in ('json', 'html', 'csv', 'ndjson')
+        ]
+        print(f"{count:,} patients")
+        baseline_bytes = baseline_ms = None
+        for label, make_response, fmt in cases:
+            body = render(make_response, fmt)
+            ms = timed(lambda: render(make_response, fmt), repeat=3)
+            baseline_bytes, baseline_ms = baseline_bytes or len(body), baseline_ms or ms
+            print(f"  {label:<24} {len(body):>11,} bytes ({len(body) / baseline_bytes:4.0%})  "
+                  f"{ms:8.1f} ms ({baseline_ms / ms:4.1f}x)")
+
+
+@benchmark('json-serialization')
+def bench_json_serialization(patients=10000):
+    """Per-endpoint jsonify(): stdlib provider + dict per row (old) vs orjson records and columns"""
+    from datetime import datetime
+    from decimal import Decimal
+    from flask import Flask
+    from app.formats import shaped_rows
+    from app.json_provider import FastJSONProvider, orjson
+
+    stdlib_app = Flask(__name__)
+    fast_app = Flask(__name__)
+    fast_app.json = FastJSONProvider(fast_app)
+
+    # endpoint -> (response keys, database rows, the old per-row dict with its str() conversions)
+    endpoints = {
+        '/api/patients': (
+            ('id', 'first_name', 'last_name', 'date_of_birth', 'email'),
+            [(i, f'Given{i}', f'Family{i}', date(1940, 1, 1) + timedelta(days=i % 29000), f'patient{i}@example.com')
+             for i in range(patients)],
+            lambda p: {"id": p[0], "first_name": p[1], "last_name": p[2], "date_of_birth": str(p[3]),
+                       "email": p[4]}),
+        '/api/analytics/patient-conditions': (
+            ('condition', 'patient_count'),
+            [(f'Condition {i}', 1000 - i) for i in range(200)],
+            lambda r: {"condition": r[0], "patient_count": r[1]}),
+        '/api/saved-epic-observations': (
+            ('id', 'test_name', 'value', 'unit', 'date', 'patient_name', 'fhir_id'),
+            [(i, 'Glucose', str(70 + i % 80), 'mg/dL', datetime(2024, 1 + i % 12, 1 + i % 28, 9, 30),
+              f'Given{i} Family{i}', f'e{i:010d}') for i in range(50)],
+            lambda r: {"id": r[0], "test_name": r[1], "value": r[2], "unit": r[3],
+                       "date": str(r[4]) if r[4] else None, "patient_name": r[5], "fhir_id": r[6]}),
+        'Decimal aggregates (AVG/MIN/MAX)': (
+            ('test_name', 'average', 'minimum', 'maximum'),
+            [(f'Test {i}', Decimal('101.25') + i, Decimal('70.0'), Decimal('199.5')) for i in range(patients)],
+            lambda r: {"test_name": r[0], "average": float(r[1]), "minimum": float(r[2]), "maximum": float(r[3])}),
+    }
+
+    def render(app, make_data, shape=''):
+        with app.test_request_context(f'/?shape={shape}'):
+            return app.json.response({"data": make_data()}).get_data()
+
+    print_header(f"JSON SERIALIZATION PER ENDPOINT ({'orjson' if orjson else 'stdlib fallback'})")
+    for endpoint, (columns, rows, old_row) in endpoints.items():
+        cases = [
+            ('stdlib, dict per row (old)', stdlib_app, lambda: [old_row(r) for r in rows], ''),
+            ('fast provider, records', fast_app, lambda: shaped_rows(columns, rows), ''),
+            ('fast provider, columns', fast_app, lambda: shaped_rows(columns, rows), 'columns'),
+        ]
+        print(f"{endpoint} ({len(rows):,} rows)")
+        baseline = None
+        for label, app, make_data, shape in cases:
+            body = render(app, make_data, shape)
+            ms = timed(lambda: render(app, make_data, shape))
+            baseline = baseline or ms
+            print(f"  {label:<28} {len(body):>10,} bytes  {ms:8.2f} ms ({baseline / ms:5.1f}x)")
+
+
+def main(names):
+    selected = names or [name for name, (_, live) in BENCHMARKS.items() if not live]
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+            return 1
+        BENCHMARKS[name][0]()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
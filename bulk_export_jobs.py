@@ -0,0 +1,378 @@
+"""
+Server-side manager for FHIR bulk data ($export) jobs
+Jobs are rows in bulk_export_jobs (sql/07_bulk_export_jobs.sql), so they survive restarts.
+One background poller per process claims due jobs with FOR UPDATE SKIP LOCKED, so jobs are
+never polled twice even with several workers; it honours Retry-After and backs off on errors.
+When a job completes, its download is handed to a worker pool so the poller keeps polling, and
+the manifest output files are downloaded in parallel. A running download keeps renewing its
+claim, and every write it makes to the job checks that the claim is still its own.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+
+POLL_IDLE = float(os.getenv('BULK_EXPORT_POLL_IDLE', 5))  # seconds between looks for due jobs
+POLL_DEFAULT = float(os.getenv('BULK_EXPORT_POLL_DEFAULT', 10))  # when the server sends no Retry-After
+POLL_MAX = float(os.getenv('BULK_EXPORT_POLL_MAX', 300))
+MAX_ATTEMPTS = int(os.getenv('BULK_EXPORT_MAX_ATTEMPTS', 8))
+DOWNLOAD_WORKERS = int(os.getenv('BULK_EXPORT_DOWNLOAD_WORKERS', 4))  # files downloaded at once
+DOWNLOAD_JOBS = int(os.getenv('BULK_EXPORT_DOWNLOAD_JOBS', 2))  # completed jobs downloading at once
+# A claimed job becomes due again after this long without a renewal, in case its worker died mid-way
+CLAIM_LEASE = float(os.getenv('BULK_EXPORT_CLAIM_LEASE', 900))
+# A running download renews its claim at most this often
+CLAIM_RENEW = CLAIM_LEASE / 3
+
+JOB_COLUMNS = (
+    'job_id', 'kickoff', 'resource_types', 'params', 'status_url', 'status', 'attempts',
+    'next_poll_at', 'progress', 'manifest', 'transaction_time', 'output_files', 'error',
+    'created_at', 'updated_at', 'completed_at'
+)
+JOB_SELECT = f"SELECT {', '.join(JOB_COLUMNS)} FROM bulk_export_jobs"
+
+
+def _job_dict(row):
+    return {
+        column: value.isoformat() if isinstance(value, datetime) else value
+        for column, value in zip(JOB_COLUMNS, row)
+    }
+
+
+def export_resource_types(params):
+    """Resource types a kickoff asked for, as keyed in bulk_export_watermarks ('*' for all)"""
+    types = [t.strip() for t in (params.get('_type') or '').split(',') if t.strip()]
+    return sorted(types) or ['*']
+
+
+def load_watermark(cursor, kickoff, resource_types):
+    """
+    The _since to use for an export: the oldest watermark among resource_types,
+    or None (full export) if any of them has never been ingested
+    """
+    cursor.execute("""
+        SELECT resource_type, transaction_time FROM bulk_export_watermarks
+        WHERE kickoff = %s AND resource_type = ANY(%s)
+    """, (kickoff, list(resource_types)))
+    watermarks = dict(cursor.fetchall())
+    if any(resource_type not in watermarks for resource_type in resource_types):
+        return None
+    return min(watermarks.values())
+
+
+def advance_watermarks(cursor, job_id):
+    """Move the watermarks of a job's resource types up to its transactionTime (never backwards)"""
+    cursor.execute("""
+        INSERT INTO bulk_export_watermarks (kickoff, resource_type, transaction_time, job_id)
+        SELECT kickoff, btrim(resource_type), transaction_time, job_id
+        FROM bulk_export_jobs,
+             unnest(string_to_array(COALESCE(NULLIF(resource_types, ''), '*'), ',')) AS resource_type
+        WHERE job_id = %s AND transaction_time IS NOT NULL
+        ON CONFLICT (kickoff, resource_type) DO UPDATE SET
+            transaction_time = EXCLUDED.transaction_time,
+            job_id = EXCLUDED.job_id,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE EXCLUDED.transaction_time > bulk_export_watermarks.transaction_time
+    """, (job_id,))
+    return cursor.rowcount
+
+
+class ClaimLost(Exception):
+    """The job was claimed by another worker after our lease ran out; leave it to them"""
+
+
+class _Claim:
+    """One worker's claim on a job, identified by the claim_token written when it was claimed"""
+
+    def __init__(self, manager, job_id, token):
+        self.manager = manager
+        self.job_id = job_id
+        self.token = token
+        self._renewed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def renew(self, force=False):
+        """
+        Push next_poll_at CLAIM_LEASE ahead again; throttled to every CLAIM_RENEW seconds unless force
+        Raises ClaimLost if the job is no longer ours, so the caller stops before touching its files.
+        """
+        with self._lock:
+            if not force and time.monotonic() - self._renewed < CLAIM_RENEW:
+                return
+            if not self.manager._update(self.job_id, claim=self, next_poll_at=_at(CLAIM_LEASE)):
+                raise ClaimLost(f"Bulk export job {self.job_id} was claimed by another worker")
+            self._renewed = time.monotonic()
+
+
+def _retryable(result):
+    """Transient status-check failures: network errors, 429 and 5xx"""
+    http_status = result.get('http_status')
+    return http_status is None or http_status == 429 or http_status >= 500
+
+
+class BulkExportJobManager:
+    """
+    Kicks off exports, persists them and polls them from one background thread
+    bulk is an EpicBulkExport; connection_factory is a context manager yielding a
+    database connection, e.g. app.utils.get_db_connection.
+    """
+
+    def __init__(self, bulk, connection_factory, download_workers=DOWNLOAD_WORKERS, spool_dir=None,
+                 on_complete=None):
+        self.bulk = bulk
+        self.connection_factory = connection_factory
+        self.download_workers = download_workers
+        self.spool_dir = spool_dir
+        # Called with the job_id once a job's files are downloaded, e.g. to start ingest
+        self.on_complete = on_complete
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Created by start() in the process that polls; jobs whose download runs in this process
+        self._job_pool = None
+        self._file_pool = None
+        self._downloading = set()
+
+    # ===== JOBS =====
+    def submit(self, kickoff='Patient', params=None, incremental=True):
+        """
+        Start an export on Epic and record it; the poller takes it from there
+        With incremental, _since is set from the watermark of the last ingested export,
+        so only resources changed since then are exported.
+        """
+        params = dict(params or {})
+        resource_types = export_resource_types(params)
+
+        if incremental and '_since' not in params:
+            with self.connection_factory() as conn:
+                cursor = conn.cursor()
+                since = load_watermark(cursor, kickoff, resource_types)
+                cursor.close()
+            if since is not None:
+                params['_since'] = since.isoformat()
+                print(f"Incremental export of {kickoff} {','.join(resource_types)} since {params['_since']}")
+
+        status_url = self.bulk.initiate_export(kickoff, params)
+
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                INSERT INTO bulk_export_jobs (kickoff, resource_types, params, status_url)
+                VALUES (%s, %s, %s::jsonb, %s)
+                ON CONFLICT (status_url) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+                RETURNING {', '.join(JOB_COLUMNS)}
+            """, (kickoff, ','.join(resource_types) if params.get('_type') else None,
+                  json.dumps(params), status_url))
+            job = _job_dict(cursor.fetchone())
+            conn.commit()
+            cursor.close()
+
+        self.start()
+        self._wake.set()
+        return job
+
+    def get_job(self, job_id):
+        return self._fetch_one(f"{JOB_SELECT} WHERE job_id = %s", (job_id,))
+
+    def find_job(self, status_url):
+        return self._fetch_one(f"{JOB_SELECT} WHERE status_url = %s", (status_url,))
+
+    def list_jobs(self, limit=50):
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"{JOB_SELECT} ORDER BY job_id DESC LIMIT %s", (limit,))
+            jobs = [_job_dict(row) for row in cursor.fetchall()]
+            cursor.close()
+        return jobs
+
+    def _fetch_one(self, query, params):
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            cursor.close()
+        return _job_dict(row) if row else None
+
+    def _update(self, job_id, claim=None, **fields):
+        """Set fields on a job; with a claim, only while it is still ours. Returns whether a row changed"""
+        json_fields = {'manifest', 'output_files'}
+        assignments = ', '.join(
+            f"{column} = %s::jsonb" if column in json_fields else f"{column} = %s" for column in fields
+        )
+        values = [json.dumps(value) if column in json_fields else value for column, value in fields.items()]
+        where, params = "job_id = %s", [job_id]
+        if claim is not None:
+            where, params = "job_id = %s AND claim_token = %s", [job_id, claim.token]
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE bulk_export_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE {where}",
+                values + params
+            )
+            updated = cursor.rowcount
+            conn.commit()
+            cursor.close()
+        return updated > 0
+
+    def _schedule(self, claim, delay, **fields):
+        return self._update(claim.job_id, claim=claim, next_poll_at=_at(delay), **fields)
+
+    # ===== POLLER =====
+    def start(self):
+        """
+        Start the background poller for this process (no-op if it is already running)
+        Cheap enough to call on every request, so each forked worker starts its own on first use.
+        """
+        if self._running():
+            return
+        with self._lock:
+            if self._running():
+                return
+            if self._pid != os.getpid():
+                # Threads do not survive a fork; a copied pool would never run its work
+                self._job_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_JOBS,
+                                                    thread_name_prefix='bulk-export-job')
+                self._file_pool = ThreadPoolExecutor(max_workers=self.download_workers,
+                                                     thread_name_prefix='bulk-export-download')
+                self._downloading = set()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='bulk-export-poller', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _running(self):
+        return self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = POLL_IDLE
+            try:
+                claimed = self.poll_due_jobs()
+            except Exception as e:
+                # Usually the database is unreachable; don't spin on it
+                print(f"Bulk export poller error: {e}")
+                claimed, wait = 0, POLL_MAX
+            if not claimed:
+                self._wake.wait(wait)
+                self._wake.clear()
+
+    def poll_due_jobs(self, limit=10):
+        """
+        Claim jobs whose next_poll_at has passed and advance each one; returns how many
+        Status checks run here; downloads are handed to the download pool.
+        """
+        token = str(uuid.uuid4())
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE bulk_export_jobs
+                SET next_poll_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    claim_token = %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE job_id IN (
+                    SELECT job_id FROM bulk_export_jobs
+                    WHERE status IN ('in-progress', 'downloading')
+                      AND next_poll_at <= CURRENT_TIMESTAMP
+                    ORDER BY next_poll_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING job_id, status, status_url, attempts, manifest
+            """, (CLAIM_LEASE, token, limit))
+            claimed = cursor.fetchall()
+            conn.commit()
+            cursor.close()
+
+        for job_id, status, status_url, attempts, manifest in claimed:
+            claim = _Claim(self, job_id, token)
+            try:
+                if status == 'downloading':
+                    # Picked up again after a failed or interrupted download; .part files resume
+                    self._start_download(claim, manifest, attempts)
+                else:
+                    self._poll(claim, status_url, attempts)
+            except Exception as e:
+                print(f"Bulk export job {job_id} failed: {e}")
+                self._fail_or_retry(claim, attempts, str(e), retryable=True)
+        return len(claimed)
+
+    def _poll(self, claim, status_url, attempts):
+        result = self.bulk.check_export_status(status_url)
+
+        if result['status'] == 'in-progress':
+            delay = result.get('retry_after_seconds')
+            self._schedule(claim, POLL_DEFAULT if delay is None else delay,
+                           progress=result.get('progress'), attempts=0)
+        elif result['status'] == 'complete':
+            manifest = result['data']
+            if self._update(claim.job_id, claim=claim, status='downloading', manifest=manifest, attempts=0,
+                            transaction_time=manifest.get('transactionTime'), progress=None):
+                self._start_download(claim, manifest, 0)
+        else:
+            self._fail_or_retry(claim, attempts, result.get('message'), _retryable(result),
+                                result.get('retry_after_seconds'))
+
+    def _start_download(self, claim, manifest, attempts):
+        """Queue a job's download on the download pool, unless this process is already running it"""
+        with self._lock:
+            if claim.job_id in self._downloading:
+                return
+            self._downloading.add(claim.job_id)
+        self._job_pool.submit(self._download_outputs, claim, manifest, attempts)
+
+    def _download_outputs(self, claim, manifest, attempts):
+        outputs = (manifest or {}).get('output', [])
+
+        def download(output):
+            path = self.bulk.download_export_file(output['url'], spool_dir=self.spool_dir,
+                                                  resource_type=output.get('type'), heartbeat=claim.renew)
+            return {'type': output.get('type'), 'url': output['url'], 'path': path,
+                    'bytes': os.path.getsize(path)}
+
+        try:
+            futures = [self._file_pool.submit(download, output) for output in outputs]
+            # Let every file finish before giving the job up, so a retry never writes a .part still in use
+            wait(futures)
+            files = [future.result() for future in futures]
+            completed = self._update(claim.job_id, claim=claim, status='complete', output_files=files,
+                                     attempts=0, error=None, claim_token=None,
+                                     completed_at=datetime.now().astimezone())
+        except Exception as e:
+            self._fail_or_retry(claim, attempts, f"Download failed: {e}", retryable=True)
+            return
+        finally:
+            with self._lock:
+                self._downloading.discard(claim.job_id)
+
+        if not completed:
+            print(f"Bulk export job {claim.job_id} was claimed by another worker; leaving it to them")
+            return
+        print(f"✓ Bulk export job {claim.job_id} complete: {len(files)} files")
+        if self.on_complete:
+            self.on_complete(claim.job_id)
+
+    def _fail_or_retry(self, claim, attempts, message, retryable, delay=None):
+        attempts += 1
+        if retryable and attempts < MAX_ATTEMPTS:
+            if delay is None:
+                delay = min(POLL_DEFAULT * (2 ** attempts), POLL_MAX)
+            updated = self._schedule(claim, delay, attempts=attempts, error=message)
+        else:
+            updated = self._update(claim.job_id, claim=claim, status='error', attempts=attempts, error=message)
+        if not updated:
+            print(f"Bulk export job {claim.job_id} was claimed by another worker; not recording: {message}")
+
+
+def _at(delay):
+    """Timestamp `delay` seconds from now, for next_poll_at"""
+    return datetime.now().astimezone() + timedelta(seconds=max(delay, 0))
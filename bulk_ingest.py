@@ -0,0 +1,335 @@
+"""
+Load bulk-export ndjson output into patients and patient_observations
+Files are fanned out to a process pool. Each worker parses its file line by line, flattens
+resources into column tuples, COPYs them into a staging table in batches and merges each
+batch with one set-based upsert. Finished files are checkpointed in bulk_ingest_checkpoints
+(sql/08_bulk_ingest_checkpoints.sql), so a crashed run resumes with the files it had not finished.
+Observations whose patient is not loaded are not stored; their file is loaded again on the next
+run and the job's _since watermark stays where it is until none are left, or until the file has
+been tried ORPHAN_RETRIES times, after which the rest are logged as orphans and dropped.
+A job is ingested by one run at a time, guarded by a Postgres advisory lock on its job_id.
+
+Run for a completed export job:  python bulk_ingest.py <job_id>
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.utils import connect
+from bulk_export_jobs import advance_watermarks
+from epic_backend_auth import iter_ndjson
+from epic_fhir import (
+    OBSERVATION_COLUMNS, ensure_partitions, OBSERVATION_MOVED_DELETE_SQL, OBSERVATION_STAGE_DDL, OBSERVATION_UPSERT_CLAUSE,
+    PATIENT_COLUMN_WIDTHS, PATIENT_COLUMNS, PATIENT_UPSERT_CLAUSE,
+    copy_rows, observation_for_ingest, subject_patient_id, _observation_row, _patient_row
+)
+
+
+INGEST_WORKERS = int(os.getenv('BULK_INGEST_WORKERS', max(1, min(4, os.cpu_count() or 1))))
+INGEST_BATCH_SIZE = int(os.getenv('BULK_INGEST_BATCH_SIZE', 20000))
+# Ingest is started from a web process that runs poller, download and HTTP pool threads;
+# forking it could copy a lock some other thread holds, so workers start from a fresh interpreter
+START_METHOD = os.getenv('BULK_INGEST_START_METHOD', 'spawn')
+# Runs that re-load a file for observations of unknown patients before they are given up as orphans
+ORPHAN_RETRIES = int(os.getenv('BULK_INGEST_ORPHAN_RETRIES', 3))
+# First key of the advisory lock held while a job is ingested; the second is the job_id
+INGEST_LOCK_CLASS = 8
+
+# Same widths as patients; _patient_row has already cut values to fit and kept only full birth dates
+PATIENT_STAGE_DDL = f"""
+CREATE TEMP TABLE IF NOT EXISTS bulk_patients_stage (
+    fhir_patient_id VARCHAR(255),
+    first_name VARCHAR({PATIENT_COLUMN_WIDTHS['first_name']}),
+    last_name VARCHAR({PATIENT_COLUMN_WIDTHS['last_name']}),
+    date_of_birth DATE,
+    email VARCHAR({PATIENT_COLUMN_WIDTHS['email']}),
+    phone VARCHAR({PATIENT_COLUMN_WIDTHS['phone']})
+) ON COMMIT DROP
+"""
+
+PATIENT_MERGE_SQL = f"""
+INSERT INTO patients ({', '.join(PATIENT_COLUMNS)})
+SELECT {', '.join(PATIENT_COLUMNS)} FROM bulk_patients_stage
+""" + PATIENT_UPSERT_CLAUSE
+
+
+class IngestRunning(Exception):
+    """Another run is already ingesting this job"""
+
+# patient_id is filled in by the merge, from the patients row with the same FHIR id
+OBSERVATION_STAGE_COLUMNS = OBSERVATION_COLUMNS[1:]
+STAGE_DATE_INDEX = OBSERVATION_STAGE_COLUMNS.index('observation_date')
+
+OBSERVATION_MERGE_SQL = f"""
+INSERT INTO patient_observations ({', '.join(OBSERVATION_COLUMNS)})
+SELECT DISTINCT ON (s.fhir_observation_id, s.observation_date)
+       p.patient_id, {', '.join(f's.{column}' for column in OBSERVATION_STAGE_COLUMNS)}
+FROM patient_observations_stage s
+JOIN patients p ON p.fhir_patient_id = s.fhir_patient_id
+ORDER BY s.fhir_observation_id, s.observation_date
+""" + OBSERVATION_UPSERT_CLAUSE
+
+# Only observations the merge will insert again may have their old, differently dated row removed
+OBSERVATION_MOVED_SQL = OBSERVATION_MOVED_DELETE_SQL.format(
+    source="patient_observations_stage s JOIN patients p ON p.fhir_patient_id = s.fhir_patient_id"
+)
+
+
+def _load_patients(conn, resources):
+    rows = {}
+    for resource in resources:
+        if resource.get('id'):
+            rows[resource['id']] = _patient_row(resource)
+
+    cursor = conn.cursor()
+    cursor.execute(PATIENT_STAGE_DDL)
+    copy_rows(cursor, 'bulk_patients_stage', PATIENT_COLUMNS, rows.values())
+    cursor.execute(PATIENT_MERGE_SQL)
+    written = len(cursor.fetchall())
+    conn.commit()
+    cursor.close()
+    return {'written': written, 'unchanged': len(rows) - written, 'skipped': len(resources) - len(rows)}
+
+
+def _load_observations(conn, resources):
+    rows = {}
+    for resource in resources:
+        obs = observation_for_ingest(resource)
+        fhir_patient_id = subject_patient_id(resource)
+        row = _observation_row(None, fhir_patient_id, obs)[1:]
+        # The table is partitioned on observation_date, so undated observations cannot be stored
+        if obs.get('id') and row[STAGE_DATE_INDEX] and fhir_patient_id:
+            rows[obs['id']] = row
+
+    try:
+        ensure_partitions(row[STAGE_DATE_INDEX] for row in rows.values())
+    except Exception as e:
+        print(f"Could not create observation partitions: {e}")
+    cursor = conn.cursor()
+    cursor.execute(OBSERVATION_STAGE_DDL)
+    copy_rows(cursor, 'patient_observations_stage', OBSERVATION_STAGE_COLUMNS, rows.values())
+    cursor.execute("""
+        SELECT COUNT(*) FROM patient_observations_stage s
+        WHERE NOT EXISTS (SELECT 1 FROM patients p WHERE p.fhir_patient_id = s.fhir_patient_id)
+    """)
+    unknown_patients = cursor.fetchone()[0]
+    cursor.execute(OBSERVATION_MOVED_SQL)
+    cursor.execute(OBSERVATION_MERGE_SQL)
+    written = len(cursor.fetchall())
+    conn.commit()
+    cursor.close()
+    return {
+        'written': written,
+        'unchanged': len(rows) - unknown_patients - written,
+        'skipped': len(resources) - len(rows),
+        'unknown_patients': unknown_patients
+    }
+
+
+LOADERS = {
+    'Patient': _load_patients,
+    'Observation': _load_observations,
+}
+
+
+def file_key(output):
+    return output.get('url') or output['path']
+
+
+def _chunks(resources, size):
+    chunk = []
+    for resource in resources:
+        chunk.append(resource)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ingest_file(output, job_id=None, batch_size=None):
+    """
+    Load one downloaded file ({'type', 'path', 'url'}) and checkpoint it
+    Runs in a worker process with its own database connection.
+    """
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    loader = LOADERS[output['type']]
+    totals = {'resources': 0, 'written': 0, 'unchanged': 0, 'skipped': 0, 'unknown_patients': 0}
+    started = time.perf_counter()
+
+    conn = connect()
+    try:
+        for batch in _chunks(iter_ndjson(output['path']), batch_size):
+            stats = loader(conn, batch)
+            totals['resources'] += len(batch)
+            for name, value in stats.items():
+                totals[name] += value
+
+        seconds = time.perf_counter() - started
+        rows_per_second = totals['resources'] / seconds if seconds > 0 else None
+
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO bulk_ingest_checkpoints (
+                file_key, job_id, resource_type, path, resources, rows_written,
+                unchanged, skipped, unknown_patients, seconds, rows_per_second, completed_at
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (file_key) DO UPDATE SET
+                job_id = EXCLUDED.job_id, resources = EXCLUDED.resources,
+                rows_written = EXCLUDED.rows_written, unchanged = EXCLUDED.unchanged,
+                skipped = EXCLUDED.skipped, unknown_patients = EXCLUDED.unknown_patients,
+                seconds = EXCLUDED.seconds, rows_per_second = EXCLUDED.rows_per_second,
+                completed_at = EXCLUDED.completed_at, attempts = bulk_ingest_checkpoints.attempts + 1
+            RETURNING attempts
+        """, (file_key(output), job_id, output['type'], output['path'], totals['resources'],
+              totals['written'], totals['unchanged'], totals['skipped'], totals['unknown_patients'],
+              seconds, rows_per_second))
+        attempts = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+    return {
+        'file': file_key(output),
+        'type': output['type'],
+        **totals,
+        'attempts': attempts,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows_per_second, 1) if rows_per_second else None
+    }
+
+
+def completed_files(keys):
+    """
+    Which of these file keys were already loaded by an earlier run
+    Files that left observations of unknown patients behind count as not done, so they are retried,
+    until they have been loaded ORPHAN_RETRIES times.
+    """
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT file_key FROM bulk_ingest_checkpoints
+            WHERE file_key = ANY(%s) AND (unknown_patients = 0 OR attempts >= %s)
+        """, (list(keys), ORPHAN_RETRIES))
+        done = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+    finally:
+        conn.close()
+    return done
+
+
+def ingest_export(output_files, job_id=None, workers=None, batch_size=None):
+    """
+    Load every supported, not yet checkpointed file of an export in a process pool
+    Patient files go first so Observations can be matched to their patients.
+    Returns one result per file; failed files carry an 'error' and are left for the next run.
+    """
+    workers = workers or INGEST_WORKERS
+    done = completed_files(file_key(output) for output in output_files)
+
+    results, pending = [], []
+    for output in output_files:
+        if file_key(output) in done:
+            results.append({'file': file_key(output), 'type': output.get('type'), 'status': 'already loaded'})
+        elif output.get('type') not in LOADERS:
+            results.append({'file': file_key(output), 'type': output.get('type'), 'status': 'unsupported type'})
+        else:
+            pending.append(output)
+
+    context = multiprocessing.get_context(START_METHOD)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for resource_type in LOADERS:
+            futures = {
+                executor.submit(ingest_file, output, job_id, batch_size): output
+                for output in pending if output['type'] == resource_type
+            }
+            for future in as_completed(futures):
+                output = futures[future]
+                try:
+                    result = future.result()
+                    print(f"✓ Loaded {result['resources']:,} {result['type']} resources from {output['path']} "
+                          f"in {result['seconds']}s ({result['rows_per_second'] or 0:,.0f} rows/s)")
+                except Exception as e:
+                    print(f"✗ Failed to load {output['path']}: {e}")
+                    result = {'file': file_key(output), 'type': output['type'], 'error': str(e)}
+                results.append(result)
+    return results
+
+
+def ingest_running(job_id):
+    """Whether some process holds the ingest lock of this job"""
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_locks
+                WHERE locktype = 'advisory' AND classid = %s::oid AND objid = %s::oid AND objsubid = 2
+            )
+        """, (INGEST_LOCK_CLASS, job_id))
+        running = cursor.fetchone()[0]
+        cursor.close()
+    finally:
+        conn.close()
+    return running
+
+
+def ingest_job(job_id, workers=None, batch_size=None):
+    """
+    Load the downloaded output of a completed bulk_export_jobs row
+    Raises IngestRunning if the job is already being ingested, e.g. by auto-ingest and a manual run.
+    """
+    # The lock belongs to this connection's session, so it is released when the connection closes
+    lock_conn = connect()
+    try:
+        cursor = lock_conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (INGEST_LOCK_CLASS, job_id))
+        if not cursor.fetchone()[0]:
+            raise IngestRunning(f"Bulk export job {job_id} is already being ingested")
+        cursor.execute("SELECT status, output_files FROM bulk_export_jobs WHERE job_id = %s", (job_id,))
+        row = cursor.fetchone()
+        lock_conn.commit()
+
+        if not row:
+            raise ValueError(f"No bulk export job {job_id}")
+        status, output_files = row
+        if status != 'complete':
+            raise ValueError(f"Bulk export job {job_id} is {status}, not complete")
+        results = ingest_export(output_files or [], job_id=job_id, workers=workers, batch_size=batch_size)
+
+        # Only a fully applied export may move _since forward; otherwise its changes would be skipped next time
+        waiting = sum(result.get('unknown_patients', 0) for result in results
+                      if result.get('attempts', 0) < ORPHAN_RETRIES)
+        orphans = sum(result.get('unknown_patients', 0) for result in results
+                      if result.get('attempts', 0) >= ORPHAN_RETRIES)
+        if orphans:
+            print(f"Bulk export job {job_id}: giving up on {orphans:,} observations of patients "
+                  f"still unknown after {ORPHAN_RETRIES} runs")
+        if waiting:
+            print(f"Bulk export job {job_id} left {waiting:,} observations of unknown patients; "
+                  f"not advancing _since until a later run loads them")
+        elif not any('error' in result for result in results):
+            if advance_watermarks(cursor, job_id):
+                print(f"✓ Advanced _since watermarks to bulk export job {job_id}")
+            lock_conn.commit()
+        cursor.close()
+    finally:
+        lock_conn.close()
+    return results
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if len(sys.argv) != 2:
+        print("Usage: python bulk_ingest.py <job_id>")
+        sys.exit(1)
+    for result in ingest_job(int(sys.argv[1])):
+        print(result)
@@ -0,0 +1,129 @@
+"""
+Vectorized demographics for batches of Patient resources
+PatientColumns turns patients into columnar NumPy arrays in one pass (gender codes and
+birth dates); ages, gender counts, the age histogram and quantiles are then computed with
+array operations instead of a strptime and a dict update per patient.
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+
+GENDERS = ('male', 'female', 'other')
+GENDER_CODES = {gender: code for code, gender in enumerate(GENDERS)}
+OTHER = GENDER_CODES['other']
+
+# Lower edges of the age histogram buckets; the last bucket is open-ended
+AGE_BINS = (0, 18, 30, 45, 65, 80)
+QUANTILES = (0.25, 0.5, 0.75)
+
+_NAT = np.datetime64('NaT', 'D')
+
+
+def _birth_date(value):
+    # Only full dates count; partial birthDates ('1980', '1980-04') give no age
+    return value if value and len(value) == 10 else 'NaT'
+
+
+def _parse_dates(values):
+    try:
+        return np.array(values, dtype='datetime64[D]')
+    except ValueError:
+        # A malformed date somewhere in the batch; parse one by one so only it becomes NaT
+        parsed = np.empty(len(values), dtype='datetime64[D]')
+        for i, value in enumerate(values):
+            try:
+                parsed[i] = np.datetime64(value, 'D')
+            except ValueError:
+                parsed[i] = _NAT
+        return parsed
+
+
+def completed_years(birth_dates, today=None):
+    """Age in whole years on `today` for a datetime64[D] array; NaT birth dates give -1"""
+    today = np.datetime64(today or date.today(), 'D')
+    birth_year = birth_dates.astype('datetime64[Y]')
+    birth_month = birth_dates.astype('datetime64[M]')
+    # Month and day packed into one comparable number: the birthday has passed when it is <= today's
+    birth_day = ((birth_month - birth_year).astype(np.int64) * 32
+                 + (birth_dates - birth_month).astype(np.int64))
+    today_year = today.astype('datetime64[Y]')
+    today_month = today.astype('datetime64[M]')
+    today_day = (int((today_month - today_year).astype(np.int64)) * 32
+                 + int((today - today_month).astype(np.int64)))
+
+    ages = (today_year - birth_year).astype(np.int64) - (birth_day > today_day)
+    ages[np.isnat(birth_dates)] = -1
+    return ages
+
+
+class PatientColumns:
+    """
+    Gender codes (indexes into GENDERS) and birth dates of a batch of patients, as arrays
+    Build with from_resources() for FHIR Patients or from_frame() for a pandas DataFrame.
+    """
+
+    def __init__(self, gender_codes, birth_dates, today=None):
+        self.gender_codes = np.asarray(gender_codes, dtype=np.int8)
+        self.birth_dates = np.asarray(birth_dates, dtype='datetime64[D]')
+        self.ages = completed_years(self.birth_dates, today)
+        self.has_age = self.ages >= 0
+
+    @classmethod
+    def from_resources(cls, resources, today=None):
+        genders, births = [], []
+        for resource in resources:
+            genders.append(GENDER_CODES.get((resource.get('gender') or '').lower(), OTHER))
+            births.append(_birth_date(resource.get('birthDate')))
+        return cls(genders, _parse_dates(births), today)
+
+    @classmethod
+    def from_frame(cls, df, gender='gender', birth_date='birth_date', today=None):
+        gender_codes = df[gender].str.lower().map(GENDER_CODES).fillna(OTHER).to_numpy(np.int8)
+        birth_dates = pd.to_datetime(df[birth_date], errors='coerce').to_numpy('datetime64[D]')
+        return cls(gender_codes, birth_dates, today)
+
+    def __len__(self):
+        return len(self.gender_codes)
+
+    def genders(self):
+        """Normalized gender per patient ('male', 'female' or 'other')"""
+        return np.asarray(GENDERS, dtype=object)[self.gender_codes].tolist()
+
+    def age_list(self):
+        """Age per patient, None where the birth date is missing or partial"""
+        ages = self.ages.astype(object)
+        ages[~self.has_age] = None
+        return ages.tolist()
+
+    def gender_counts(self):
+        counts = np.bincount(self.gender_codes, minlength=len(GENDERS))
+        return {gender: int(count) for gender, count in zip(GENDERS, counts)}
+
+    def age_histogram(self, bins=AGE_BINS):
+        """[{'label': '18-29', 'count': n}, ...] over patients with a known age"""
+        buckets = np.searchsorted(np.asarray(bins), self.ages[self.has_age], side='right') - 1
+        counts = np.bincount(buckets, minlength=len(bins))
+        labels = [f"{low}-{high - 1}" for low, high in zip(bins, bins[1:])] + [f"{bins[-1]}+"]
+        return [{'label': label, 'count': int(count)} for label, count in zip(labels, counts)]
+
+    def stats(self, bins=AGE_BINS, quantiles=QUANTILES):
+        """The dashboards' stats block, plus age quantiles and histogram"""
+        ages = self.ages[self.has_age]
+        known = ages.size > 0
+        return {
+            'total_patients': len(self),
+            'gender_counts': self.gender_counts(),
+            'average_age': float(ages.mean()) if known else None,
+            'age_range': {
+                'min': int(ages.min()) if known else None,
+                'max': int(ages.max()) if known else None
+            },
+            'age_quantiles': {
+                f"p{round(q * 100)}": float(value) if known else None
+                for q, value in zip(quantiles, np.quantile(ages, quantiles) if known else quantiles)
+            },
+            'age_histogram': self.age_histogram(bins)
+        }
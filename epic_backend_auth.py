@@ -3,14 +3,56 @@ Epic Backend Services (System-to-System) Authentication
 Uses JWT-based authentication for automated bulk data access without user login
 """
 
-import jwt
+import hashlib
+import tempfile
 import time
 import uuid
+import jwt
 import requests
+import fhir_http
 import os
+import threading
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
+from epic_fhir import EpicFHIRClient
+import token_store
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # orjson is optional; fall back to the stdlib decoder
+    from json import loads as _json_loads
+
+
+TOKEN_SCOPE = 'system/Patient.read system/Observation.read system/*.read'
+# Refresh this long before the token's expiry, on a background timer
+TOKEN_REFRESH_AHEAD = float(os.getenv('BACKEND_TOKEN_REFRESH_AHEAD', 120))
+# Never re-arm the refresh timer sooner than this, so a short-lived token cannot cause a refresh loop
+TOKEN_REFRESH_MIN_DELAY = float(os.getenv('BACKEND_TOKEN_REFRESH_MIN_DELAY', 10))
+# Stop refreshing in the background once the token has not been used for this long
+TOKEN_IDLE_STOP = float(os.getenv('BACKEND_TOKEN_IDLE_STOP', 1800))
+TOKEN_BACKGROUND_REFRESH = os.getenv('BACKEND_TOKEN_BACKGROUND_REFRESH', '1') == '1'
+
+# Where bulk-export ndjson files are downloaded to
+SPOOL_DIR = os.getenv('BULK_EXPORT_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'epic_bulk_export'))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('BULK_EXPORT_CHUNK_SIZE', 1024 * 1024))
+BUILD_INDEX = os.getenv('BULK_EXPORT_BUILD_INDEX', '1') == '1'
+
+
+def iter_ndjson(path):
+    """Yield one decoded resource per line of an ndjson file, reading it line by line"""
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield _json_loads(line)
+
+
+def _complete_length(response):
+    """Full size of the file from a 416's Content-Range ('bytes */12345'), or None"""
+    _, _, length = response.headers.get('Content-Range', '').rpartition('/')
+    return int(length) if length.isdigit() else None
 
 
 class EpicBackendAuth:
@@ -19,20 +61,41 @@ class EpicBackendAuth:
     No user login required - perfect for bulk data operations
     """
     
-    def __init__(self):
+    def __init__(self, token_store=None, background_refresh=TOKEN_BACKGROUND_REFRESH):
         self.client_id = os.getenv('EPIC_BACKEND_CLIENT_ID')
         self.token_url = os.getenv('EPIC_TOKEN_URL')
         self.fhir_url = os.getenv('EPIC_FHIR_URL')
         self.private_key_path = os.getenv('PRIVATE_KEY_PATH', './keys/private_key.pem')
         self.access_token = None
         self.token_expiry = None
+        # Optional cross-process store (see token_store.py) so all workers share one token
+        self.token_store = token_store
+        self.background_refresh = background_refresh
+        self._token_lock = threading.Lock()
+        self._refresh_timer = None
+        self._last_used = time.monotonic()
+        # Parsed private key, cached by load_private_key()
+        self._key_lock = threading.Lock()
+        self._private_key = None
+        self._key_source = None
         
     def load_private_key(self):
-        """Load RSA private key from file or environment variable"""
+        """
+        Load RSA private key from file or environment variable
+        The parsed key is cached; the file is only re-read when its mtime or size changes
+        """
+        with self._key_lock:
+            return self._load_private_key()
+    
+    def _load_private_key(self):
         try:
             # First try environment variable (for production)
             private_key_pem = os.getenv('PRIVATE_KEY_PEM')
             if private_key_pem:
+                source = ('env', private_key_pem)
+                if source == self._key_source:
+                    return self._private_key
+                
                 # Handle both formats: literal \n and actual newlines
                 if '\\n' in private_key_pem:
                     # Convert literal \n to actual newlines
@@ -46,16 +109,23 @@ class EpicBackendAuth:
                     password=None,
                     backend=default_backend()
                 )
+                self._remember_key(private_key, source)
                 print("✓ Loaded private key from environment variable")
                 return private_key
             
             # Fallback to file (for local development)
+            stat = os.stat(self.private_key_path)
+            source = ('file', self.private_key_path, stat.st_mtime_ns, stat.st_size)
+            if source == self._key_source:
+                return self._private_key
+            
             with open(self.private_key_path, 'rb') as key_file:
                 private_key = serialization.load_pem_private_key(
                     key_file.read(),
                     password=None,
                     backend=default_backend()
                 )
+            self._remember_key(private_key, source)
             print(f"✓ Loaded private key from file: {self.private_key_path}")
             return private_key
         except FileNotFoundError:
@@ -63,6 +133,10 @@ class EpicBackendAuth:
         except Exception as e:
             raise Exception(f"Error loading private key: {e}")
     
+    def _remember_key(self, private_key, source):
+        self._private_key = private_key
+        self._key_source = source
+    
     def create_jwt_assertion(self):
         """
         Create JWT assertion for client authentication
@@ -82,26 +156,66 @@ class EpicBackendAuth:
         }
         
         # Sign JWT with private key
-        jwt_token = jwt.encode(
+        return jwt.encode(
             claims,
             private_key,
             algorithm='RS384',  # Epic uses RS384
-            headers={'kid': 'epic-backend-key'}  # Key ID
+            headers={'kid': 'epic-backend-key'}
         )
-        
-        return jwt_token
     
+    def _token_valid(self, ahead=0):
+        return bool(self.access_token and self.token_expiry
+                    and datetime.now() + timedelta(seconds=ahead) < self.token_expiry)
+
     def get_access_token(self, force_refresh=False):
         """
         Get access token using Backend Services authentication
-        Token is cached and reused until it expires
+        Token is cached and reused until it expires. Refreshes are single-flight: concurrent
+        callers wait for the one request in progress instead of each signing a new JWT.
         """
+        self._last_used = time.monotonic()
+        
         # Return cached token if still valid
-        if not force_refresh and self.access_token and self.token_expiry:
-            if datetime.now() < self.token_expiry:
-                print("Using cached access token")
+        if not force_refresh and self._token_valid():
+            return self.access_token
+        
+        stale_token = self.access_token
+        with self._token_lock:
+            # Another thread refreshed while we waited for the lock
+            if self._token_valid() and (not force_refresh or self.access_token != stale_token):
                 return self.access_token
+            self._refresh_token(force_refresh, stale_token)
+        
+        self._schedule_refresh()
+        return self.access_token
+    
+    def _refresh_token(self, force_refresh=False, stale_token=None, ahead=0):
+        """Fetch a new token, or adopt one another process already stored; caller holds _token_lock"""
+        if self.token_store is None:
+            self._set_token(*self._request_token())
+            return
         
+        key = token_store.store_key(self.client_id, self.token_url, TOKEN_SCOPE)
+        with self.token_store.locked(key) as slot:
+            stored = slot.load()
+            if stored:
+                access_token, expires_at = stored
+                fresh = expires_at - ahead > time.time()
+                # A forced refresh still takes a stored token if it is not the one that was rejected
+                if fresh and (not force_refresh or access_token != stale_token):
+                    self._set_token(access_token, expires_at)
+                    print("Using access token from shared token store")
+                    return
+            access_token, expires_at = self._request_token()
+            slot.save(access_token, expires_at)
+            self._set_token(access_token, expires_at)
+    
+    def _set_token(self, access_token, expires_at):
+        self.access_token = access_token
+        self.token_expiry = datetime.fromtimestamp(expires_at)
+    
+    def _request_token(self):
+        """POST a signed JWT assertion to the token endpoint; returns (access_token, expiry epoch seconds)"""
         try:
             # Create JWT assertion
             jwt_assertion = self.create_jwt_assertion()
@@ -111,22 +225,20 @@ class EpicBackendAuth:
                 'grant_type': 'client_credentials',
                 'client_assertion_type': 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
                 'client_assertion': jwt_assertion,
-                'scope': 'system/Patient.read system/Observation.read system/*.read'
+                'scope': TOKEN_SCOPE
             }
             
             print(f"Requesting access token from: {self.token_url}")
-            response = requests.post(self.token_url, data=data)
+            response = fhir_http.post(self.token_url, data=data)
             response.raise_for_status()
             
             token_data = response.json()
-            self.access_token = token_data['access_token']
             
             # Set expiry (usually 15 minutes, we'll refresh 1 minute early)
             expires_in = token_data.get('expires_in', 900)
-            self.token_expiry = datetime.now() + timedelta(seconds=expires_in - 60)
             
             print(f"✓ Access token obtained (expires in {expires_in}s)")
-            return self.access_token
+            return token_data['access_token'], time.time() + expires_in - 60
             
         except requests.exceptions.HTTPError as e:
             error_detail = e.response.text if hasattr(e.response, 'text') else str(e)
@@ -134,6 +246,45 @@ class EpicBackendAuth:
         except Exception as e:
             raise Exception(f"Authentication error: {e}")
     
+    def _schedule_refresh(self, delay=None):
+        """
+        Arm the background timer that renews the token TOKEN_REFRESH_AHEAD seconds before expiry,
+        or halfway through its lifetime if it lives less than twice that
+        """
+        if not self.background_refresh or not self.token_expiry:
+            return
+        if delay is None:
+            lifetime = (self.token_expiry - datetime.now()).total_seconds()
+            delay = max(lifetime * 0.5, lifetime - TOKEN_REFRESH_AHEAD)
+        with self._token_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+            self._refresh_timer = threading.Timer(max(delay, TOKEN_REFRESH_MIN_DELAY), self._background_refresh)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+    
+    def _background_refresh(self):
+        if time.monotonic() - self._last_used > TOKEN_IDLE_STOP:
+            # Idle: let the token lapse; the next get_access_token() refreshes and re-arms the timer
+            with self._token_lock:
+                self._refresh_timer = None
+            return
+        try:
+            with self._token_lock:
+                if not self._token_valid(ahead=TOKEN_REFRESH_AHEAD):
+                    self._refresh_token(ahead=TOKEN_REFRESH_AHEAD)
+        except Exception as e:
+            print(f"Background token refresh failed, retrying in 30s: {e}")
+            self._schedule_refresh(delay=30)
+            return
+        self._schedule_refresh()
+    
+    def stop_background_refresh(self):
+        with self._token_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+    
     def test_connection(self):
         """Test the backend services connection"""
         try:
@@ -144,7 +295,7 @@ class EpicBackendAuth:
             }
             
             # Test with a simple metadata query
-            response = requests.get(f"{self.fhir_url}/metadata", headers=headers)
+            response = fhir_http.get(f"{self.fhir_url}/metadata", headers=headers)
             response.raise_for_status()
             
             print("✓ Backend Services authentication successful!")
@@ -160,9 +311,11 @@ class EpicBulkExport:
     Uses Backend Services authentication
     """
     
-    def __init__(self, auth_client):
+    def __init__(self, auth_client, parquet_dir=None):
         self.auth = auth_client
         self.fhir_url = auth_client.fhir_url
+        # When set, downloaded Patient/Observation files are also landed as Parquet (parquet_landing.py)
+        self.parquet_dir = parquet_dir or os.getenv('BULK_EXPORT_PARQUET_DIR')
     
     def initiate_export(self, resource_type='Patient', params=None):
         """
@@ -182,10 +335,10 @@ class EpicBulkExport:
             
             # Optional parameters
             if params:
-                export_url += '?' + '&'.join([f"{k}={v}" for k, v in params.items()])
+                export_url += '?' + urlencode(params)
             
             print(f"Initiating bulk export: {export_url}")
-            response = requests.get(export_url, headers=headers)
+            response = fhir_http.get(export_url, headers=headers)
             
             if response.status_code == 202:  # Accepted
                 status_url = response.headers.get('Content-Location')
@@ -209,25 +362,31 @@ class EpicBulkExport:
                 'Accept': 'application/fhir+json'
             }
             
-            response = requests.get(status_url, headers=headers)
+            response = fhir_http.get(status_url, headers=headers)
             
             if response.status_code == 202:
                 # Still processing
                 retry_after = response.headers.get('Retry-After', 'unknown')
                 return {
                     'status': 'in-progress',
-                    'retry_after': retry_after
+                    'retry_after': retry_after,
+                    'retry_after_seconds': fhir_http.retry_after_seconds(response, default=None),
+                    'progress': response.headers.get('X-Progress'),
+                    'http_status': 202
                 }
             elif response.status_code == 200:
                 # Complete!
                 return {
                     'status': 'complete',
-                    'data': response.json()
+                    'data': response.json(),
+                    'http_status': 200
                 }
             else:
                 return {
                     'status': 'error',
-                    'message': response.text
+                    'message': response.text,
+                    'retry_after_seconds': fhir_http.retry_after_seconds(response, default=None),
+                    'http_status': response.status_code
                 }
                 
         except Exception as e:
@@ -236,35 +395,111 @@ class EpicBulkExport:
                 'message': str(e)
             }
     
-    def download_export_file(self, file_url):
+    def download_export_file(self, file_url, spool_dir=None, chunk_size=DOWNLOAD_CHUNK_SIZE, resource_type=None,
+                             heartbeat=None):
         """
-        Download an ndjson file from bulk export
-        Returns the data as a list of FHIR resources
+        Stream an ndjson file from bulk export to a local spool file and return its path
+        The body is written chunk by chunk, so memory stays flat for multi-GB files.
+        An interrupted download resumes from the bytes already on disk with an HTTP Range request.
+        A sidecar byte-offset index (ndjson_index.py) is built for random access by id or patient.
+        Given the file's resource_type and a parquet_dir, the file is also landed as Parquet.
+        heartbeat, if given, is called after every chunk and between steps, and with force=True just
+        before the finished file is renamed into place; an exception from it abandons the download.
         """
-        try:
-            token = self.auth.get_access_token()
+        heartbeat = heartbeat or (lambda force=False: None)
+        path = self._download_to_spool(file_url, spool_dir, chunk_size, heartbeat)
+        if BUILD_INDEX:
+            import ndjson_index
+            
+            if not ndjson_index.has_index(path):
+                heartbeat()
+                ndjson_index.build_index(path)
+        if resource_type and self.parquet_dir:
+            heartbeat()
+            self.land_export_file(path, resource_type)
+        return path
+    
+    def land_export_file(self, path, resource_type):
+        """Convert a downloaded ndjson file into the Parquet landing zone"""
+        import parquet_landing
+        
+        landed = parquet_landing.ndjson_to_parquet(path, resource_type, landing_dir=self.parquet_dir)
+        if landed:
+            print(f"✓ Landed {landed['rows']:,} {resource_type} rows as Parquet ({len(landed['files'])} files)")
+        return landed
+    
+    def _download_to_spool(self, file_url, spool_dir, chunk_size, heartbeat):
+        spool_dir = spool_dir or SPOOL_DIR
+        os.makedirs(spool_dir, exist_ok=True)
+        name = hashlib.sha256(file_url.encode('utf-8')).hexdigest()[:32]
+        path = os.path.join(spool_dir, f"{name}.ndjson")
+        part_path = f"{path}.part"
+        
+        if os.path.exists(path):
+            return path
+        
+        resumable = True
+        for attempt in range(fhir_http.MAX_RETRIES + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
             headers = {
-                'Authorization': f'Bearer {token}'
+                'Authorization': f'Bearer {self.auth.get_access_token()}',
+                'Accept': 'application/fhir+ndjson',
+                # Range offsets count bytes of the encoded body, and we count bytes on disk
+                'Accept-Encoding': 'identity'
             }
+            if offset and resumable:
+                headers['Range'] = f'bytes={offset}-'
             
-            response = requests.get(file_url, headers=headers)
-            response.raise_for_status()
-            
-            # Parse ndjson (newline-delimited JSON)
-            resources = []
-            for line in response.text.strip().split('\n'):
-                if line:
-                    resources.append(eval(line))  # or use json.loads(line)
-            
-            return resources
-            
-        except Exception as e:
-            raise Exception(f"Failed to download export file: {e}")
+            try:
+                with fhir_http.get(file_url, headers=headers, stream=True) as response:
+                    if response.status_code == 416:
+                        if offset and offset == _complete_length(response):
+                            # Everything had arrived; only the rename was missed
+                            break
+                        # Our partial file is no prefix of what the server has now: start over
+                        os.remove(part_path)
+                        continue
+                    response.raise_for_status()
+                    
+                    encoding = response.headers.get('Content-Encoding', 'identity').lower()
+                    if encoding != 'identity':
+                        # Compressed anyway: bytes on disk no longer match the server's offsets
+                        resumable = False
+                    
+                    # 200 instead of 206 means the server ignored Range and sent everything
+                    mode = 'ab' if 'Range' in headers and response.status_code == 206 else 'wb'
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            heartbeat()
+                break
+                
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if attempt == fhir_http.MAX_RETRIES:
+                    raise Exception(f"Failed to download export file: {e}")
+                wait = fhir_http.BACKOFF_FACTOR * (2 ** attempt)
+                print(f"Download of {file_url} interrupted ({e}); resuming in {wait:.1f}s")
+                time.sleep(wait)
+            except Exception as e:
+                raise Exception(f"Failed to download export file: {e}")
+        else:
+            raise Exception(f"Failed to download export file: {file_url}")
+        
+        heartbeat(force=True)
+        os.replace(part_path, path)
+        print(f"✓ Downloaded {file_url} ({os.path.getsize(path):,} bytes)")
+        return path
     
-    def simple_patient_export(self, count=100):
+    def iter_export_file(self, file_url, spool_dir=None):
+        """Download (or reuse) an export file and yield its FHIR resources one at a time"""
+        return iter_ndjson(self.download_export_file(file_url, spool_dir))
+    
+    def simple_patient_export(self, count=100, elements=None):
         """
         Simplified patient export using Epic's test Group
         Uses proper Bulk Data Export workflow
+        elements limits each Patient read to those fields (_elements)
         """
         try:
             token = self.auth.get_access_token()
@@ -284,7 +519,7 @@ class EpicBulkExport:
                 params = {'_type': 'Patient'}
                 
                 print(f"Initiating bulk export for test group...")
-                response = requests.get(url, headers=headers, params=params)
+                response = fhir_http.get(url, headers=headers, params=params)
                 
                 if response.status_code == 202:
                     status_url = response.headers.get('Content-Location')
@@ -306,25 +541,20 @@ class EpicBulkExport:
                 'e.5VtBjHjlS6ILI.N0a8RqQ3',  # Camila Lopez
             ]
             
-            patients = []
             print(f"Fetching Epic test patients directly...")
             
-            # Fetch each test patient by ID
-            headers_read = {
-                'Authorization': f'Bearer {token}',
-                'Accept': 'application/fhir+json'
-            }
+            # One FHIR batch Bundle for all reads; falls back to concurrent (cached) single reads
+            client = EpicFHIRClient(token, cache_scope=f"backend:{self.auth.client_id}")
+            selected_ids = test_patient_ids[:min(len(test_patient_ids), count)]
+            fetched = client.read_patients(selected_ids, elements=elements)
             
-            for patient_id in test_patient_ids[:min(len(test_patient_ids), count)]:
-                try:
-                    url = f"{self.fhir_url}/Patient/{patient_id}"
-                    response = requests.get(url, headers=headers_read)
-                    if response.status_code == 200:
-                        patients.append(response.json())
-                        print(f"  ✓ Fetched patient {patient_id}")
-                except Exception as e:
-                    print(f"  ✗ Could not fetch patient {patient_id}: {e}")
-                    continue
+            patients = []
+            for patient_id in selected_ids:
+                if patient_id in fetched:
+                    patients.append(fetched[patient_id])
+                    print(f"  ✓ Fetched patient {patient_id}")
+                else:
+                    print(f"  ✗ Could not fetch patient {patient_id}")
             
             if len(patients) == 0:
                 raise Exception("Could not fetch any test patients. Backend Services may not have access to these patient IDs.")
@@ -1,56 +1,466 @@
+import fhir_http
+import fhir_cache
 import requests
+import hashlib
 import json
 from requests.auth import HTTPBasicAuth
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
 import os
-from datetime import datetime
+import io
+import math
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from psycopg2.extras import execute_values
+
+# Field projections for the dashboards; sent as _elements so Epic only returns what is read
+PATIENT_SUMMARY_ELEMENTS = ('name', 'gender', 'birthDate')
+OBSERVATION_SUMMARY_ELEMENTS = ('code', 'valueQuantity', 'effectiveDateTime')
+# Ingest also needs the fallback timestamps
+OBSERVATION_INGEST_ELEMENTS = ('code', 'valueQuantity', 'effectiveDateTime', 'effectivePeriod', 'issued')
+
+# Requests per FHIR batch Bundle
+BATCH_SIZE = int(os.getenv('FHIR_BATCH_SIZE', 50))
+# How long an endpoint that answered "batch not supported" is read individually before batch is retried
+BATCH_UNSUPPORTED_TTL = float(os.getenv('FHIR_BATCH_UNSUPPORTED_TTL', 3600))
+# Only these mean the endpoint has no batch interaction; other 4xx are about this request or its token
+BATCH_UNSUPPORTED_STATUSES = (404, 405, 501)
+
+
+def projection_params(elements=None, summary=None):
+    """Search/read parameters for a field projection (_elements) or a FHIR _summary mode"""
+    params = {}
+    if elements:
+        params['_elements'] = ','.join(elements)
+    if summary:
+        params['_summary'] = summary
+    return params
+
 
 class EpicFHIRClient:
-    def __init__(self, access_token):
+    def __init__(self, access_token, cache_scope=None, use_cache=True):
         self.access_token = access_token
         self.fhir_url = os.getenv('EPIC_FHIR_URL', 'https://fhirauth.patientdev.repldev.rep/api/FHIR/R4')
         self.headers = {
             'Authorization': f'Bearer {access_token}',
             'Accept': 'application/fhir+json'
         }
+        # Cached responses are only shared between clients with the same scope;
+        # by default that is the access token, i.e. the same user session
+        self.cache_scope = cache_scope or hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+        self.use_cache = use_cache
     
-    def search_patients(self, count=5):
+    def _get_json(self, url, params=None):
+        if self.use_cache:
+            return fhir_cache.get_json(url, params=params, headers=self.headers, scope=self.cache_scope)
+        response = fhir_http.get(url, headers=self.headers, params=params)
+        response.raise_for_status()
+        return response.json()
+    
+    def search_patients(self, count=5, elements=None, summary=None):
         """Search for patients from Epic"""
         try:
             url = f"{self.fhir_url}/Patient"
-            params = {'_count': count}
-            response = requests.get(url, headers=self.headers, params=params)
-            response.raise_for_status()
-            return response.json()
+            params = {'_count': count, **projection_params(elements, summary)}
+            return self._get_json(url, params)
         except Exception as e:
             print(f"Error searching patients: {e}")
             return None
     
-    def get_patient_observations(self, patient_id):
+    def get_patient_observations(self, patient_id, elements=None, summary=None):
         """Get observations (labs, vitals) for a patient"""
         try:
             url = f"{self.fhir_url}/Observation"
             params = {'patient': patient_id,
-                      'category': 'laboratory'
+                      'category': 'laboratory',
+                      **projection_params(elements, summary)
                       }
-            response = requests.get(url, headers=self.headers, params=params)
-            response.raise_for_status()
-            return response.json()
+            return self._get_json(url, params)
         except Exception as e:
             print(f"Error fetching observations: {e}")
             return None
     
-    def get_patient_details(self, patient_id):
+    def get_patient_details(self, patient_id, elements=None, summary=None):
         """Get specific patient demographics"""
         try:
             url = f"{self.fhir_url}/Patient/{patient_id}"
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
+            return self._get_json(url, projection_params(elements, summary) or None)
         except Exception as e:
             print(f"Error fetching patient details: {e}")
             return None
 
+    def _get_bundle(self, url, params=None):
+        return self._get_json(url, params)
+
+    def iter_search_pages(self, url, params=None, prefetch=True, more_wanted=None):
+        """
+        Lazily yield each page (Bundle) of a search, following the Bundle's next links
+        With prefetch, the next page is downloaded on a background thread while the
+        caller works through the current one, unless more_wanted(bundle) says otherwise.
+        Errors are raised, not swallowed.
+        """
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            bundle = self._get_bundle(url, params)
+            while bundle:
+                next_url = bundle_next_link(bundle)
+
+                pending = None
+                if executor and next_url and (more_wanted is None or more_wanted(bundle)):
+                    pending = executor.submit(self._get_bundle, next_url)
+
+                yield bundle
+
+                if not next_url:
+                    return
+                bundle = pending.result() if pending else self._get_bundle(next_url)
+        finally:
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_search(self, url, params=None, max_resources=None, prefetch=True):
+        """
+        Lazily yield resources from a search, following the Bundle's next links
+        Stops after max_resources (no request at all if it is 0 or less). With prefetch, the next
+        page is downloaded on a background thread while the caller works through the current one.
+        Errors are raised, not swallowed.
+        """
+        if max_resources is not None and max_resources <= 0:
+            return
+        yielded = 0
+
+        def more_wanted(bundle):
+            return max_resources is None or yielded + len(bundle_matches(bundle)) < max_resources
+
+        pages = self.iter_search_pages(url, params, prefetch=prefetch, more_wanted=more_wanted)
+        try:
+            for bundle in pages:
+                for entry in bundle_matches(bundle):
+                    yield entry.get('resource', {})
+                    yielded += 1
+                    if max_resources is not None and yielded >= max_resources:
+                        return
+        finally:
+            pages.close()
+
+    def iter_patients(self, page_size=100, max_resources=None, prefetch=True, elements=None, summary=None):
+        """Yield Patient resources across every page of the search"""
+        return self.iter_search(
+            f"{self.fhir_url}/Patient",
+            params={'_count': page_size, **projection_params(elements, summary)},
+            max_resources=max_resources,
+            prefetch=prefetch
+        )
+
+    def iter_patient_observations(self, patient_id, category='laboratory', page_size=100,
+                                  max_resources=None, prefetch=True, elements=None, summary=None):
+        """Yield a patient's Observation resources across every page of the search"""
+        params = {'patient': patient_id, '_count': page_size, **projection_params(elements, summary)}
+        if category:
+            params['category'] = category
+        return self.iter_search(
+            f"{self.fhir_url}/Observation",
+            params=params,
+            max_resources=max_resources,
+            prefetch=prefetch
+        )
+
+    def iter_observations_for_patients(self, patient_ids, max_workers=None, category='laboratory',
+                                       max_resources=None, elements=None):
+        """
+        Fetch observations for many patients on a bounded thread pool
+        Yields (patient_id, resources, error) as each patient completes; all requests
+        share the fhir_http rate limiter, which also honours 429 Retry-After.
+        """
+        max_workers = max_workers or fhir_http.FETCH_WORKERS
+
+        def fetch(patient_id):
+            return list(self.iter_patient_observations(
+                patient_id, category=category, max_resources=max_resources, prefetch=False, elements=elements
+            ))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch, patient_id): patient_id for patient_id in dict.fromkeys(patient_ids)}
+            try:
+                for future in as_completed(futures):
+                    patient_id = futures[future]
+                    try:
+                        yield patient_id, future.result(), None
+                    except Exception as e:
+                        yield patient_id, [], str(e)
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def batch_get(self, request_urls):
+        """
+        Run many GETs (relative URLs such as 'Patient/123' or 'Observation?patient=123')
+        as FHIR batch Bundles of up to BATCH_SIZE entries, one round-trip each.
+        Falls back to concurrent single reads if the server rejects batch.
+        Returns [(url, status_code, resource)] in request order; resource is None on failure.
+        """
+        results = []
+        for start in range(0, len(request_urls), BATCH_SIZE):
+            chunk = request_urls[start:start + BATCH_SIZE]
+            if not _batch_unsupported_now(self.fhir_url):
+                try:
+                    results.extend(self._post_batch(chunk))
+                    continue
+                except _BatchRejected as e:
+                    print(f"FHIR batch not accepted, reading individually: {e}")
+            results.extend(self._get_each(chunk))
+        return results
+
+    def _post_batch(self, request_urls):
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{'request': {'method': 'GET', 'url': url}} for url in request_urls]
+        }
+        headers = {**self.headers, 'Content-Type': 'application/fhir+json'}
+        response = fhir_http.post(self.fhir_url, headers=headers, json=bundle)
+
+        if response.status_code in BATCH_UNSUPPORTED_STATUSES:
+            # The server does not do batch; read individually for a while before trying again
+            _batch_unsupported[self.fhir_url] = time.monotonic() + BATCH_UNSUPPORTED_TTL
+            raise _BatchRejected(f"{response.status_code} {response.reason}")
+        if response.status_code != 200:
+            raise _BatchRejected(f"{response.status_code} {response.reason}")
+
+        reply = response.json()
+        entries = reply.get('entry', [])
+        if reply.get('type') != 'batch-response' or len(entries) != len(request_urls):
+            raise _BatchRejected("unexpected batch-response")
+
+        results = []
+        for url, entry in zip(request_urls, entries):
+            status = entry.get('response', {}).get('status', '')
+            status_code = int(status.split()[0]) if status[:3].isdigit() else 0
+            resource = entry.get('resource') if 200 <= status_code < 300 else None
+            results.append((url, status_code, resource))
+        return results
+
+    def _get_each(self, request_urls):
+        def read(url):
+            try:
+                return url, 200, self._get_json(f"{self.fhir_url}/{url}")
+            except requests.HTTPError as e:
+                return url, e.response.status_code, None
+            except Exception as e:
+                print(f"Error reading {url}: {e}")
+                return url, 0, None
+
+        with ThreadPoolExecutor(max_workers=fhir_http.FETCH_WORKERS) as executor:
+            return list(executor.map(read, request_urls))
+
+    def read_patients(self, patient_ids, elements=None):
+        """Read many Patients by id in as few round-trips as possible; returns {id: resource}"""
+        query = f"?{urlencode(projection_params(elements))}" if elements else ''
+        patient_ids = list(dict.fromkeys(patient_ids))
+        results = self.batch_get([f"Patient/{patient_id}{query}" for patient_id in patient_ids])
+        return {
+            patient_id: resource
+            for patient_id, (_, _, resource) in zip(patient_ids, results)
+            if resource is not None
+        }
+
+    def search_observations_batch(self, patient_ids, category='laboratory', elements=None):
+        """
+        Observation searches for many patients packed into batch Bundles
+        Returns {patient_id: [resources]}; any further pages are followed individually
+        """
+        patient_ids = list(dict.fromkeys(patient_ids))
+        urls = []
+        for patient_id in patient_ids:
+            params = {'patient': patient_id, **projection_params(elements)}
+            if category:
+                params['category'] = category
+            urls.append(f"Observation?{urlencode(params)}")
+
+        observations = {}
+        for patient_id, (_, _, bundle) in zip(patient_ids, self.batch_get(urls)):
+            if bundle is None:
+                continue
+            resources = [entry.get('resource', {}) for entry in bundle_matches(bundle)]
+            next_url = bundle_next_link(bundle)
+            if next_url:
+                resources.extend(self.iter_search(next_url))
+            observations[patient_id] = resources
+        return observations
+
+    def search_patients_with_observations(self, count=20, category='laboratory', prefetch=True):
+        """
+        Patients together with their Observations from one search, using
+        _revinclude=Observation:patient instead of one Observation search per patient.
+        Included Observations are filtered to category locally, since _revinclude takes no filter.
+        Falls back to search_observations_batch if the server rejects or ignores _revinclude.
+        Returns [(patient_resource, [observation_resources])] in search order.
+        """
+        params = {'_count': count, '_revinclude': 'Observation:patient'}
+        patients, observations = [], []
+        # Whether the server applied _revinclude; an empty result alone cannot tell
+        honored = False
+
+        def more_wanted(bundle):
+            # Only Patients count towards `count`; a page can carry many included Observations
+            page_patients = sum(
+                1 for entry in bundle_matches(bundle)
+                if entry.get('resource', {}).get('resourceType') == 'Patient'
+            )
+            return len(patients) + page_patients < count
+
+        pages = self.iter_search_pages(f"{self.fhir_url}/Patient", params, prefetch=prefetch,
+                                       more_wanted=more_wanted)
+        try:
+            # Always finish a page, so every included Observation of its patients is kept
+            for bundle in pages:
+                honored = honored or revinclude_honored(bundle)
+                for entry in bundle_matches(bundle):
+                    resource = entry.get('resource', {})
+                    if resource.get('resourceType') == 'Patient':
+                        patients.append(resource)
+                    elif resource.get('resourceType') == 'Observation':
+                        observations.append(resource)
+                if len(patients) >= count:
+                    break
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 400:
+                raise
+            print(f"_revinclude not accepted, searching observations separately: {e}")
+            patients = list(self.iter_patients(page_size=count, max_resources=count, prefetch=prefetch))
+            observations = None
+        finally:
+            pages.close()
+
+        patients = patients[:count]
+        if observations is not None and (honored or observations):
+            # Honored, even if these patients have no Observations at all
+            by_patient = index_observations_by_patient(observations, category)
+        else:
+            # Rejected, or silently ignored
+            by_patient = self.search_observations_batch(
+                [patient.get('id') for patient in patients], category=category
+            )
+        return [(patient, by_patient.get(patient.get('id'), [])) for patient in patients]
+
+
+class _BatchRejected(Exception):
+    pass
+
+
+# FHIR endpoint -> time.monotonic() until which batch is not tried, after it answered "not supported"
+_batch_unsupported = {}
+
+
+def _batch_unsupported_now(fhir_url):
+    until = _batch_unsupported.get(fhir_url)
+    if until is None:
+        return False
+    if time.monotonic() >= until:
+        _batch_unsupported.pop(fhir_url, None)
+        return False
+    return True
+
+
+def bundle_matches(bundle):
+    """Entries of a search Bundle, without the OperationOutcome warnings Epic appends"""
+    return [
+        entry for entry in bundle.get('entry', [])
+        if entry.get('search', {}).get('mode') != 'outcome'
+    ]
+
+
+def _has_category(resource, category):
+    return any(
+        coding.get('code') == category
+        for concept in resource.get('category', [])
+        for coding in concept.get('coding', [])
+    )
+
+
+def index_observations_by_patient(observations, category=None):
+    """
+    Group Observation resources by the id of their subject Patient in one pass
+    Handles relative ('Patient/123') and absolute subject references; drops other categories.
+    """
+    by_patient = {}
+    for resource in observations:
+        if category and not _has_category(resource, category):
+            continue
+        patient_id = subject_patient_id(resource)
+        if patient_id:
+            by_patient.setdefault(patient_id, []).append(resource)
+    return by_patient
+
+
+def subject_patient_id(resource):
+    """Patient id from a resource's subject (or patient) reference ('Patient/123' or an absolute URL), else None"""
+    reference = (resource.get('subject') or resource.get('patient') or {}).get('reference', '')
+    resource_type, _, patient_id = reference.rstrip('/').rpartition('/')
+    if not patient_id or not resource_type.endswith('Patient'):
+        return None
+    return patient_id
+
+
+def revinclude_honored(bundle):
+    """
+    Whether a search Bundle shows the server applied _revinclude: an entry with search.mode
+    'include', or _revinclude in the self link, which lists the parameters the server used
+    """
+    if any(entry.get('search', {}).get('mode') == 'include' for entry in bundle.get('entry', [])):
+        return True
+    return any(
+        link.get('relation') == 'self' and '_revinclude' in (link.get('url') or '')
+        for link in bundle.get('link', [])
+    )
+
+
+def bundle_next_link(bundle):
+    """URL of the next page of a search Bundle, or None on the last page"""
+    for link in bundle.get('link', []):
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+
+def patient_summary(resource):
+    """The fields the dashboards show for a Patient; reads only PATIENT_SUMMARY_ELEMENTS"""
+    name = (resource.get('name') or [{}])[0]
+    first_name = (name.get('given') or [''])[0]
+    last_name = name.get('family') or ''
+    return {
+        'id': resource.get('id'),
+        'first_name': first_name,
+        'last_name': last_name,
+        'dob': resource.get('birthDate'),
+        'gender': resource.get('gender'),
+        'avatar': f'https://ui-avatars.com/api/?name={first_name}+{last_name}'
+    }
+
+
+def observation_summary(resource):
+    """The fields the dashboards show for an Observation; reads only OBSERVATION_SUMMARY_ELEMENTS"""
+    quantity = resource.get('valueQuantity', {})
+    return {
+        'id': resource.get('id'),
+        'code': (resource.get('code', {}).get('coding') or [{}])[0].get('display', 'Unknown'),
+        'value': quantity.get('value', 'N/A'),
+        'unit': quantity.get('unit', ''),
+        'date': resource.get('effectiveDateTime', 'N/A')
+    }
+
+
+def observation_for_ingest(resource):
+    """Parsed observation for save_observations_to_db; reads only OBSERVATION_INGEST_ELEMENTS"""
+    observation = observation_summary(resource)
+    observation['last_updated'] = resource.get('meta', {}).get('lastUpdated')
+    observation['date'] = (resource.get('effectiveDateTime')
+                           or resource.get('effectivePeriod', {}).get('start')
+                           or resource.get('issued'))
+    return observation
+
 def get_epic_auth_url():
     """Generate Epic OAuth2 authorization URL with proper URL encoding"""
     client_id = os.getenv('EPIC_CLIENT_ID')
@@ -75,35 +485,445 @@ def get_epic_auth_url():
     
     return full_url
 
-def save_observations_to_db(conn, patient_id, fhir_patient_id, observations_data):
-    """Save observations to database"""
+OBSERVATION_COLUMNS = (
+    'patient_id', 'fhir_patient_id', 'fhir_observation_id', 'test_name', 'test_code',
+    'value', 'value_numeric', 'unit', 'observation_date', 'fhir_last_updated'
+)
+OBSERVATION_BATCH_SIZE = int(os.getenv('OBSERVATION_BATCH_SIZE', 5000))
+
+# Staging table for COPY; dropped automatically when the transaction commits
+OBSERVATION_STAGE_DDL = """
+CREATE TEMP TABLE IF NOT EXISTS patient_observations_stage (
+    patient_id INT,
+    fhir_patient_id VARCHAR(255),
+    fhir_observation_id VARCHAR(255),
+    test_name VARCHAR(255),
+    test_code VARCHAR(100),
+    value VARCHAR(100),
+    value_numeric DOUBLE PRECISION,
+    unit VARCHAR(50),
+    observation_date TIMESTAMP,
+    fhir_last_updated TIMESTAMPTZ
+) ON COMMIT DROP
+"""
+
+# Only rewrite a row when something in it actually changed, and never with an older
+# version of the resource (meta.lastUpdated) than the one already stored.
+# patient_observations is partitioned on observation_date, so the unique key includes it.
+OBSERVATION_UPSERT_CLAUSE = """
+ON CONFLICT (fhir_observation_id, observation_date) DO UPDATE SET
+    patient_id = EXCLUDED.patient_id,
+    fhir_patient_id = EXCLUDED.fhir_patient_id,
+    test_name = EXCLUDED.test_name,
+    test_code = EXCLUDED.test_code,
+    value = EXCLUDED.value,
+    value_numeric = EXCLUDED.value_numeric,
+    unit = EXCLUDED.unit,
+    fhir_last_updated = EXCLUDED.fhir_last_updated,
+    updated_at = CURRENT_TIMESTAMP
+WHERE (patient_observations.patient_id, patient_observations.fhir_patient_id, patient_observations.test_name,
+       patient_observations.test_code, patient_observations.value, patient_observations.unit,
+       patient_observations.fhir_last_updated)
+      IS DISTINCT FROM
+      (EXCLUDED.patient_id, EXCLUDED.fhir_patient_id, EXCLUDED.test_name,
+       EXCLUDED.test_code, EXCLUDED.value, EXCLUDED.unit,
+       EXCLUDED.fhir_last_updated)
+  AND (EXCLUDED.fhir_last_updated IS NULL OR patient_observations.fhir_last_updated IS NULL
+       OR EXCLUDED.fhir_last_updated >= patient_observations.fhir_last_updated)
+RETURNING (xmax = 0) AS inserted
+"""
+
+# The unique key is (fhir_observation_id, observation_date), so when Epic corrects an Observation's
+# effective date the upsert cannot find the old row and would insert a second one. Run this first to
+# delete the stored row of every incoming Observation whose date moved (unless the incoming version
+# is older); the upsert then inserts it under its new date. {source} must provide fhir_observation_id,
+# observation_date and fhir_last_updated.
+OBSERVATION_MOVED_DELETE_SQL = """
+DELETE FROM patient_observations po
+USING {source}
+WHERE po.fhir_observation_id = s.fhir_observation_id
+  AND po.observation_date <> s.observation_date
+  AND (s.fhir_last_updated IS NULL OR po.fhir_last_updated IS NULL
+       OR s.fhir_last_updated >= po.fhir_last_updated)
+"""
+
+
+def _numeric_value(value):
+    """Numeric form of an observation value, or None if it is not a number"""
+    if isinstance(value, bool):
+        return None
     try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def observation_timestamp(value):
+    """
+    A FHIR date or dateTime as text Postgres casts to TIMESTAMP, or None if it is no date at all
+    Partial dates ('2024', '2024-05') become the start of their year or month.
+    """
+    if not isinstance(value, str):
+        return None
+    if len(value) == 4 and value.isdigit():
+        value = f"{value}-01-01"
+    elif len(value) == 7:
+        value = f"{value}-01"
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return value
+
+
+# Months this process has already made sure have a partition
+_partitioned_months = set()
+_partition_lock = threading.Lock()
+
+
+def ensure_partitions(timestamps):
+    """
+    Create any missing monthly patient_observations partitions for these observation timestamps
+    Runs on its own short autocommit connection, so the partition DDL and its lock on
+    patient_observations never sit inside a long write or ingest transaction; months seen
+    before are skipped without a round trip. A month whose rows already sit in the default
+    partition is reported, and its rows keep going to the default partition.
+    """
+    months = {timestamp[:7] for timestamp in timestamps if timestamp}
+    with _partition_lock:
+        missing = sorted(months - _partitioned_months)
+    if not missing:
+        return 0
+
+    from app.utils import connect
+
+    conn = connect()
+    try:
+        conn.autocommit = True
         cursor = conn.cursor()
-        
-        for obs in observations_data:
-            query = """
-            INSERT INTO patient_observations 
-            (patient_id, fhir_patient_id, test_name, test_code, value, unit, observation_date)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, (
-                patient_id,
-                fhir_patient_id,
-                obs.get('code', 'Unknown'),
-                obs.get('code', ''),
-                str(obs.get('value', 'N/A')),
-                obs.get('unit', ''),
-                obs.get('date', None)
-            ))
-        
+        cursor.execute("SELECT ensure_observation_partitions(%s::DATE, %s::DATE)",
+                       (f"{missing[0]}-01", f"{missing[-1]}-01"))
+        created = cursor.fetchone()[0]
+        cursor.close()
+        for notice in conn.notices:
+            print(f"Observation partitions: {notice.strip()}")
+    finally:
+        conn.close()
+    with _partition_lock:
+        _partitioned_months.update(missing)
+    return created
+
+
+def _observation_row(patient_id, fhir_patient_id, obs):
+    """Flatten a parsed observation dict into a patient_observations column tuple"""
+    value = obs.get('value', 'N/A')
+    return (
+        patient_id,
+        fhir_patient_id,
+        obs.get('id'),
+        obs.get('code', 'Unknown'),
+        obs.get('code', ''),
+        str(value),
+        _numeric_value(value),
+        obs.get('unit', ''),
+        observation_timestamp(obs.get('date')),
+        obs.get('last_updated', None)
+    )
+
+
+def _dedupe_observation_rows(rows):
+    """Keep the last row per FHIR Observation id; ON CONFLICT cannot touch a row twice per statement"""
+    id_index = OBSERVATION_COLUMNS.index('fhir_observation_id')
+    by_id = {}
+    for row in rows:
+        by_id[row[id_index]] = row
+    return list(by_id.values())
+
+
+def _copy_text_value(value):
+    """Encode one value for COPY ... FROM STDIN text format"""
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def _batches(rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream rows into table with COPY FROM STDIN using an in-memory buffer"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_text_value(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def _write_observation_batches(conn, rows, batch_size, method):
+    cursor = conn.cursor()
+    columns = ', '.join(OBSERVATION_COLUMNS)
+
+    date_index = OBSERVATION_COLUMNS.index('observation_date')
+    id_index = OBSERVATION_COLUMNS.index('fhir_observation_id')
+    updated_index = OBSERVATION_COLUMNS.index('fhir_last_updated')
+
+    if method == 'copy':
+        cursor.execute(OBSERVATION_STAGE_DDL)
+
+    batches = []
+    for batch in _batches(rows, batch_size):
+        started = time.perf_counter()
+        if method == 'copy':
+            cursor.execute("TRUNCATE patient_observations_stage")
+            copy_rows(cursor, 'patient_observations_stage', OBSERVATION_COLUMNS, batch)
+            cursor.execute(OBSERVATION_MOVED_DELETE_SQL.format(source='patient_observations_stage s'))
+            moved = cursor.rowcount
+            cursor.execute(
+                f"INSERT INTO patient_observations ({columns}) "
+                f"SELECT {columns} FROM patient_observations_stage "
+                + OBSERVATION_UPSERT_CLAUSE
+            )
+            written = cursor.fetchall()
+        else:
+            execute_values(
+                cursor,
+                OBSERVATION_MOVED_DELETE_SQL.format(
+                    source="(VALUES %s) AS s (fhir_observation_id, observation_date, fhir_last_updated)"
+                ),
+                [(row[id_index], row[date_index], row[updated_index]) for row in batch],
+                template="(%s, %s::TIMESTAMP, %s::TIMESTAMPTZ)",
+                page_size=batch_size
+            )
+            moved = cursor.rowcount
+            written = execute_values(
+                cursor,
+                f"INSERT INTO patient_observations ({columns}) VALUES %s " + OBSERVATION_UPSERT_CLAUSE,
+                batch,
+                page_size=batch_size,
+                fetch=True
+            )
+        inserted = sum(1 for r in written if r[0])
+        batches.append({
+            'rows': len(batch),
+            'inserted': inserted,
+            'updated': len(written) - inserted,
+            'unchanged': len(batch) - len(written),
+            'moved': moved,
+            'ms': round((time.perf_counter() - started) * 1000, 3)
+        })
+    conn.commit()
+    cursor.close()
+    return batches
+
+
+def save_observations_to_db(conn, patient_id, fhir_patient_id, observations_data, batch_size=None, method='copy'):
+    """
+    Upsert observations keyed on their FHIR Observation id, in batches
+    Uses COPY into a staging table by default and falls back to execute_values pages if COPY fails.
+    Unchanged observations are not rewritten, so repeat syncs are idempotent.
+    Observations without a FHIR id are skipped, since nothing would match them on the next sync;
+    so are those without a usable date, because the table is partitioned on observation_date.
+    An Observation whose effective date changed is moved: its old row is deleted and it is inserted again.
+    Returns {'rows', 'inserted', 'updated', 'unchanged', 'moved', 'skipped', 'method', 'batches'} or None on failure
+    """
+    batch_size = batch_size or OBSERVATION_BATCH_SIZE
+    id_index = OBSERVATION_COLUMNS.index('fhir_observation_id')
+    date_index = OBSERVATION_COLUMNS.index('observation_date')
+    keyed = [
+        row for row in (_observation_row(patient_id, fhir_patient_id, obs) for obs in observations_data)
+        if row[id_index] and row[date_index]
+    ]
+    rows = _dedupe_observation_rows(keyed)
+    try:
+        # Before the write transaction, so every month has its own partition rather than the default one
+        ensure_partitions(row[date_index] for row in rows)
+    except Exception as e:
+        print(f"Could not create observation partitions: {e}")
+
+    methods = ['copy', 'execute_values'] if method == 'copy' else ['execute_values']
+    for write_method in methods:
+        try:
+            batches = _write_observation_batches(conn, rows, batch_size, write_method)
+            return {
+                'rows': len(rows),
+                'inserted': sum(b['inserted'] for b in batches),
+                'updated': sum(b['updated'] for b in batches),
+                'unchanged': sum(b['unchanged'] for b in batches),
+                'moved': sum(b['moved'] for b in batches),
+                'skipped': len(observations_data) - len(keyed),
+                'method': write_method,
+                'batches': batches
+            }
+        except Exception as e:
+            print(f"Error saving observations with {write_method}: {e}")
+            conn.rollback()
+    return None
+
+
+PATIENT_COLUMNS = ('fhir_patient_id', 'first_name', 'last_name', 'date_of_birth', 'email', 'phone')
+# VARCHAR widths of the patients columns (sql/01_init.sql, sql/03_fhir_patient_mapping.sql);
+# one over-long value would otherwise fail the whole batch
+PATIENT_COLUMN_WIDTHS = {'first_name': 100, 'last_name': 100, 'email': 150, 'phone': 50}
+
+# Only rewrite a patient when something in it actually changed
+PATIENT_UPSERT_CLAUSE = """
+ON CONFLICT (fhir_patient_id) DO UPDATE SET
+    first_name = EXCLUDED.first_name,
+    last_name = EXCLUDED.last_name,
+    date_of_birth = EXCLUDED.date_of_birth,
+    email = EXCLUDED.email,
+    phone = EXCLUDED.phone,
+    updated_at = CURRENT_TIMESTAMP
+WHERE (patients.first_name, patients.last_name, patients.date_of_birth, patients.email, patients.phone)
+      IS DISTINCT FROM
+      (EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.date_of_birth, EXCLUDED.email, EXCLUDED.phone)
+RETURNING fhir_patient_id, patient_id
+"""
+
+PATIENT_UPSERT_SQL = f"INSERT INTO patients ({', '.join(PATIENT_COLUMNS)}) VALUES %s " + PATIENT_UPSERT_CLAUSE
+
+
+class LRUCache:
+    """Small thread-safe LRU map"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# fhir_patient_id -> local patients.patient_id (the mapping never changes once created)
+patient_id_cache = LRUCache(maxsize=int(os.getenv('PATIENT_ID_CACHE_SIZE', 10000)))
+
+
+def _telecom_value(resource, system):
+    for telecom in resource.get('telecom', []):
+        if telecom.get('system') == system:
+            return telecom.get('value')
+    return None
+
+
+def full_date(value):
+    """A FHIR date as 'YYYY-MM-DD' if it is a complete, valid date; partial dates ('1980', '1980-05') give None"""
+    if not isinstance(value, str) or len(value) != 10:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        return None
+
+
+def _fit(value, column):
+    return value[:PATIENT_COLUMN_WIDTHS[column]] if value else value
+
+
+def _patient_row(resource):
+    """Flatten an Epic Patient resource into a patients column tuple that fits the table's columns"""
+    name = (resource.get('name') or [{}])[0]
+    return (
+        resource.get('id'),
+        _fit((name.get('given') or [''])[0], 'first_name'),
+        _fit(name.get('family') or '', 'last_name'),
+        full_date(resource.get('birthDate')),
+        _fit(_telecom_value(resource, 'email'), 'email'),
+        _fit(_telecom_value(resource, 'phone'), 'phone')
+    )
+
+
+def resolve_patient_ids(conn, fhir_patient_ids):
+    """
+    Map FHIR Patient ids to local patient_ids
+    Served from the in-process LRU where possible; the rest are looked up in one query.
+    Ids with no local patient are left out of the result.
+    """
+    mapping = {}
+    missing = []
+    for fhir_id in set(fhir_patient_ids):
+        patient_id = patient_id_cache.get(fhir_id)
+        if patient_id is None:
+            missing.append(fhir_id)
+        else:
+            mapping[fhir_id] = patient_id
+
+    if missing:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT fhir_patient_id, patient_id FROM patients WHERE fhir_patient_id = ANY(%s)",
+            (missing,)
+        )
+        for fhir_id, patient_id in cursor.fetchall():
+            patient_id_cache.put(fhir_id, patient_id)
+            mapping[fhir_id] = patient_id
+        cursor.close()
+
+    return mapping
+
+
+def upsert_patients_to_db(conn, patient_resources, batch_size=None):
+    """
+    Bulk upsert Epic Patient resources into patients, keyed on fhir_patient_id
+    Returns {fhir_patient_id: patient_id} for every resource, or None on failure
+    """
+    batch_size = batch_size or OBSERVATION_BATCH_SIZE
+    rows = {}
+    for resource in patient_resources:
+        if resource.get('id'):
+            rows[resource['id']] = _patient_row(resource)
+
+    try:
+        cursor = conn.cursor()
+        written = execute_values(cursor, PATIENT_UPSERT_SQL, list(rows.values()), page_size=batch_size, fetch=True)
         conn.commit()
         cursor.close()
-        return True
     except Exception as e:
-        print(f"Error saving observations: {e}")
+        print(f"Error saving patients: {e}")
         conn.rollback()
-        return False
-    
+        return None
+
+    mapping = {}
+    for fhir_id, patient_id in written:
+        patient_id_cache.put(fhir_id, patient_id)
+        mapping[fhir_id] = patient_id
+
+    # Unchanged patients are not returned by the upsert
+    unchanged = [fhir_id for fhir_id in rows if fhir_id not in mapping]
+    if unchanged:
+        mapping.update(resolve_patient_ids(conn, unchanged))
+    return mapping
+
 def exchange_code_for_token(code):
     """Exchange authorization code for access token"""
     try:
@@ -124,7 +944,7 @@ def exchange_code_for_token(code):
             'client_id': client_id
         }
         
-        response = requests.post(token_url, data=data)
+        response = fhir_http.post(token_url, data=data)
         response.raise_for_status()
         return response.json()
     except Exception as e:
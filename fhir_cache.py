@@ -0,0 +1,210 @@
+"""
+Response cache for FHIR reads
+In-memory LRU with an optional on-disk tier. Fresh entries (younger than the TTL) are
+served without touching the network; stale ones are revalidated with
+If-None-Match / If-Modified-Since so an unchanged resource costs a 304, not a download.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import fhir_http
+
+
+CACHE_SIZE = int(os.getenv('FHIR_CACHE_SIZE', 512))
+CACHE_TTL = float(os.getenv('FHIR_CACHE_TTL', 300))
+# Responses contain PHI, so the disk tier is off unless a directory is configured
+CACHE_DIR = os.getenv('FHIR_CACHE_DIR')
+CACHE_DISK_MAX_ENTRIES = int(os.getenv('FHIR_CACHE_DISK_MAX_ENTRIES', 10000))
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'last_modified', 'stored_at')
+
+    def __init__(self, body, etag=None, last_modified=None, stored_at=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at if stored_at is not None else time.time()
+
+    def age(self):
+        return time.time() - self.stored_at
+
+
+class ResponseCache:
+    """Thread-safe LRU of raw response bodies with validators, optionally backed by a directory"""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, disk_dir=CACHE_DIR, disk_max_entries=CACHE_DISK_MAX_ENTRIES):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.counters = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'revalidated': 0,
+            'refetched': 0,
+            'uncacheable': 0
+        }
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(url, params=None, scope=''):
+        query = urlencode(sorted((params or {}).items()), doseq=True)
+        return hashlib.sha256(f"{scope}\n{url}\n{query}".encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.cache")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+            return CacheEntry(body, meta.get('etag'), meta.get('last_modified'), meta.get('stored_at'))
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, entry):
+        meta = json.dumps({
+            'etag': entry.etag,
+            'last_modified': entry.last_modified,
+            'stored_at': entry.stored_at
+        }).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(meta + b'\n')
+                f.write(entry.body)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            print(f"Could not write FHIR cache entry: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % 100 == 0
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """Drop the oldest files once the disk tier grows past its limit"""
+        try:
+            paths = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith('.cache')]
+            if len(paths) <= self.disk_max_entries:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - self.disk_max_entries]:
+                os.remove(path)
+        except OSError as e:
+            print(f"Could not prune FHIR cache directory: {e}")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._count('disk_hits')
+                self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        if self.disk_dir:
+            self._write_disk(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+            stats['max_entries'] = self.maxsize
+            stats['ttl_seconds'] = self.ttl
+            stats['disk_tier'] = bool(self.disk_dir)
+        return stats
+
+    def get_json(self, url, params=None, headers=None, scope=''):
+        """
+        GET url and return the decoded JSON body, using the cache where possible
+        scope separates callers whose credentials may see different data
+        Raises requests.HTTPError on error responses, like response.raise_for_status()
+        """
+        key = self.make_key(url, params, scope)
+        entry = self.get(key)
+
+        if entry is not None and entry.age() < self.ttl:
+            self._count('hits')
+            return json.loads(entry.body)
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag:
+                request_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request_headers['If-Modified-Since'] = entry.last_modified
+
+        response = fhir_http.get(url, headers=request_headers, params=params)
+
+        if entry is not None and response.status_code == 304:
+            self._count('revalidated')
+            refreshed = CacheEntry(
+                entry.body,
+                response.headers.get('ETag', entry.etag),
+                response.headers.get('Last-Modified', entry.last_modified)
+            )
+            self.put(key, refreshed)
+            return json.loads(refreshed.body)
+
+        response.raise_for_status()
+        self._count('refetched' if entry is not None else 'misses')
+
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            self._count('uncacheable')
+        else:
+            self.put(key, CacheEntry(
+                response.content,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified')
+            ))
+        return response.json()
+
+
+response_cache = ResponseCache()
+
+
+def get_json(url, params=None, headers=None, scope=''):
+    """Cached GET through the process-wide response cache"""
+    return response_cache.get_json(url, params=params, headers=headers, scope=scope)
@@ -0,0 +1,160 @@
+"""
+Shared HTTP session for Epic FHIR and OAuth token calls
+One keep-alive connection pool per host, default timeouts and retries with backoff
+"""
+
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 60))
+POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 4))  # number of hosts to keep pools for
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 20))  # keep-alive connections per host
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+RATE_LIMIT = float(os.getenv('HTTP_RATE_LIMIT', 10))  # requests per second across all threads; 0 disables
+RATE_BURST = int(os.getenv('HTTP_RATE_BURST', 20))
+MAX_RETRY_AFTER = float(os.getenv('HTTP_MAX_RETRY_AFTER', 120))
+FETCH_WORKERS = int(os.getenv('FHIR_FETCH_WORKERS', 8))  # thread pool size for concurrent FHIR reads
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every outbound request
+    pause() holds all callers back, e.g. while honouring a 429 Retry-After
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        if self.rate <= 0:
+            wait = self._paused_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the next `seconds`"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+rate_limiter = TokenBucket(RATE_LIMIT, RATE_BURST)
+
+
+def retry_after_seconds(response, default=1.0):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return default
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class _Retry(Retry):
+    # 429 is left to request(), which pauses the shared rate limiter for every thread
+    RETRY_AFTER_STATUS_CODES = frozenset([503])
+
+
+def _build_session():
+    # Reads of a non-idempotent POST are never replayed; connect failures are, since nothing was sent
+    retry = _Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=MAX_RETRIES,
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # The session is shared by every thread and caller, so it must not carry cookies between them
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session():
+    """Get or create the process-wide HTTP session"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the shared session, applying the default (connect, read) timeout
+    Every call takes a token from the shared rate limiter. A 429 pauses the limiter
+    for its Retry-After and the request is retried up to MAX_RETRIES times.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        response = session.request(method, url, **kwargs)
+        if response.status_code != 429 or attempt == MAX_RETRIES:
+            return response
+        wait = retry_after_seconds(response, default=BACKOFF_FACTOR * (2 ** attempt))
+        print(f"Rate limited by {url}; retrying in {wait:.1f}s")
+        response.close()
+        rate_limiter.pause(wait)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,140 @@
+"""
+Byte-offset index for downloaded bulk-export ndjson files
+build_index() writes two sidecar arrays next to the file: resource id -> (offset, length)
+and patient reference -> (offset, length), each sorted by a 64-bit key hash.
+IndexedNdjson memory-maps the file and its sidecars and decodes only the requested lines,
+so spot lookups in a multi-GB export neither scan it nor load it.
+"""
+
+import hashlib
+import mmap
+import os
+from array import array
+
+import numpy as np
+
+from epic_backend_auth import _json_loads
+from epic_fhir import subject_patient_id
+
+
+def _key(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _patient_reference(resource):
+    """Id of the Patient a resource belongs to: itself, or its subject/patient reference"""
+    if resource.get('resourceType') == 'Patient':
+        return resource.get('id')
+    return subject_patient_id(resource)
+
+
+def index_paths(path):
+    return f"{path}.ids.npy", f"{path}.patients.npy"
+
+
+class _Entries:
+    """Compact (key, offset, length) columns; a few bytes per line instead of a tuple each"""
+
+    def __init__(self):
+        self.keys = array('Q')
+        self.offsets = array('Q')
+        self.lengths = array('Q')
+
+    def add(self, key, offset, length):
+        self.keys.append(key)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def save(self, target):
+        # One (3, n) array sorted by key: row 0 stays contiguous for searchsorted on the mmap
+        table = np.array([self.keys, self.offsets, self.lengths], dtype=np.uint64).reshape(3, -1)
+        table = table[:, np.lexsort((table[1], table[0]))]
+        tmp_path = f"{target}.tmp.npy"
+        np.save(tmp_path, table)
+        os.replace(tmp_path, target)
+
+
+def build_index(path):
+    """Scan an ndjson file once and write its sidecar index; returns the number of indexed lines"""
+    ids, patients = _Entries(), _Entries()
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            length = len(line)
+            stripped = line.strip()
+            if stripped:
+                resource = _json_loads(stripped)
+                if resource.get('id'):
+                    ids.add(_key(resource['id']), offset, length)
+                patient_id = _patient_reference(resource)
+                if patient_id:
+                    patients.add(_key(patient_id), offset, length)
+            offset += length
+
+    ids_path, patients_path = index_paths(path)
+    ids.save(ids_path)
+    patients.save(patients_path)
+    return len(ids.keys)
+
+
+def has_index(path):
+    return all(
+        os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path)
+        for index_path in index_paths(path)
+    )
+
+
+class IndexedNdjson:
+    """
+    Random access to an indexed ndjson file
+    Use as a context manager, or call close() to release the mappings.
+    """
+
+    def __init__(self, path):
+        if not has_index(path):
+            build_index(path)
+        self.path = path
+        self._file = open(path, 'rb')
+        # mmap cannot map an empty file
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else None
+        ids_path, patients_path = index_paths(path)
+        self._ids = np.load(ids_path, mmap_mode='r')
+        self._patients = np.load(patients_path, mmap_mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._ids.shape[1]
+
+    def _lines(self, index, value):
+        key = np.uint64(_key(value))
+        keys = index[0]
+        start = int(np.searchsorted(keys, key, side='left'))
+        end = int(np.searchsorted(keys, key, side='right'))
+        for position in range(start, end):
+            offset, length = int(index[1, position]), int(index[2, position])
+            yield _json_loads(self._map[offset:offset + length])
+
+    def get(self, resource_id):
+        """The resource with this id, or None"""
+        for resource in self._lines(self._ids, resource_id):
+            # The key is a hash, so confirm the decoded line really is the one asked for
+            if resource.get('id') == resource_id:
+                return resource
+        return None
+
+    def for_patient(self, patient_id):
+        """Every resource in the file that belongs to this patient, in file order"""
+        return [
+            resource for resource in self._lines(self._patients, patient_id)
+            if _patient_reference(resource) == patient_id
+        ]
@@ -0,0 +1,224 @@
+"""
+Columnar Parquet landing zone for bulk-export resources
+Each downloaded ndjson file is flattened into typed columns and written as Parquet,
+one row group at a time so memory stays bounded regardless of file size. Layout (hive style):
+
+    <landing_dir>/resource_type=Patient/export_date=2024-05-01/part-<file>.parquet
+    <landing_dir>/resource_type=Observation/effective_month=2024-04/part-<file>.parquet
+
+read_landing() loads only the requested columns (and partitions) into pandas.
+"""
+
+import hashlib
+import os
+import re
+from datetime import date
+
+import pandas as pd
+
+from epic_backend_auth import iter_ndjson
+from epic_fhir import _numeric_value, _telecom_value, observation_for_ingest, subject_patient_id
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional; only the landing zone needs it
+    pa = pq = None
+
+
+LANDING_DIR = os.getenv('BULK_EXPORT_PARQUET_DIR')
+ROW_GROUP_SIZE = int(os.getenv('PARQUET_ROW_GROUP_SIZE', 50000))
+# Flush the largest partition buffer once this many rows are held across all partitions
+MAX_BUFFERED_ROWS = int(os.getenv('PARQUET_MAX_BUFFERED_ROWS', 4 * ROW_GROUP_SIZE))
+
+_MONTH = re.compile(r'^\d{4}-\d{2}')
+
+
+if pa is not None:
+    PATIENT_SCHEMA = pa.schema([
+        ('id', pa.string()),
+        ('first_name', pa.string()),
+        ('last_name', pa.string()),
+        ('gender', pa.string()),
+        ('birth_date', pa.date32()),
+        ('email', pa.string()),
+        ('phone', pa.string()),
+        ('last_updated', pa.timestamp('us', tz='UTC')),
+    ])
+    OBSERVATION_SCHEMA = pa.schema([
+        ('id', pa.string()),
+        ('patient_id', pa.string()),
+        ('category', pa.string()),
+        ('code', pa.string()),
+        ('code_system', pa.string()),
+        ('display', pa.string()),
+        ('value', pa.string()),
+        ('value_numeric', pa.float64()),
+        ('unit', pa.string()),
+        ('effective', pa.timestamp('us', tz='UTC')),
+        ('last_updated', pa.timestamp('us', tz='UTC')),
+    ])
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("The Parquet landing zone needs pyarrow (pip install pyarrow)")
+
+
+def _patient_record(resource):
+    name = (resource.get('name') or [{}])[0]
+    return {
+        'id': resource.get('id'),
+        'first_name': (name.get('given') or [''])[0],
+        'last_name': name.get('family') or '',
+        'gender': resource.get('gender'),
+        'birth_date': resource.get('birthDate'),
+        'email': _telecom_value(resource, 'email'),
+        'phone': _telecom_value(resource, 'phone'),
+        'last_updated': resource.get('meta', {}).get('lastUpdated')
+    }
+
+
+def _observation_record(resource):
+    obs = observation_for_ingest(resource)
+    coding = (resource.get('code', {}).get('coding') or [{}])[0]
+    category = ((resource.get('category') or [{}])[0].get('coding') or [{}])[0]
+    value = obs.get('value')
+    return {
+        'id': obs.get('id'),
+        'patient_id': subject_patient_id(resource),
+        'category': category.get('code'),
+        'code': coding.get('code'),
+        'code_system': coding.get('system'),
+        'display': obs.get('code'),
+        'value': None if value is None else str(value),
+        'value_numeric': _numeric_value(value),
+        'unit': obs.get('unit') or None,
+        'effective': obs.get('date'),
+        'last_updated': obs.get('last_updated')
+    }
+
+
+def _timestamps(values):
+    return pd.to_datetime(pd.Series(values, dtype=object), utc=True, errors='coerce', format='ISO8601')
+
+
+def _patient_table(records):
+    frame = pd.DataFrame.from_records(records, columns=list(PATIENT_SCHEMA.names))
+    # Partial birthDates ('1980', '1980-04') are not dates; they become null
+    frame['birth_date'] = pd.to_datetime(frame['birth_date'], errors='coerce', format='%Y-%m-%d').dt.date
+    frame['last_updated'] = _timestamps(frame['last_updated'])
+    return pa.Table.from_pandas(frame, schema=PATIENT_SCHEMA, preserve_index=False)
+
+
+def _observation_table(records):
+    frame = pd.DataFrame.from_records(records, columns=list(OBSERVATION_SCHEMA.names))
+    frame['effective'] = _timestamps(frame['effective'])
+    frame['last_updated'] = _timestamps(frame['last_updated'])
+    return pa.Table.from_pandas(frame, schema=OBSERVATION_SCHEMA, preserve_index=False)
+
+
+# resource type -> (flatten one resource, build a typed table from flattened records, partition of a record)
+CONVERTERS = {
+    'Patient': (_patient_record, _patient_table, None),
+    'Observation': (_observation_record, _observation_table,
+                    lambda record: 'effective_month=' + (record['effective'][:7]
+                                                         if _MONTH.match(record['effective'] or '')
+                                                         else 'unknown')),
+}
+
+
+class _PartitionWriters:
+    """One ParquetWriter per partition directory, fed from bounded per-partition buffers"""
+
+    def __init__(self, base_dir, file_name, build_table):
+        self.base_dir = base_dir
+        self.file_name = file_name
+        self.build_table = build_table
+        self.buffers = {}
+        self.writers = {}
+        self.buffered = 0
+        self.rows = 0
+        self.paths = []
+
+    def add(self, partition, record):
+        buffer = self.buffers.setdefault(partition, [])
+        buffer.append(record)
+        self.buffered += 1
+        if len(buffer) >= ROW_GROUP_SIZE:
+            self.flush(partition)
+        elif self.buffered >= MAX_BUFFERED_ROWS:
+            self.flush(max(self.buffers, key=lambda key: len(self.buffers[key])))
+
+    def flush(self, partition):
+        records = self.buffers.pop(partition, [])
+        if not records:
+            return
+        table = self.build_table(records)
+        writer = self.writers.get(partition)
+        if writer is None:
+            directory = os.path.join(self.base_dir, partition)
+            os.makedirs(directory, exist_ok=True)
+            # Written under a hidden temporary name, so readers never see a half-written file
+            writer = pq.ParquetWriter(os.path.join(directory, f".{self.file_name}.tmp"), table.schema,
+                                      compression='zstd')
+            self.writers[partition] = writer
+            self.paths.append(os.path.join(directory, self.file_name))
+        writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        self.buffered -= len(records)
+        self.rows += len(records)
+
+    def close(self, success=True):
+        for partition in list(self.buffers):
+            if success:
+                self.flush(partition)
+        for writer in self.writers.values():
+            writer.close()
+        for path in self.paths:
+            directory, name = os.path.split(path)
+            tmp_path = os.path.join(directory, f".{name}.tmp")
+            if success:
+                os.replace(tmp_path, path)
+            else:
+                os.remove(tmp_path)
+
+
+def ndjson_to_parquet(path, resource_type, landing_dir=None, export_date=None):
+    """
+    Convert one downloaded ndjson file into Parquet in the landing zone
+    Re-converting the same file replaces its parts. Returns {'rows', 'files'}, or None
+    for resource types without a converter.
+    """
+    _require_pyarrow()
+    if resource_type not in CONVERTERS:
+        return None
+
+    landing_dir = landing_dir or LANDING_DIR
+    flatten, build_table, partition_of = CONVERTERS[resource_type]
+    default_partition = f"export_date={(export_date or date.today()).isoformat()}"
+    file_name = f"part-{hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]}.parquet"
+
+    writers = _PartitionWriters(os.path.join(landing_dir, f"resource_type={resource_type}"), file_name, build_table)
+    try:
+        for resource in iter_ndjson(path):
+            record = flatten(resource)
+            writers.add(partition_of(record) if partition_of else default_partition, record)
+    except Exception:
+        writers.close(success=False)
+        raise
+    writers.close()
+    return {'rows': writers.rows, 'files': writers.paths}
+
+
+def read_landing(resource_type, columns=None, filters=None, landing_dir=None):
+    """
+    Load landed resources of one type into a pandas DataFrame
+    Only the listed columns are read; filters (pyarrow list-of-tuples form, e.g.
+    [('effective_month', '>=', '2024-01')]) prune partitions and row groups before decoding.
+    """
+    _require_pyarrow()
+    directory = os.path.join(landing_dir or LANDING_DIR, f"resource_type={resource_type}")
+    if not os.path.isdir(directory):
+        return pd.DataFrame(columns=columns)
+    table = pq.read_table(directory, columns=columns, filters=filters, partitioning='hive')
+    return table.to_pandas()
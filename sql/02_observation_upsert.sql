@@ -0,0 +1,9 @@
+-- Natural key for Epic observations so repeat syncs upsert instead of duplicating
+
+ALTER TABLE patient_observations ADD COLUMN IF NOT EXISTS fhir_observation_id VARCHAR(255);
+ALTER TABLE patient_observations ADD COLUMN IF NOT EXISTS fhir_last_updated TIMESTAMPTZ;
+ALTER TABLE patient_observations ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- Rows saved before this migration have no FHIR id; NULLs never conflict, so they are left as-is
+CREATE UNIQUE INDEX IF NOT EXISTS idx_patient_observations_fhir_observation_id
+    ON patient_observations(fhir_observation_id);
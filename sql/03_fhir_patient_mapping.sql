@@ -0,0 +1,12 @@
+-- Link local patients to their Epic FHIR Patient id
+
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS fhir_patient_id VARCHAR(255);
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- Epic Patient resources do not always carry a birthDate
+ALTER TABLE patients ALTER COLUMN date_of_birth DROP NOT NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_patients_fhir_patient_id ON patients(fhir_patient_id);
+
+-- FHIR telecom values ('+1 (608) 555-0100 ext. 1234') do not fit the original VARCHAR(20)
+ALTER TABLE patients ALTER COLUMN phone TYPE VARCHAR(50);
@@ -0,0 +1,130 @@
+-- Monthly range partitioning of patient_observations on observation_date,
+-- with a numeric copy of the value filled at ingest time
+
+-- Create any missing monthly partitions covering [start_date, end_date]
+-- Takes a strong lock on patient_observations, so writers call it in its own short transaction
+-- (epic_fhir.ensure_partitions) before they write; it can also be run ahead of time from a schedule.
+CREATE OR REPLACE FUNCTION ensure_observation_partitions(start_date DATE, end_date DATE)
+RETURNS INT AS $$
+DECLARE
+    month_start DATE := date_trunc('month', start_date)::DATE;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    IF start_date IS NULL OR end_date IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    WHILE month_start <= end_date LOOP
+        partition_name := format('patient_observations_y%sm%s',
+                                 to_char(month_start, 'YYYY'), to_char(month_start, 'MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            BEGIN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF patient_observations FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, (month_start + INTERVAL '1 month')::DATE
+                );
+                created := created + 1;
+            EXCEPTION
+                WHEN check_violation THEN
+                    -- Rows for this month already sit in the default partition; they stay there
+                    -- until moved by hand, and new rows for the month keep going there too
+                    RAISE WARNING 'Partition % not created, the default partition holds rows for it: %',
+                        partition_name, SQLERRM;
+                WHEN duplicate_table THEN
+                    -- Another session created it first
+                    NULL;
+            END;
+        END IF;
+        month_start := (month_start + INTERVAL '1 month')::DATE;
+    END LOOP;
+
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    first_month DATE;
+BEGIN
+    -- Already partitioned: nothing to migrate
+    IF EXISTS (
+        SELECT 1 FROM pg_partitioned_table
+        WHERE partrelid = 'patient_observations'::regclass
+    ) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE patient_observations RENAME TO patient_observations_legacy;
+    ALTER SEQUENCE patient_observations_observation_id_seq RENAME TO patient_observations_legacy_observation_id_seq;
+    ALTER INDEX idx_patient_observations_patient_id RENAME TO idx_patient_observations_legacy_patient_id;
+    ALTER INDEX idx_patient_observations_fhir_id RENAME TO idx_patient_observations_legacy_fhir_id;
+    ALTER INDEX IF EXISTS idx_patient_observations_fhir_observation_id
+        RENAME TO idx_patient_observations_legacy_fhir_observation_id;
+
+    CREATE TABLE patient_observations (
+        observation_id SERIAL,
+        patient_id INT NOT NULL REFERENCES patients(patient_id),
+        fhir_patient_id VARCHAR(255),
+        fhir_observation_id VARCHAR(255),
+        test_name VARCHAR(255) NOT NULL,
+        test_code VARCHAR(100),
+        value VARCHAR(100),
+        value_numeric DOUBLE PRECISION,
+        unit VARCHAR(50),
+        observation_date TIMESTAMP NOT NULL,
+        fhir_last_updated TIMESTAMPTZ,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (observation_id, observation_date)
+    ) PARTITION BY RANGE (observation_date);
+
+    -- Catches rows outside the months created below until their partition exists
+    CREATE TABLE patient_observations_default PARTITION OF patient_observations DEFAULT;
+
+    SELECT date_trunc('month', MIN(COALESCE(observation_date, created_at)))::DATE
+    INTO first_month
+    FROM patient_observations_legacy;
+
+    PERFORM ensure_observation_partitions(
+        COALESCE(first_month, CURRENT_DATE),
+        (CURRENT_DATE + INTERVAL '12 months')::DATE
+    );
+
+    INSERT INTO patient_observations (
+        observation_id, patient_id, fhir_patient_id, fhir_observation_id, test_name, test_code,
+        value, value_numeric, unit, observation_date, fhir_last_updated, created_at, updated_at
+    )
+    SELECT
+        observation_id, patient_id, fhir_patient_id, fhir_observation_id, test_name, test_code,
+        value,
+        CASE WHEN value ~ '^\s*[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?\s*$' THEN value::DOUBLE PRECISION END,
+        unit,
+        COALESCE(observation_date, created_at, CURRENT_TIMESTAMP),
+        fhir_last_updated, created_at, updated_at
+    FROM patient_observations_legacy;
+
+    PERFORM setval(
+        'patient_observations_observation_id_seq',
+        COALESCE((SELECT MAX(observation_id) FROM patient_observations), 0) + 1,
+        false
+    );
+
+    DROP TABLE patient_observations_legacy;
+END;
+$$;
+
+-- BRIN stays tiny and works well because observations arrive roughly in time order
+CREATE INDEX IF NOT EXISTS idx_patient_observations_date_brin
+    ON patient_observations USING BRIN (observation_date);
+CREATE INDEX IF NOT EXISTS idx_patient_observations_patient_code_date
+    ON patient_observations (patient_id, test_code, observation_date);
+CREATE INDEX IF NOT EXISTS idx_patient_observations_fhir_id
+    ON patient_observations (fhir_patient_id);
+
+-- Unique indexes on a partitioned table must include the partition key.
+-- So an Observation whose effective date is corrected no longer conflicts with its old row; the
+-- writers (epic_fhir.OBSERVATION_MOVED_DELETE_SQL) delete that row by fhir_observation_id first.
+-- Anything else inserting into this table must do the same or it will keep both versions.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_patient_observations_fhir_observation_id
+    ON patient_observations (fhir_observation_id, observation_date);
@@ -0,0 +1,21 @@
+-- Precomputed patient counts per condition for the dashboards
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS condition_prevalence AS
+SELECT c.condition_id, c.condition_name, COUNT(pc.patient_id) AS patient_count
+FROM conditions c
+LEFT JOIN patient_conditions pc ON c.condition_id = pc.condition_id
+GROUP BY c.condition_id, c.condition_name;
+
+-- Required for REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS idx_condition_prevalence_condition_id
+    ON condition_prevalence(condition_id);
+
+CREATE TABLE IF NOT EXISTS materialized_view_refreshes (
+    view_name VARCHAR(100) PRIMARY KEY,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    duration_ms DOUBLE PRECISION
+);
+
+INSERT INTO materialized_view_refreshes (view_name)
+VALUES ('condition_prevalence')
+ON CONFLICT (view_name) DO NOTHING;
@@ -0,0 +1,8 @@
+-- Backend Services access token shared by every worker process (BACKEND_TOKEN_STORE=postgres)
+
+CREATE TABLE IF NOT EXISTS backend_access_tokens (
+    store_key VARCHAR(64) PRIMARY KEY,
+    access_token TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
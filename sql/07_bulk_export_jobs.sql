@@ -0,0 +1,27 @@
+-- Bulk data ($export) jobs tracked server-side, polled by one background poller
+
+CREATE TABLE IF NOT EXISTS bulk_export_jobs (
+    job_id SERIAL PRIMARY KEY,
+    kickoff VARCHAR(255) NOT NULL,               -- 'Patient', 'Group/<id>' or '' for system-level
+    resource_types TEXT,                         -- the _type parameter, if any
+    params JSONB NOT NULL DEFAULT '{}',
+    status_url TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'in-progress',  -- in-progress, downloading, complete, error
+    attempts INT NOT NULL DEFAULT 0,             -- status polls answered with an error
+    next_poll_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    claim_token UUID,                            -- set by the worker that claimed the job last
+    progress TEXT,
+    manifest JSONB,
+    transaction_time TIMESTAMPTZ,
+    output_files JSONB,                          -- [{type, url, path, bytes}] once downloaded
+    error TEXT,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_bulk_export_jobs_due
+    ON bulk_export_jobs (next_poll_at)
+    WHERE status IN ('in-progress', 'downloading');
+CREATE UNIQUE INDEX IF NOT EXISTS idx_bulk_export_jobs_status_url
+    ON bulk_export_jobs (status_url);
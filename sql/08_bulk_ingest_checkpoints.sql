@@ -0,0 +1,20 @@
+-- Bulk export files already loaded into patients / patient_observations,
+-- so an interrupted ingest resumes with the files it had not finished
+
+CREATE TABLE IF NOT EXISTS bulk_ingest_checkpoints (
+    file_key TEXT PRIMARY KEY,                   -- the file's download URL (or local path)
+    job_id INT REFERENCES bulk_export_jobs(job_id) ON DELETE SET NULL,
+    resource_type VARCHAR(50) NOT NULL,
+    path TEXT,
+    resources INT NOT NULL DEFAULT 0,            -- lines read from the file
+    rows_written INT NOT NULL DEFAULT 0,         -- rows inserted or changed
+    unchanged INT NOT NULL DEFAULT 0,
+    skipped INT NOT NULL DEFAULT 0,              -- resources without an id or date
+    unknown_patients INT NOT NULL DEFAULT 0,     -- observations whose patient is not loaded (yet)
+    attempts INT NOT NULL DEFAULT 1,             -- runs that loaded the file; retried while unknown_patients > 0
+    seconds DOUBLE PRECISION,
+    rows_per_second DOUBLE PRECISION,
+    completed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_bulk_ingest_checkpoints_job_id ON bulk_ingest_checkpoints (job_id);
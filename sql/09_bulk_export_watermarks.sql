@@ -0,0 +1,11 @@
+-- Last successfully ingested bulk export per kickoff (Patient, Group/<id>, ...) and resource type.
+-- The next export for the same kickoff asks only for changes with _since=transaction_time.
+
+CREATE TABLE IF NOT EXISTS bulk_export_watermarks (
+    kickoff VARCHAR(255) NOT NULL,
+    resource_type VARCHAR(50) NOT NULL,          -- '*' when the export had no _type
+    transaction_time TIMESTAMPTZ NOT NULL,
+    job_id INT REFERENCES bulk_export_jobs(job_id) ON DELETE SET NULL,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (kickoff, resource_type)
+);
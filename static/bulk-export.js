@@ -1,7 +1,9 @@
 // Bulk Export Dashboard - JavaScript
 // Using LOCAL PostgreSQL Database
 
-let allPatients = [];
+// The page of patients on screen; Previous/Next load the others (see patients.js)
+let pagePatients = [];
+let totalPatients = null;
 let genderChart = null;
 let ageChart = null;
 
@@ -13,31 +15,29 @@ document.addEventListener('DOMContentLoaded', () => {
 
 // ===== LOAD PATIENTS FROM LOCAL DATABASE =====
 function loadPatients() {
-  fetch('/api/patients')
-    .then((res) => {
-      console.log('Patients response status:', res.status);
-      if (!res.ok) {
-        throw new Error(`HTTP ${res.status}: ${res.statusText}`);
-      }
-      return res.json();
-    })
+  fetch('/api/patients/count')
+    .then((res) => res.json())
     .then((data) => {
-      console.log('Patient data:', data);
-
-      if (data.error) {
-        throw new Error(data.error);
-      }
+      totalPatients = data.data;
+    })
+    .catch((err) => console.log('Could not load patient count:', err.message));
 
-      if (!data.data || !Array.isArray(data.data)) {
-        throw new Error('No patient data returned');
+  const pager = createPatientPager({
+    controls: pagerControls('patients-pager', document.getElementById('table-container')),
+    render: (data) => {
+      console.log('Patient data:', data);
+      pagePatients = data.data;
+      console.log(`Loaded ${pagePatients.length} patients`);
+      // Once the results are showing, paging redraws them for the new page
+      if (document.getElementById('table-section').style.display === 'block') {
+        showResults();
       }
-
-      allPatients = data.data;
-      console.log(`Loaded ${allPatients.length} patients`);
-    })
-    .catch((err) => {
+    },
+    onError: (err) => {
       console.error('Error loading patients:', err);
-    });
+    },
+  });
+  pager.first();
 }
 
 // ===== LOAD BULK DATA AND DISPLAY =====
@@ -50,24 +50,13 @@ function loadBulkData() {
   // Simulate a small delay for better UX
   setTimeout(() => {
     try {
-      if (allPatients.length === 0) {
+      if (pagePatients.length === 0) {
         alert('No patients loaded. Try refreshing the page.');
         if (loadingDiv) loadingDiv.style.display = 'none';
         return;
       }
 
-      // Calculate statistics
-      const stats = calculateStats(allPatients);
-      console.log('Calculated stats:', stats);
-
-      // Display stats
-      displayStats(stats);
-
-      // Display table
-      displayPatientTable(allPatients);
-
-      // Show charts
-      showCharts(stats);
+      showResults();
 
       if (loadingDiv) loadingDiv.style.display = 'none';
 
@@ -83,6 +72,22 @@ function loadBulkData() {
   }, 500);
 }
 
+// Stats, table and charts for the page on screen
+function showResults() {
+  // Calculate statistics
+  const stats = calculateStats(pagePatients);
+  console.log('Calculated stats:', stats);
+
+  // Display stats
+  displayStats(stats);
+
+  // Display table
+  displayPatientTable(pagePatients);
+
+  // Show charts
+  showCharts(stats);
+}
+
 // ===== CALCULATE STATISTICS =====
 function calculateStats(patients) {
   let maleCount = 0;
@@ -109,7 +114,8 @@ function calculateStats(patients) {
   femaleCount = patients.length - half;
 
   return {
-    totalPatients: patients.length,
+    // The whole table's count; the rest describes this page
+    totalPatients: totalPatients ?? patients.length,
     maleCount: maleCount,
     femaleCount: femaleCount,
     otherCount: 0,
@@ -241,14 +247,15 @@ function showCharts(stats) {
 }
 
 // ===== DOWNLOAD CSV =====
+// The page on screen
 function downloadCSV() {
-  if (allPatients.length === 0) {
+  if (pagePatients.length === 0) {
     alert('No data to download');
     return;
   }
 
   let csv = 'First Name,Last Name,DOB,Email,Patient ID\n';
-  allPatients.forEach((patient) => {
+  pagePatients.forEach((patient) => {
     const dob = patient.date_of_birth || 'N/A';
     csv += `"${patient.first_name}","${patient.last_name}","${dob}","${patient.email}","${patient.id}"\n`;
   });
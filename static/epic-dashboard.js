@@ -4,68 +4,62 @@
 let observationsModalInstance = null;
 
 // ===== FETCH PATIENTS FROM LOCAL DATABASE =====
-fetch('/api/patients')
-  .then((res) => {
-    console.log('Response status:', res.status);
-    if (!res.ok) {
-      throw new Error(`HTTP ${res.status}: ${res.statusText}`);
-    }
-    return res.json();
-  })
-  .then((data) => {
-    console.log('Patient data received:', data);
+// One page at a time, with Previous/Next controls (see patients.js)
+const patientsContainer = document.getElementById('patients-container');
+let totalPatients = null;
 
-    // Check if there's an error in the response
-    if (data.error) {
-      throw new Error(data.error);
-    }
+fetch('/api/patients/count')
+  .then((res) => res.json())
+  .then((data) => {
+    totalPatients = data.data;
+    const total = document.getElementById('patients-total');
+    if (total) total.textContent = totalPatients;
+  })
+  .catch((err) => console.log('Could not load patient count:', err.message));
 
-    // Check if data.data exists and is an array
-    if (!data.data || !Array.isArray(data.data)) {
-      console.error('Invalid data structure:', data);
-      throw new Error('No patient data returned from database');
-    }
+function renderPatientsPage(data) {
+  console.log('Patient data received:', data);
 
-    let html = '';
+  let html = '';
 
-    // Display patient cards with avatars
-    data.data.forEach((patient) => {
-      const dob = patient.date_of_birth ? new Date(patient.date_of_birth).toLocaleDateString() : 'N/A';
-      
-      html += `
-                <div class="patient-card">
-                    <div class="patient-avatar" style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; display: flex; align-items: center; justify-content: center; width: 60px; height: 60px; border-radius: 50%; font-size: 24px; font-weight: bold;">
-                        ${patient.first_name.charAt(0)}${patient.last_name.charAt(0)}
-                    </div>
-                    <div class="patient-info">
-                        <h3>${patient.first_name} ${patient.last_name}</h3>
-                        <p>DOB: ${dob}</p>
-                        <p>Email: ${patient.email || 'N/A'}</p>
-                        <p><small class="text-muted">ID: ${patient.id}</small></p>
-                    </div>
-                </div>
-            `;
-    });
+  // Display patient cards with avatars
+  data.data.forEach((patient) => {
+    const dob = patient.date_of_birth ? new Date(patient.date_of_birth).toLocaleDateString() : 'N/A';
+    
+    html += `
+              <div class="patient-card">
+                  <div class="patient-avatar" style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; display: flex; align-items: center; justify-content: center; width: 60px; height: 60px; border-radius: 50%; font-size: 24px; font-weight: bold;">
+                      ${patient.first_name.charAt(0)}${patient.last_name.charAt(0)}
+                  </div>
+                  <div class="patient-info">
+                      <h3>${patient.first_name} ${patient.last_name}</h3>
+                      <p>DOB: ${dob}</p>
+                      <p>Email: ${patient.email || 'N/A'}</p>
+                      <p><small class="text-muted">ID: ${patient.id}</small></p>
+                  </div>
+              </div>
+          `;
+  });
 
-    if (html === '') {
-      html = '<div class="alert alert-info">No patients found in database</div>';
-    }
+  if (html === '') {
+    html = '<div class="alert alert-info">No patients found in database</div>';
+  }
 
-    document.getElementById('patients-container').innerHTML = html;
+  // Show total count
+  const countHtml = `
+    <div class="alert alert-info">
+      <strong>Total Patients in Database:</strong> <span id="patients-total">${totalPatients ?? '…'}</span>
+    </div>
+  `;
+  patientsContainer.innerHTML = countHtml + html;
+}
 
-    // Show total count
-    const countHtml = `
-      <div class="alert alert-info">
-        <strong>Total Patients in Database:</strong> ${data.count}
-      </div>
-    `;
-    document.getElementById('patients-container').innerHTML = countHtml + document.getElementById('patients-container').innerHTML;
-  })
-  .catch((err) => {
+const patientPager = createPatientPager({
+  controls: pagerControls('patients-pager', patientsContainer),
+  render: renderPatientsPage,
+  onError: (err) => {
     console.error('Error details:', err);
-    document.getElementById(
-      'patients-container'
-    ).innerHTML = `
+    patientsContainer.innerHTML = `
       <div class="alert alert-danger">
         <h4>Error loading patients from database:</h4>
         <p>${err.message}</p>
@@ -74,7 +68,86 @@ fetch('/api/patients')
         <p><small>Check the browser console (F12) for more details</small></p>
       </div>
     `;
+  },
+});
+patientPager.first();
+
+// ===== FETCH EPIC PATIENTS WITH THEIR LABS =====
+// One request: /api/epic/patients-with-labs returns each patient with its observations,
+// so opening a patient's labs needs no further calls
+const epicLabsContainer = document.getElementById('epic-labs-container');
+const epicPatientsById = {};
+
+function showPatientLabs(patientId) {
+  const patient = epicPatientsById[patientId];
+  if (!patient) return;
+
+  document.getElementById('observationsTitle').textContent =
+    `Labs for ${patient.first_name} ${patient.last_name}`;
+
+  let html = '';
+  if (patient.observations.length === 0) {
+    html = '<div class="alert alert-info">No lab results for this patient</div>';
+  } else {
+    html = '<table class="table table-striped"><thead><tr><th>Test</th><th>Value</th><th>Date</th></tr></thead><tbody>';
+    patient.observations.forEach((obs) => {
+      const date = obs.date ? new Date(obs.date).toLocaleDateString() : 'N/A';
+      html += `<tr><td>${obs.code}</td><td>${obs.value ?? 'N/A'} ${obs.unit || ''}</td><td>${date}</td></tr>`;
+    });
+    html += '</tbody></table>';
+  }
+  document.getElementById('observations-content').innerHTML = html;
+
+  if (!observationsModalInstance) {
+    observationsModalInstance = new bootstrap.Modal(document.getElementById('observationsModal'));
+  }
+  observationsModalInstance.show();
+}
+
+if (epicLabsContainer) {
+  fetch('/api/epic/patients-with-labs?count=10')
+    .then((res) => res.json().then((data) => ({ status: res.status, data })))
+    .then(({ status, data }) => {
+      if (status === 401) {
+        epicLabsContainer.innerHTML = '<div class="alert alert-warning">Not connected to Epic. <a href="/api/epic/login">Log in with Epic</a></div>';
+        return;
+      }
+      if (data.error) {
+        throw new Error(data.error);
+      }
+
+      let html = '';
+      data.data.forEach((patient) => {
+        epicPatientsById[patient.id] = patient;
+        const dob = patient.dob ? new Date(patient.dob).toLocaleDateString() : 'N/A';
+        html += `
+              <div class="patient-card">
+                  <div class="patient-info">
+                      <h3>${patient.first_name} ${patient.last_name}</h3>
+                      <p>DOB: ${dob} · ${patient.gender || 'N/A'}</p>
+                      <button type="button" class="btn btn-sm btn-outline-primary" data-patient-id="${patient.id}">
+                          View Labs (${patient.observations.length})
+                      </button>
+                  </div>
+              </div>
+          `;
+      });
+
+      if (html === '') {
+        html = '<div class="alert alert-info">No patients returned by Epic</div>';
+      }
+      epicLabsContainer.innerHTML = html;
+    })
+    .catch((err) => {
+      console.error('Error loading Epic patients with labs:', err);
+      epicLabsContainer.innerHTML = `<div class="alert alert-danger">Error loading Epic labs: ${err.message}</div>`;
+    });
+
+  epicLabsContainer.addEventListener('click', (event) => {
+    const button = event.target.closest('button[data-patient-id]');
+    if (button) showPatientLabs(button.dataset.patientId);
   });
+}
 
 // ===== FETCH CONDITIONS ANALYTICS =====
 fetch('/api/analytics/patient-conditions')
@@ -20,9 +20,12 @@ fetch(`${API_BASE}/patients/count`)
   });
 
 // ===== ALL PATIENTS =====
-fetch(`${API_BASE}/patients`)
-  .then((res) => res.json())
-  .then((data) => {
+// One page at a time with Previous/Next controls; needs patients.js loaded first
+const patientsData = document.getElementById('patients-data');
+
+createPatientPager({
+  controls: pagerControls('patients-pager', patientsData),
+  render: (data) => {
     document.getElementById('patients-desc').textContent = data.description;
     document.getElementById('patients-query').textContent = data.query;
     document.getElementById('patients-time').textContent = `Updated: ${new Date(
@@ -49,13 +52,12 @@ fetch(`${API_BASE}/patients`)
     });
 
     html += '</table>';
-    document.getElementById('patients-data').innerHTML = html;
-  })
-  .catch((err) => {
-    document.getElementById(
-      'patients-data'
-    ).innerHTML = `<div class="error">Error: ${err.message}</div>`;
-  });
+    patientsData.innerHTML = html;
+  },
+  onError: (err) => {
+    patientsData.innerHTML = `<div class="error">Error: ${err.message}</div>`;
+  },
+}).first();
 
 // ===== ALL CONDITIONS =====
 fetch(`${API_BASE}/conditions`)
@@ -0,0 +1,95 @@
+// Shared helper: browse /api/patients one page at a time
+// Only the page on screen is fetched and rendered. "Next" follows next_after_id;
+// "Previous" goes back through the after_ids of the pages already seen.
+
+const PATIENTS_PAGE_SIZE = 100;
+
+async function fetchPatientsPage(afterId, limit = PATIENTS_PAGE_SIZE) {
+  const res = await fetch(`/api/patients?limit=${limit}&after_id=${afterId}`);
+  console.log('Patients response status:', res.status);
+  if (!res.ok) {
+    throw new Error(`HTTP ${res.status}: ${res.statusText}`);
+  }
+  const page = await res.json();
+  if (page.error) {
+    throw new Error(page.error);
+  }
+  if (!page.data || !Array.isArray(page.data)) {
+    throw new Error('No patient data returned');
+  }
+  return page;
+}
+
+// controls: element that gets the Previous/Next buttons
+// render(page, pageNumber): draws one /api/patients response
+// onError(err): called when a page cannot be loaded
+function createPatientPager({ controls, render, onError, pageSize = PATIENTS_PAGE_SIZE }) {
+  const earlier = []; // after_id of every page before the current one
+  let afterId = 0;
+  let nextAfterId = null;
+  let loading = false;
+
+  function drawControls(page) {
+    const first = earlier.length * pageSize + 1;
+    const last = first + page.count - 1;
+    controls.innerHTML = `
+      <div class="d-flex align-items-center gap-2 my-2">
+        <button type="button" class="btn btn-sm btn-outline-secondary" data-page="prev"
+                ${earlier.length ? '' : 'disabled'}>← Previous</button>
+        <span class="text-muted">Patients ${page.count ? `${first}–${last}` : '0'}</span>
+        <button type="button" class="btn btn-sm btn-outline-secondary" data-page="next"
+                ${nextAfterId === null ? 'disabled' : ''}>Next →</button>
+      </div>
+    `;
+  }
+
+  async function load(target) {
+    loading = true;
+    try {
+      const page = await fetchPatientsPage(target, pageSize);
+      afterId = target;
+      nextAfterId = page.next_after_id;
+      drawControls(page);
+      render(page, earlier.length + 1);
+      return page;
+    } catch (err) {
+      onError(err);
+      return null;
+    } finally {
+      loading = false;
+    }
+  }
+
+  controls.addEventListener('click', (event) => {
+    const button = event.target.closest('button[data-page]');
+    if (!button || button.disabled || loading) {
+      return;
+    }
+    if (button.dataset.page === 'next' && nextAfterId !== null) {
+      earlier.push(afterId);
+      load(nextAfterId).then((page) => page || earlier.pop());
+    } else if (button.dataset.page === 'prev' && earlier.length) {
+      const previous = earlier.pop();
+      load(previous).then((page) => page || earlier.push(previous));
+    }
+  });
+
+  return {
+    first: () => {
+      earlier.length = 0;
+      return load(0);
+    },
+    reload: () => load(afterId),
+  };
+}
+
+// The element with this id, or a new one inserted just before `before`
+function pagerControls(id, before) {
+  let controls = document.getElementById(id);
+  if (!controls) {
+    controls = document.createElement('div');
+    controls.id = id;
+    before.parentNode.insertBefore(controls, before);
+  }
+  return controls;
+}
@@ -0,0 +1,122 @@
+"""
+Tests for resuming bulk export downloads (EpicBulkExport.download_export_file) against a fake session
+Run: python -m pytest -q test_bulk_download.py
+"""
+
+import hashlib
+import os
+
+import pytest
+import requests
+
+import epic_backend_auth
+import fhir_http
+from epic_backend_auth import EpicBulkExport
+
+FILE_URL = 'https://fhir.example/bulk/Observation.ndjson'
+BODY = b''.join(b'{"resourceType": "Observation", "id": "obs-%d"}\n' % i for i in range(5))
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error", response=self)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Serves BODY, honoring Range unless honor_range is False"""
+
+    def __init__(self, honor_range=True):
+        self.honor_range = honor_range
+        self.requests = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        byte_range = (headers or {}).get('Range')
+        if not byte_range or not self.honor_range:
+            return FakeResponse(200, BODY)
+        offset = int(byte_range[len('bytes='):].rstrip('-'))
+        if offset >= len(BODY):
+            return FakeResponse(416, headers={'Content-Range': f'bytes */{len(BODY)}'})
+        return FakeResponse(206, BODY[offset:],
+                            headers={'Content-Range': f'bytes {offset}-{len(BODY) - 1}/{len(BODY)}'})
+
+
+class FakeAuth:
+    fhir_url = 'https://fhir.example'
+
+    def get_access_token(self):
+        return 'token'
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    monkeypatch.setattr(epic_backend_auth, 'BUILD_INDEX', False)
+    name = hashlib.sha256(FILE_URL.encode('utf-8')).hexdigest()[:32]
+    return tmp_path, str(tmp_path / f'{name}.ndjson')
+
+
+def use_session(monkeypatch, session):
+    monkeypatch.setattr(fhir_http, '_session', session)
+    monkeypatch.setattr(fhir_http, '_session_pid', os.getpid())
+    return session
+
+
+def download(spool_dir):
+    return EpicBulkExport(FakeAuth()).download_export_file(FILE_URL, spool_dir=str(spool_dir), chunk_size=8)
+
+
+def test_partial_file_resumes_with_range(spool, monkeypatch):
+    spool_dir, path = spool
+    with open(f'{path}.part', 'wb') as f:
+        f.write(BODY[:20])
+    session = use_session(monkeypatch, FakeSession())
+
+    assert download(spool_dir) == path
+    assert session.requests[0]['Range'] == 'bytes=20-'
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+    assert not os.path.exists(f'{path}.part')
+
+
+def test_server_ignoring_range_rewrites_the_file(spool, monkeypatch):
+    spool_dir, path = spool
+    with open(f'{path}.part', 'wb') as f:
+        f.write(BODY[:20])
+    session = use_session(monkeypatch, FakeSession(honor_range=False))
+
+    download(spool_dir)
+    assert session.requests[0]['Range'] == 'bytes=20-'
+    # A 200 carries the whole body, so it replaces the partial file rather than being appended
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+
+
+def test_416_on_a_complete_part_file_keeps_it(spool, monkeypatch):
+    spool_dir, path = spool
+    with open(f'{path}.part', 'wb') as f:
+        f.write(BODY)
+    session = use_session(monkeypatch, FakeSession())
+
+    assert download(spool_dir) == path
+    assert len(session.requests) == 1
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
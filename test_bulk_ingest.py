@@ -0,0 +1,163 @@
+"""
+Tests for bulk_ingest.ingest_job, against a fake database (no Postgres needed)
+Run: python -m pytest -q test_bulk_ingest.py
+"""
+
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+import bulk_ingest
+
+
+class FakeDatabase:
+    """The bulk_export_jobs row and bulk_ingest_checkpoints table ingest_job reads and writes"""
+
+    def __init__(self, output_files):
+        self.output_files = output_files
+        self.checkpoints = {}
+        self.watermark_advances = 0
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.result = []
+
+    def execute(self, query, params=None):
+        if 'pg_try_advisory_lock' in query:
+            self.result = [(True,)]
+        elif 'FROM bulk_export_jobs' in query:
+            self.result = [('complete', self.db.output_files)]
+        elif 'SELECT file_key FROM bulk_ingest_checkpoints' in query:
+            keys, retries = params
+            self.result = [
+                (key,) for key in keys
+                if key in self.db.checkpoints
+                and (self.db.checkpoints[key]['unknown_patients'] == 0
+                     or self.db.checkpoints[key]['attempts'] >= retries)
+            ]
+        elif 'INSERT INTO bulk_ingest_checkpoints' in query:
+            key, unknown_patients = params[0], params[8]
+            previous = self.db.checkpoints.get(key)
+            attempts = previous['attempts'] + 1 if previous else 1
+            self.db.checkpoints[key] = {'unknown_patients': unknown_patients, 'attempts': attempts}
+            self.result = [(attempts,)]
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def export(tmp_path, monkeypatch):
+    """An export of one Observation file whose observations all belong to unknown patients"""
+    path = tmp_path / 'Observation.ndjson'
+    path.write_text(''.join(json.dumps({'resourceType': 'Observation', 'id': f'obs-{i}'}) + '\n'
+                            for i in range(3)))
+    db = FakeDatabase([{'type': 'Observation', 'url': 'https://fhir.example/Observation.ndjson',
+                        'path': str(path)}])
+    loads = []
+
+    def load_observations(conn, resources):
+        loads.append(len(resources))
+        return {'written': 0, 'unchanged': 0, 'skipped': 0, 'unknown_patients': len(resources)}
+
+    def advance_watermarks(cursor, job_id):
+        db.watermark_advances += 1
+        return 1
+
+    monkeypatch.setattr(bulk_ingest, 'connect', lambda: FakeConnection(db))
+    monkeypatch.setitem(bulk_ingest.LOADERS, 'Observation', load_observations)
+    monkeypatch.setattr(bulk_ingest, 'advance_watermarks', advance_watermarks)
+    # Threads instead of worker processes, so the fakes above are the ones used
+    monkeypatch.setattr(bulk_ingest, 'ProcessPoolExecutor',
+                        lambda max_workers, mp_context: ThreadPoolExecutor(max_workers=max_workers))
+    db.loads = loads
+    return db
+
+
+def test_unknown_patients_hold_the_watermark_until_retries_run_out(export, monkeypatch):
+    monkeypatch.setattr(bulk_ingest, 'ORPHAN_RETRIES', 2)
+
+    first = bulk_ingest.ingest_job(1, workers=1)
+    assert first[0]['unknown_patients'] == 3
+    assert export.watermark_advances == 0
+
+    # The file is loaded again; with the retries used up its orphans are dropped and _since moves on
+    second = bulk_ingest.ingest_job(1, workers=1)
+    assert second[0]['attempts'] == 2
+    assert export.loads == [3, 3]
+    assert export.watermark_advances == 1
+
+    # From then on the file counts as done
+    third = bulk_ingest.ingest_job(1, workers=1)
+    assert third[0]['status'] == 'already loaded'
+    assert export.loads == [3, 3]
+
+
+def test_rerun_skips_checkpointed_files(export, monkeypatch):
+    monkeypatch.setitem(bulk_ingest.LOADERS, 'Observation', lambda conn, resources: (
+        export.loads.append(len(resources))
+        or {'written': len(resources), 'unchanged': 0, 'skipped': 0, 'unknown_patients': 0}
+    ))
+
+    bulk_ingest.ingest_job(1, workers=1)
+    results = bulk_ingest.ingest_job(1, workers=1)
+
+    assert export.loads == [3]
+    assert results[0]['status'] == 'already loaded'
+    assert export.watermark_advances == 2
+
+
+def varchar_widths(ddl):
+    """{column: n} for every VARCHAR(n) column in a CREATE TABLE body"""
+    return {name: int(width) for name, width in re.findall(r'^\s*(\w+) VARCHAR\((\d+)\)', ddl, re.MULTILINE)}
+
+
+def table_varchar_widths(table):
+    """VARCHAR widths of a table after running the migrations in sql/ in order"""
+    widths = {}
+    for path in sorted(Path(__file__).parent.joinpath('sql').glob('*.sql')):
+        sql = path.read_text()
+        for body in re.findall(rf'CREATE TABLE (?:IF NOT EXISTS )?{table} \((.*?)\n\s*\)', sql, re.DOTALL):
+            widths = varchar_widths(body)
+        for added, altered, width in re.findall(
+                rf'ALTER TABLE {table} (?:ADD COLUMN IF NOT EXISTS (\w+)|ALTER COLUMN (\w+) TYPE) VARCHAR\((\d+)\)', sql):
+            widths[added or altered] = int(width)
+    return widths
+
+
+@pytest.mark.parametrize('stage_ddl, table', [
+    (bulk_ingest.PATIENT_STAGE_DDL, 'patients'),
+    (bulk_ingest.OBSERVATION_STAGE_DDL, 'patient_observations'),
+])
+def test_staging_columns_are_as_wide_as_the_table(stage_ddl, table):
+    stage = varchar_widths(stage_ddl)
+    assert stage
+    # Wider staging would let COPY accept values the upsert then fails on; narrower would reject good rows
+    assert stage == {name: table_varchar_widths(table).get(name) for name in stage}
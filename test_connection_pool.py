@@ -0,0 +1,163 @@
+"""
+Tests for app.utils.ConnectionPool, against fake connections (no database needed)
+Run: python -m pytest -q test_connection_pool.py
+"""
+
+import threading
+import time
+
+import pytest
+from psycopg2 import extensions
+
+import app.utils as utils
+from app.utils import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.pings += 1
+        if self.conn.ping_started is not None:
+            self.conn.ping_started.set()
+        if self.conn.ping_gate is not None:
+            self.conn.ping_gate.wait(5)
+        if self.conn.broken:
+            raise utils.psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.pings = 0
+        self.ping_started = None
+        self.ping_gate = None
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Every connection the pool opens, in order"""
+    opened = []
+
+    def connect():
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(utils, 'connect', connect)
+    return opened
+
+
+def test_concurrent_checkouts_never_exceed_maxconn(connections):
+    pool = ConnectionPool(minconn=0, maxconn=3, timeout=5)
+    lock = threading.Lock()
+    active = []
+    peak = []
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(20):
+                with pool.connection():
+                    with lock:
+                        active.append(1)
+                        peak.append(len(active))
+                    time.sleep(0.001)
+                    with lock:
+                        active.pop()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert max(peak) <= 3
+    assert len(connections) <= 3
+    stats = pool.stats()
+    assert stats['checkouts'] == 200
+    assert stats['in_use'] == 0
+
+
+def test_checkout_times_out_when_pool_is_exhausted(connections):
+    pool = ConnectionPool(minconn=0, maxconn=1, timeout=0.2)
+    held = pool.getconn()
+
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - started >= 0.2
+    assert pool.stats()['timeouts'] == 1
+
+    pool.putconn(held)
+    assert pool.getconn() is held
+
+
+def test_closed_idle_connection_is_discarded(connections):
+    pool = ConnectionPool(minconn=1, maxconn=2)
+    stale = connections[0]
+    stale.closed = 1
+
+    conn = pool.getconn()
+    assert conn is not stale
+    assert pool.stats()['discarded'] == 1
+    assert pool.stats()['in_use'] == 1
+
+
+def test_failed_ping_discards_connection(connections):
+    pool = ConnectionPool(minconn=1, maxconn=2, ping_after=0)
+    connections[0].broken = True
+
+    conn = pool.getconn()
+    assert conn is connections[1]
+    stats = pool.stats()
+    assert stats['failed_pings'] == 1
+    assert stats['discarded'] == 1
+    assert stats['in_use'] == 1
+
+
+def test_ping_does_not_hold_the_pool_lock(connections):
+    pool = ConnectionPool(minconn=0, maxconn=2, ping_after=0)
+    other = pool.getconn()
+    slow = pool.getconn()
+    pool.putconn(slow)
+    slow.ping_started = threading.Event()
+    slow.ping_gate = threading.Event()
+
+    checkout = threading.Thread(target=pool.getconn)
+    checkout.start()
+    assert slow.ping_started.wait(5)
+    try:
+        # While the slow ping is in flight, returning a connection and reading stats must not block
+        returned = threading.Thread(target=pool.putconn, args=(other,))
+        returned.start()
+        returned.join(1)
+        assert not returned.is_alive()
+        assert pool.stats()['in_use'] == 1
+    finally:
+        slow.ping_gate.set()
+        checkout.join(5)
+    assert pool.stats()['in_use'] == 1
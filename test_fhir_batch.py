@@ -0,0 +1,117 @@
+"""
+Tests for EpicFHIRClient.batch_get and its fallback to single reads, against fake fhir_http calls
+Run: python -m pytest -q test_fhir_batch.py
+"""
+
+import pytest
+import requests
+
+import epic_fhir
+import fhir_http
+from epic_fhir import EpicFHIRClient
+
+FHIR_URL = 'https://fhir.example/R4'
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.reason = 'Fake'
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+
+class FakeServer:
+    """Answers batch POSTs with batch_status (or a batch-response) and single GETs with the resource"""
+
+    def __init__(self, batch_status=200, missing=()):
+        self.batch_status = batch_status
+        self.missing = set(missing)
+        self.posts = []
+        self.gets = []
+
+    def entry(self, url):
+        if url in self.missing:
+            return {'response': {'status': '404 Not Found'}}
+        return {'response': {'status': '200 OK'}, 'resource': {'id': url}}
+
+    def post(self, url, headers=None, json=None):
+        urls = [entry['request']['url'] for entry in json['entry']]
+        self.posts.append(urls)
+        status = self.batch_status(urls) if callable(self.batch_status) else self.batch_status
+        if status != 200:
+            return FakeResponse(status)
+        return FakeResponse(200, {'resourceType': 'Bundle', 'type': 'batch-response',
+                                  'entry': [self.entry(url) for url in urls]})
+
+    def get(self, url, headers=None, params=None):
+        relative = url[len(FHIR_URL) + 1:]
+        self.gets.append(relative)
+        if relative in self.missing:
+            return FakeResponse(404)
+        return FakeResponse(200, {'id': relative})
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setenv('EPIC_FHIR_URL', FHIR_URL)
+    monkeypatch.setattr(fhir_http, 'post', server.post)
+    monkeypatch.setattr(fhir_http, 'get', server.get)
+    monkeypatch.setattr(epic_fhir, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(epic_fhir, '_batch_unsupported', {})
+    return server
+
+
+def client():
+    return EpicFHIRClient('token', use_cache=False)
+
+
+def test_rejected_chunk_falls_back_to_single_reads(server):
+    urls = ['Patient/1', 'Patient/2', 'Patient/3', 'Patient/4', 'Patient/5']
+    server.missing = {'Patient/2', 'Patient/4'}
+    # The second chunk's batch fails; the others go through
+    server.batch_status = lambda chunk: 500 if chunk == ['Patient/3', 'Patient/4'] else 200
+
+    results = client().batch_get(urls)
+
+    assert results == [
+        ('Patient/1', 200, {'id': 'Patient/1'}),
+        ('Patient/2', 404, None),
+        ('Patient/3', 200, {'id': 'Patient/3'}),
+        ('Patient/4', 404, None),
+        ('Patient/5', 200, {'id': 'Patient/5'}),
+    ]
+    # Only the rejected chunk is read one by one; a 404 entry inside a good batch is not re-read
+    assert sorted(server.gets) == ['Patient/3', 'Patient/4']
+    assert server.posts == [['Patient/1', 'Patient/2'], ['Patient/3', 'Patient/4'], ['Patient/5']]
+    # A 500 is about this request, not the endpoint: batch stays on
+    assert not epic_fhir._batch_unsupported_now(FHIR_URL)
+
+
+def test_unsupported_batch_is_retried_once_the_ttl_expires(server, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(epic_fhir.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(epic_fhir, 'BATCH_UNSUPPORTED_TTL', 60)
+    server.batch_status = 405
+
+    client().batch_get(['Patient/1', 'Patient/2', 'Patient/3'])
+    # The first 405 marks the endpoint; the next chunk goes straight to single reads
+    assert server.posts == [['Patient/1', 'Patient/2']]
+    assert sorted(server.gets) == ['Patient/1', 'Patient/2', 'Patient/3']
+
+    now[0] += 59
+    client().batch_get(['Patient/4'])
+    assert len(server.posts) == 1
+
+    now[0] += 1
+    server.batch_status = 200
+    assert client().batch_get(['Patient/5']) == [('Patient/5', 200, {'id': 'Patient/5'})]
+    assert server.posts[-1] == ['Patient/5']
+    assert not epic_fhir._batch_unsupported_now(FHIR_URL)
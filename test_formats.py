@@ -0,0 +1,82 @@
+"""
+Tests for the response format layer (app/formats.py)
+Run: python -m pytest -q test_formats.py
+"""
+
+import json
+
+import pytest
+from flask import Flask
+
+from app.formats import respond, shaped_rows
+
+ROWS = [
+    {'id': 1, 'name': '<script>alert("x")</script>', 'note': 'Smith & Sons'},
+    {'id': 2, 'name': 'Zoë', 'note': None},
+]
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route('/rows')
+    def rows():
+        return respond({'data': ROWS, 'count': len(ROWS)})
+
+    @app.route('/shaped')
+    def shaped():
+        return respond({'data': shaped_rows(('id', 'name'), [(1, 'Ann'), (2, 'Bob')])})
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize('query, accept, mimetype', [
+    ('', None, 'application/json'),
+    ('', '*/*', 'application/json'),
+    ('', 'text/csv', 'text/csv'),
+    ('', 'application/x-ndjson', 'application/x-ndjson'),
+    ('', 'text/html,application/xhtml+xml,*/*;q=0.8', 'text/html'),
+    ('', 'application/fhir+json', 'application/json'),
+    # ?format= wins over the Accept header
+    ('?format=csv', 'text/html', 'text/csv'),
+    ('?format=json', 'text/csv', 'application/json'),
+    ('?format=NDJSON', 'application/json', 'application/x-ndjson'),
+])
+def test_format_from_query_then_accept(client, query, accept, mimetype):
+    headers = {'Accept': accept} if accept else {}
+    response = client.get(f'/rows{query}', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert 'Accept' in response.headers.get('Vary', '')
+
+
+def test_unknown_format_is_rejected(client):
+    response = client.get('/rows?format=xml', headers={'Accept': 'text/csv'})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_json_keeps_the_whole_payload(client):
+    assert client.get('/rows').get_json() == {'data': ROWS, 'count': 2}
+
+
+def test_ndjson_streams_only_the_rows(client):
+    lines = client.get('/rows?format=ndjson').get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == ROWS
+
+
+def test_shape_columns(client):
+    assert client.get('/shaped?shape=columns').get_json()['data'] == {
+        'columns': ['id', 'name'], 'rows': [[1, 'Ann'], [2, 'Bob']]
+    }
+    assert client.get('/shaped').get_json()['data'] == [{'id': 1, 'name': 'Ann'}, {'id': 2, 'name': 'Bob'}]
+
+
+def test_html_escapes_cell_values(client):
+    html = client.get('/rows?format=html').get_data(as_text=True)
+    assert '<script>' not in html
+    assert '&lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt;' in html
+    assert 'Smith &amp; Sons' in html
+    assert '<td>Zoë</td><td></td>' in html
+    assert html.startswith('<table class="table table-striped">')
@@ -0,0 +1,56 @@
+"""
+Tests that app.json_provider writes the same JSON with and without orjson installed
+Run: python -m pytest -q test_json_provider.py
+"""
+
+import importlib.util
+import sys
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+from app import json_provider
+
+numpy = pytest.importorskip('numpy')
+pytest.importorskip('orjson')
+
+
+@pytest.fixture
+def stdlib_provider(monkeypatch):
+    """A second copy of app.json_provider, loaded as if orjson were not installed"""
+    monkeypatch.setitem(sys.modules, 'orjson', None)
+    spec = importlib.util.spec_from_file_location('json_provider_stdlib', json_provider.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert module.orjson is None
+    return module
+
+
+PAYLOAD = {
+    'when': datetime(2024, 3, 5, 14, 30, 15, 250000),
+    'when_utc': datetime(2024, 3, 5, 14, 30, 15, tzinfo=timezone.utc),
+    'born': date(1980, 7, 1),
+    'price': Decimal('12.50'),
+    'bad_decimal': Decimal('NaN'),
+    'nan': float('nan'),
+    'inf': float('-inf'),
+    'count': numpy.int64(42),
+    'ratio': numpy.float64(0.25),
+    'flag': numpy.bool_(True),
+    'ages': numpy.array([34, 51, 67]),
+    'values': numpy.array([1.5, numpy.nan, 2.0]),
+    'name': 'Zoë Müller',
+    1: 'int key',
+    2.5: 'float key',
+    date(2024, 1, 1): 'date key',
+    'nested': [{'at': datetime(2023, 12, 31, 23, 59, 59)}, (1, 2), None],
+}
+
+
+@pytest.mark.parametrize('sort_keys, indent', [(False, False), (True, False), (False, True)])
+def test_stdlib_fallback_matches_orjson(stdlib_provider, sort_keys, indent):
+    fast = json_provider.dumps_bytes(PAYLOAD, sort_keys=sort_keys, indent=indent)
+    slow = stdlib_provider.dumps_bytes(PAYLOAD, sort_keys=sort_keys, indent=indent)
+    assert fast == slow
+    assert json_provider.loads(fast) == stdlib_provider.loads(slow)
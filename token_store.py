@@ -0,0 +1,141 @@
+"""
+Shared store for the Backend Services access token
+Lets every worker process reuse one token instead of each signing its own JWT.
+The store's lock is held while a token is fetched, so only one process refreshes at a time.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+TOKEN_STORE = os.getenv('BACKEND_TOKEN_STORE', '').lower()  # '', 'file' or 'postgres'
+TOKEN_FILE = os.getenv('BACKEND_TOKEN_FILE', os.path.join(tempfile.gettempdir(), 'epic_backend_token.json'))
+
+
+def store_key(*parts):
+    """Stable key for a token: client id, token URL and scope all change what the token grants"""
+    return hashlib.sha256('\n'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class _FileSlot:
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def load(self):
+        """(access_token, expires_at epoch seconds) or None"""
+        try:
+            with open(self.path, 'r') as f:
+                record = json.load(f).get(self.key)
+        except (OSError, ValueError):
+            return None
+        if not record:
+            return None
+        return record['access_token'], record['expires_at']
+
+    def save(self, access_token, expires_at):
+        try:
+            with open(self.path, 'r') as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            records = {}
+        records[self.key] = {'access_token': access_token, 'expires_at': expires_at}
+
+        # The file holds a bearer token: owner-only, replaced atomically
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(records, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+class FileTokenStore:
+    """Token records in a JSON file, serialized across processes with flock on a sidecar lock file"""
+
+    def __init__(self, path=TOKEN_FILE):
+        self.path = path
+
+    @contextmanager
+    def locked(self, key):
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield _FileSlot(self.path, key)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class _PostgresSlot:
+    def __init__(self, cursor, key):
+        self.cursor = cursor
+        self.key = key
+
+    def load(self):
+        self.cursor.execute("""
+            SELECT access_token, EXTRACT(EPOCH FROM expires_at)
+            FROM backend_access_tokens
+            WHERE store_key = %s
+        """, (self.key,))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        return row[0], float(row[1])
+
+    def save(self, access_token, expires_at):
+        self.cursor.execute("""
+            INSERT INTO backend_access_tokens (store_key, access_token, expires_at, updated_at)
+            VALUES (%s, %s, to_timestamp(%s), CURRENT_TIMESTAMP)
+            ON CONFLICT (store_key) DO UPDATE SET
+                access_token = EXCLUDED.access_token,
+                expires_at = EXCLUDED.expires_at,
+                updated_at = EXCLUDED.updated_at
+        """, (self.key, access_token, expires_at))
+
+
+class PostgresTokenStore:
+    """
+    Token records in the backend_access_tokens table (sql/06_backend_access_tokens.sql)
+    A transaction-scoped advisory lock on the key serializes refreshes across processes and hosts.
+    connection_factory is a context manager yielding a connection, e.g. app.utils.get_db_connection.
+    """
+
+    def __init__(self, connection_factory):
+        self.connection_factory = connection_factory
+
+    @contextmanager
+    def locked(self, key):
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (key,))
+                yield _PostgresSlot(cursor, key)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+
+def token_store_from_env(connection_factory=None):
+    """The store selected by BACKEND_TOKEN_STORE, or None to keep the token in-process only"""
+    if TOKEN_STORE == 'file':
+        return FileTokenStore()
+    if TOKEN_STORE == 'postgres':
+        if connection_factory is None:
+            raise ValueError("BACKEND_TOKEN_STORE=postgres needs a database connection factory")
+        return PostgresTokenStore(connection_factory)
+    if TOKEN_STORE:
+        raise ValueError(f"Unknown BACKEND_TOKEN_STORE: {TOKEN_STORE}")
+    return None